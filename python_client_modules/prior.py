@@ -1,29 +1,20 @@
 from py3.sts_client import STSClient, STSPoint
+from py3.prior_solis.discovery import DeviceType, find_port
+from py3.sts_logging import configure
 import serial
-import time
+
+configure(crash_path="sts_crash.log")
 
 with STSClient('http://localhost:80', True, 1, "PRIOR_STAGE", True, True) as sts_client:
 	established: bool = False
 	connection: serial.Serial = serial.Serial()
-	# Attempt connection
-	import serial.tools.list_ports
-	ports = serial.tools.list_ports.comports()
-
-	for port, desc, hwid in sorted(ports):
+	# Attempt connection, probing all ports at once (the last port found is tried first)
+	port: str | None = find_port(DeviceType.PRIOR)
+	if port is not None:
 		try:
 			connection = serial.Serial(port=port, baudrate=9600)
-			# kill the input buffer to prevent dual blocking
-			connection.timeout = 1
-			connection.write_timeout = 1
-			print(connection.read_all())
-			connection.write(b'\rSERIAL \r')
-			connection.timeout = None
-			connection.write_timeout = None
-			time.sleep(1)
-			if "00000" in connection.read_all().decode():
-				print("Successfully connected to "+ port)
-				established = True
-				break
+			print("Successfully connected to "+ port)
+			established = True
 		except serial.SerialException as exception:
 			print(exception)
 		except ValueError as exception:
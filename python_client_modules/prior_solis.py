@@ -2,6 +2,10 @@ import os.path
 from py3.sts_client import STSClient, STSPoint
 from py3.prior_solis.coordinate import Coordinate
 from py3.prior_solis.mover import MicroscopeMover
+from py3.prior_solis.spectrum import convert_asc
+from py3.sts_logging import configure
+
+configure(crash_path="sts_crash.log")
 
 
 
@@ -11,14 +15,17 @@ with STSClient('http://localhost', True, 1, "SOLIS_STAGE", True, True) as sts_cl
         if mover.connection_active:
             def move(pt:STSPoint):
                 destCoord:Coordinate=Coordinate(pt.x, pt.y)
-                print(pt.x, pt.y)
                 mover.set_coordinates(destCoord)
             def measure(exp_id:int, pt_num:int):
                 directory="P://temp"
                 filename=f"{exp_id}_{pt_num}.asc"
-                mover.set_output_directory(directory)
+                # skipped when unchanged, otherwise pipelined ahead of the capture
+                mover.set_output_directory(directory, blocking=False)
                 mover.take_capture(filename)
-                sts_client.send_file(os.path.join(directory,filename),exp_id,pt_num)
+                # upload the compact binary spectrum in the background
+                # while the stage moves to the next point
+                container=convert_asc(os.path.join(directory,filename))
+                sts_client.queue_file(container,exp_id,pt_num)
             def get_point():
                 x,y=mover.get_coordinates().to_tuple(True)
                 return STSPoint(int(x),int(y),0)
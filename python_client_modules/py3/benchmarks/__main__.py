@@ -0,0 +1,75 @@
+"""Runs the client benchmarks against an in-process queue server and simulated devices.
+
+Run from python_client_modules:
+
+    python -m py3.benchmarks --output results.json
+    python -m py3.benchmarks --baseline results.json
+
+Each benchmark runs for every transport, see `--help` for sizes.
+"""
+from __future__ import annotations
+from typing import Any
+
+import argparse
+import json
+
+from ..sts_client import STSTransport
+from . import dispatch, measurement, upload
+from .common import compare, load_results, save_results
+
+BENCHMARKS: tuple[str, ...] = ("measurement", "dispatch", "upload")
+
+
+def main() -> None:
+    """Parses the arguments, runs the benchmarks and reports the results"""
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(prog="python -m py3.benchmarks")
+    parser.add_argument(
+        "benchmarks", nargs="*", metavar="benchmark", help=f"any of {', '.join(BENCHMARKS)}, all by default"
+    )
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--baseline", help="compare with results saved by an earlier run")
+    parser.add_argument("--points", type=int, default=50, help="grid points per measurement run")
+    parser.add_argument("--instruments", type=int, default=2, help="instruments measuring each point")
+    parser.add_argument("--acquisition-time", type=float, default=0.02, help="simulated seconds per capture")
+    parser.add_argument("--messages", type=int, default=1000, help="messages of the dispatch burst")
+    parser.add_argument("--files", type=int, default=50, help="files uploaded")
+    parser.add_argument("--file-size", type=int, default=1 << 20, help="bytes per uploaded file")
+    parser.add_argument(
+        "--transport", choices=[transport.name for transport in STSTransport], action="append",
+        help="transports to benchmark, all by default"
+    )
+    args: argparse.Namespace = parser.parse_args()
+    selected: list[str] = args.benchmarks or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+    transports: list[STSTransport] = [
+        STSTransport[name] for name in (args.transport or [transport.name for transport in STSTransport])
+    ]
+
+    results: dict[str, Any] = {}
+    for transport in transports:
+        if "measurement" in selected:
+            print(f"measurement, {transport.name}...")
+            results[f"measurement_{transport.name.lower()}"] = measurement.run(
+                args.points, args.instruments, transport, args.acquisition_time
+            )
+        if "dispatch" in selected:
+            print(f"dispatch, {transport.name}...")
+            results[f"dispatch_{transport.name.lower()}"] = dispatch.run(args.messages, transport=transport)
+    if "upload" in selected:
+        print("upload...")
+        results["upload"] = upload.run(args.files, args.file_size)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        save_results(args.output, results)
+        print(f"Saved to {args.output}")
+    if args.baseline:
+        print(f"Compared with {args.baseline}:")
+        for metric, old, new, change in compare(load_results(args.baseline), results):
+            print(f"{metric:70} {old:12.3f} {new:12.3f} {change:+8.1%}")
+
+
+if __name__ == "__main__":
+    main()
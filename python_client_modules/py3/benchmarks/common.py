@@ -0,0 +1,155 @@
+"""Contains the measurements shared by the benchmarks: latency summaries, resource usage and result files"""
+from __future__ import annotations
+from typing import Any, Iterator
+
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # resource is only available on Unix, where peak memory is reported
+    resource = None
+
+
+def summarize(latencies: list[float]) -> dict[str, float]:
+    """Returns the count, mean, p50, p99 and max of latencies in seconds, as milliseconds"""
+    if not latencies:
+        return {"count": 0}
+    values: np.ndarray = np.asarray(latencies) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def _peak_rss() -> int | None:
+    """Returns the peak resident memory of the process in bytes, None where it is not available"""
+    if resource is None:
+        return None
+    peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class ResourceMeter:
+    """Measures wall time, CPU time and peak resident memory of the process over a block.
+
+    Everything in the process is counted, including the stand-in server and devices,
+    so benchmarks report the usage per instrument as the total divided by the
+    number of instruments. Memory is read from the operating system before and
+    after the block rather than traced, which would slow down the timed code;
+    the growth is how much the block raised the peak of the process.
+    """
+
+    def __init__(self) -> None:
+        self.wall: float = 0.0
+        self.cpu: float = 0.0
+        self.peak_memory: int | None = None
+        self.memory_growth: int | None = None
+
+    @contextlib.contextmanager
+    def measure(self) -> Iterator[ResourceMeter]:
+        """Measures the block"""
+        base_memory: int | None = _peak_rss()
+        wall: float = time.perf_counter()
+        cpu: float = time.process_time()
+        try:
+            yield self
+        finally:
+            self.wall = time.perf_counter() - wall
+            self.cpu = time.process_time() - cpu
+            self.peak_memory = _peak_rss()
+            if self.peak_memory is not None and base_memory is not None:
+                self.memory_growth = self.peak_memory - base_memory
+
+    def to_dict(self, instruments: int = 1) -> dict[str, float | None]:
+        """Returns the measured usage, in total and per instrument; memory is None where
+        the platform does not report it"""
+        return {
+            "wall_s": self.wall,
+            "cpu_s": self.cpu,
+            "cpu_percent": 100 * self.cpu / self.wall if self.wall else 0.0,
+            "peak_rss_mb": None if self.peak_memory is None else self.peak_memory / 2**20,
+            "rss_growth_mb": None if self.memory_growth is None else self.memory_growth / 2**20,
+            "cpu_s_per_instrument": self.cpu / instruments,
+            "rss_growth_mb_per_instrument":
+                None if self.memory_growth is None else self.memory_growth / 2**20 / instruments,
+        }
+
+
+@contextlib.contextmanager
+def quiet() -> Iterator[None]:
+    """Silences the logging and prints of the clients, simulators and stand-in server,
+    which would dominate the measurements"""
+    previous: int = logging.root.manager.disable
+    logging.disable(logging.CRITICAL)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logging.disable(previous)
+
+
+def environment() -> dict[str, Any]:
+    """Returns what a result depends on besides the code: interpreter, machine and revision"""
+    revision: str | None
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True, timeout=10
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        revision = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "revision": revision,
+    }
+
+
+def save_results(path: str, results: dict[str, Any]) -> None:
+    """Saves benchmark results with their environment as JSON"""
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"environment": environment(), "results": results}, file, indent=2)
+
+
+def load_results(path: str) -> dict[str, Any]:
+    """Loads the results saved by `save_results`"""
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)["results"]
+
+
+def _flatten(results: Any, prefix: str = "") -> dict[str, float]:
+    if isinstance(results, dict):
+        flat: dict[str, float] = {}
+        for key, value in results.items():
+            flat.update(_flatten(value, f"{prefix}.{key}" if prefix else str(key)))
+        return flat
+    if isinstance(results, (int, float)) and not isinstance(results, bool):
+        return {prefix: float(results)}
+    return {}
+
+
+def compare(baseline: dict[str, Any], results: dict[str, Any]) -> list[tuple[str, float, float, float]]:
+    """Returns (metric, baseline, result, relative change) of every metric in both results"""
+    old: dict[str, float] = _flatten(baseline)
+    new: dict[str, float] = _flatten(results)
+    return [
+        (key, old[key], new[key], (new[key] - old[key]) / old[key] if old[key] else 0.0)
+        for key in new if key in old
+    ]
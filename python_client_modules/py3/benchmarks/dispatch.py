@@ -0,0 +1,82 @@
+"""Benchmarks message dispatch: how many messages per second reach a handler,
+and how long a message takes from arriving at the server to being handled"""
+from __future__ import annotations
+from typing import Any
+
+import threading
+import time
+
+from ..debugging.queue_server import QueueServer
+from ..sts_client import STSClient, STSTransport
+from .common import ResourceMeter, quiet, summarize
+
+TOPIC: str = "benchmark"
+SUBSCRIBE_TIMEOUT: float = 30.0
+"""Seconds a client may take to handle its first message after subscribing"""
+DISPATCH_TIMEOUT: float = 60.0
+"""Seconds all messages may take to be handled"""
+
+
+class _Receiver:
+    """Handler recording when each message was handled"""
+
+    def __init__(self, expected: int) -> None:
+        self.handled: dict[int, float] = {}
+        self.subscribed: threading.Event = threading.Event()
+        """Set once a warm-up message (negative index) was handled"""
+        self._expected: int = expected
+        self._done: threading.Event = threading.Event()
+
+    def __call__(self, body: dict[str, Any]) -> None:
+        index: int = int(body["index"])
+        if index < 0:
+            self.subscribed.set()
+            return
+        self.handled[index] = time.monotonic()
+        if len(self.handled) >= self._expected:
+            self._done.set()
+
+    def wait(self, timeout: float) -> bool:
+        """Waits until every expected message was handled"""
+        return self._done.wait(timeout)
+
+
+def run(
+    messages: int = 1000, paced: int = 200, interval: float = 0.005,
+    transport: STSTransport = STSTransport.POLL
+    ) -> dict[str, Any]:
+    """Sends a burst of `messages` for throughput, then `paced` messages every `interval`
+    seconds for latency, returns both with the resource usage"""
+    meter: ResourceMeter = ResourceMeter()
+    receiver: _Receiver = _Receiver(messages + paced)
+    with quiet(), QueueServer() as server, meter.measure():
+        with STSClient(server.url, False, 1, "BENCHMARK", False, transport=transport) as client:
+            client.on(TOPIC, receiver)
+            # the burst starts once the client is receiving, so subscribing is not timed
+            server.post(TOPIC, {"index": -1})
+            subscribed: bool = receiver.subscribed.wait(SUBSCRIBE_TIMEOUT)
+            burst_sent: float = time.monotonic()
+            for index in range(messages):
+                server.post(TOPIC, {"index": index})
+            sent: dict[int, float] = {}
+            # pacing starts once the burst is through, so it measures an idle client
+            while len(receiver.handled) < messages and time.monotonic() - burst_sent < DISPATCH_TIMEOUT:
+                time.sleep(0.001)
+            burst_time: float = max(receiver.handled.values(), default=burst_sent) - burst_sent
+            for index in range(messages, messages + paced):
+                sent[index] = server.post(TOPIC, {"index": index}).time
+                time.sleep(interval)
+            complete: bool = receiver.wait(DISPATCH_TIMEOUT)
+            requests_sent: dict[str, int] = client.session.stats.to_dict()
+    handled: int = len(receiver.handled)
+    return {
+        "transport": transport.name,
+        "messages": messages,
+        "complete": subscribed and complete,
+        "messages_per_second": (min(handled, messages) / burst_time) if burst_time > 0 else 0.0,
+        "dispatch_latency": summarize([
+            receiver.handled[index] - arrived for index, arrived in sent.items() if index in receiver.handled
+        ]),
+        "client_requests": requests_sent,
+        "resources": meter.to_dict(),
+    }
@@ -0,0 +1,126 @@
+"""Benchmarks sequenced measurements: instruments on simulated SOLIS devices measuring a grid
+the way an experiment drives them, one `measure` after the `ready` of the previous instrument"""
+from __future__ import annotations
+from typing import Any
+
+import os
+import shutil
+import tempfile
+import time
+from contextlib import ExitStack
+
+from ..debugging.queue_server import QueueMessage, QueueServer
+from ..prior_solis.coordinate import Coordinate
+from ..prior_solis.mover import MicroscopeMover
+from ..prior_solis.path_planning import StageMotion
+from ..prior_solis.simulator import SimulatedSolis, SimulatedStage
+from ..prior_solis.spectrum import convert_asc
+from ..sts_client import STSClient, STSPoint, STSTransport
+from .common import ResourceMeter, quiet, summarize
+
+EXPERIMENT_ID: int = 1
+GRID_STEP: int = 200
+"""Distance between neighbouring grid points, in stage units"""
+READY_TIMEOUT: float = 60.0
+"""Seconds an instrument may take to answer a `measure`"""
+UPLOAD_TIMEOUT: float = 60.0
+"""Seconds the uploads may take to arrive after the last point"""
+
+
+def grid(points: int) -> list[STSPoint]:
+    """Returns `points` points of a square serpentine grid"""
+    side: int = max(1, round(points ** 0.5))
+    result: list[STSPoint] = []
+    for index in range(points):
+        row, column = divmod(index, side)
+        if row % 2 == 1:
+            column = side - 1 - column
+        result.append(STSPoint(column * GRID_STEP, row * GRID_STEP, 0))
+    return result
+
+
+def _instrument(
+    stack: ExitStack, server: QueueServer, sequence: int, directory: str,
+    simulator: SimulatedSolis, transport: STSTransport
+    ) -> STSClient:
+    """Starts a client measuring with `simulator`, the first instrument also moves the stage"""
+    # the mover opens its port through the class wide factory when entered
+    MicroscopeMover.serial_factory = simulator.open
+    mover: MicroscopeMover = stack.enter_context(MicroscopeMover())
+    client: STSClient = STSClient(
+        server.url, False, sequence, f"SIMULATED_{sequence}", False,
+        is_stage=sequence == 1, transport=transport
+    )
+
+    def move(point: STSPoint) -> None:
+        mover.set_coordinates(Coordinate(point.x, point.y))
+
+    def measure(pt_num: int, exp_id: int) -> None:
+        filename: str = f"{exp_id}_{pt_num}_{sequence}.asc"
+        mover.set_output_directory(directory, blocking=False)
+        mover.take_capture(filename)
+        client.queue_file(convert_asc(os.path.join(directory, filename)), pt_num, exp_id)
+
+    if sequence == 1:
+        client.onmove = move
+        client.cal_a, client.cal_b, client.cal_c = STSPoint(0, 0, 0), STSPoint(1, 0, 0), STSPoint(0, 1, 0)
+        client.current_cal_a, client.current_cal_b, client.current_cal_c = client.cal_a, client.cal_b, client.cal_c
+    client.onmeasure = measure
+    stack.enter_context(client)
+    return client
+
+
+def run(
+    points: int = 50, instruments: int = 2, transport: STSTransport = STSTransport.POLL,
+    acquisition_time: float = 0.02, jitter: float = 0.005, spectrum_size: int = 1024,
+    motion: StageMotion | None = None
+    ) -> dict[str, Any]:
+    """Measures `points` grid points with `instruments` instruments, returns
+    the measure to ready latency of every instrument, throughput and resource usage"""
+    directory: str = tempfile.mkdtemp(prefix="sts_benchmark_")
+    latencies: dict[int, list[float]] = {sequence: [] for sequence in range(1, instruments + 1)}
+    meter: ResourceMeter = ResourceMeter()
+    stage: SimulatedStage = SimulatedStage(motion if motion is not None else StageMotion())
+    try:
+        with quiet(), QueueServer() as server, meter.measure(), ExitStack() as stack:
+            for sequence in latencies:
+                _instrument(stack, server, sequence, directory, SimulatedSolis(
+                    stage if sequence == 1 else SimulatedStage(), output_directory=directory,
+                    acquisition_time=acquisition_time, jitter=jitter,
+                    spectrum_size=spectrum_size, seed=sequence,
+                ), transport)
+            started: float = time.monotonic()
+            for number, point in enumerate(grid(points), start=1):
+                for sequence, sequence_latencies in latencies.items():
+                    request: QueueMessage = server.post("measure", {
+                        "sequence": sequence, "experimentId": EXPERIMENT_ID, "pointNumber": number,
+                        "point": {"x": point.x, "y": point.y, "z": point.z},
+                    })
+                    ready: QueueMessage | None = server.wait_for(
+                        "ready", request.id, lambda body, seq=sequence: body.get("sequence") == seq,
+                        READY_TIMEOUT,
+                    )
+                    if ready is None:
+                        raise TimeoutError(f"Instrument {sequence} did not get ready at point {number}")
+                    sequence_latencies.append(ready.time - request.time)
+            measured: float = time.monotonic() - started
+            uploaded: bool = server.wait_for_uploads(points * instruments, UPLOAD_TIMEOUT)
+            upload_lag: float = (server.uploads[-1].time - started - measured) if server.uploads else 0.0
+            upload_bytes: int = sum(upload.size for upload in server.uploads)
+            requests_served: int = server.requests
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "points": points,
+        "instruments": instruments,
+        "transport": transport.name,
+        "acquisition_time_s": acquisition_time,
+        "points_per_minute": 60 * points / measured,
+        "measure_to_ready": {str(sequence): summarize(values) for sequence, values in latencies.items()},
+        "measure_to_ready_all": summarize([value for values in latencies.values() for value in values]),
+        "uploads_complete": uploaded,
+        "upload_bytes": upload_bytes,
+        "upload_lag_s": max(upload_lag, 0.0),
+        "server_requests": requests_served,
+        "resources": meter.to_dict(instruments),
+    }
@@ -0,0 +1,52 @@
+"""Benchmarks measurement uploads: files queued with `queue_file` until the server has them all"""
+from __future__ import annotations
+from typing import Any
+
+import os
+import shutil
+import tempfile
+import time
+
+from ..debugging.queue_server import QueueServer
+from ..sts_client import STSClient
+from .common import ResourceMeter, quiet, summarize
+
+UPLOAD_TIMEOUT: float = 120.0
+"""Seconds all uploads may take"""
+
+
+def run(files: int = 50, size: int = 1 << 20) -> dict[str, Any]:
+    """Uploads `files` random files of `size` bytes, returns the throughput and per file latency"""
+    directory: str = tempfile.mkdtemp(prefix="sts_benchmark_")
+    meter: ResourceMeter = ResourceMeter()
+    try:
+        paths: list[str] = []
+        for index in range(files):
+            path: str = os.path.join(directory, f"{index}.bin")
+            with open(path, "wb") as file:
+                file.write(os.urandom(size))
+            paths.append(path)
+        with quiet(), QueueServer() as server, meter.measure():
+            with STSClient(server.url, False, 1, "BENCHMARK", False) as client:
+                started: float = time.monotonic()
+                queued: list[float] = []
+                for index, path in enumerate(paths):
+                    queued.append(time.monotonic())
+                    client.queue_file(path, index, 1)
+                complete: bool = server.wait_for_uploads(files, UPLOAD_TIMEOUT)
+                elapsed: float = time.monotonic() - started
+                uploads = list(server.uploads)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    uploaded: int = sum(upload.size for upload in uploads)
+    latencies: list[float] = [
+        upload.time - queued[int(upload.fields["pointNumber"])] for upload in uploads
+    ]
+    return {
+        "files": files,
+        "file_size": size,
+        "complete": complete,
+        "megabytes_per_second": uploaded / 2**20 / elapsed if elapsed else 0.0,
+        "upload_latency": summarize(latencies),
+        "resources": meter.to_dict(),
+    }
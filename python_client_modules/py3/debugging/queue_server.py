@@ -0,0 +1,404 @@
+"""Contains QueueServer, an in-process stand-in for the message queue of the STS server.
+
+It serves what the clients use:
+- `HEAD /`
+- `GET /retrieve?Id=&topics[]=&wait=`, long-polling up to `wait` milliseconds
+- `POST /` with a message or an array of messages
+- `POST /measurements/upload`, counting the uploaded bytes without storing them
+- the websocket `/messageQueue/ws`, pushing every new message with its id and epoch
+
+Arrival times of messages and uploads are recorded, so the server can drive
+clients and time their responses. `clear()` and `trim()` reset and trim the queue
+like the STS server does, responses carry its `epoch` and `firstId`. Run as a script to serve on port 80 like the STS server.
+"""
+from __future__ import annotations
+from typing import Any, Callable
+
+import base64
+import hashlib
+import http.server
+import json
+import struct
+import threading
+import time
+import urllib.parse
+
+MAX_RETRIEVE_WAIT: float = 30.0
+"""Longest wait of a long-polling `/retrieve` in seconds, as `maxRetrieveWait` of the server"""
+WS_GUID: bytes = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+"""Key suffix of the websocket handshake, RFC 6455"""
+WS_TEXT: int = 0x1
+WS_CLOSE: int = 0x8
+WS_PING: int = 0x9
+WS_PONG: int = 0xA
+
+
+class QueueMessage:
+    """A message in the queue with the time it arrived"""
+
+    __slots__ = ("id", "topic", "body", "time")
+
+    def __init__(self, message_id: int, topic: str, body: Any, arrived: float) -> None:
+        self.id: int = message_id
+        self.topic: str = topic
+        self.body: Any = body
+        self.time: float = arrived
+
+    def data(self) -> dict[str, Any]:
+        """Returns the message as the server sends it"""
+        return {"topic": self.topic, "body": self.body}
+
+
+class QueueUpload:
+    """A measurement upload with its form fields, size and arrival time"""
+
+    __slots__ = ("fields", "size", "time")
+
+    def __init__(self, fields: dict[str, str], size: int, arrived: float) -> None:
+        self.fields: dict[str, str] = fields
+        self.size: int = size
+        self.time: float = arrived
+
+
+class QueueServer:
+    """A threaded HTTP server holding a message queue, use with `with` or `start()`, `stop()`.
+
+    `port` 0 picks a free port, see `url`.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.messages: list[QueueMessage] = []
+        """Id of the oldest stored message, `messages[0]`"""
+        self.first_id: int = 0
+        """Changes whenever the queue is cleared"""
+        self.epoch: int = int(time.time() * 1000)
+        self.uploads: list[QueueUpload] = []
+        self.requests: int = 0
+        self._condition: threading.Condition = threading.Condition()
+        self._stopped: bool = False
+        self._httpd: http.server.ThreadingHTTPServer = http.server.ThreadingHTTPServer(
+            (host, port), _make_handler(self)
+        )
+        self._httpd.daemon_threads = True
+        self._thread: threading.Thread = threading.Thread(
+            target=self._httpd.serve_forever, name="QueueServer", daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        """Address of the server, as passed to STSClient"""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self) -> None:
+        """Serves requests on a background thread"""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops serving and closes open websockets"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    @property
+    def latest_id(self) -> int:
+        """Id of the next message, as answered in `latestId`"""
+        return self.first_id + len(self.messages)
+
+    def post(self, topic: str, body: Any) -> QueueMessage:
+        """Adds a message to the queue"""
+        with self._condition:
+            message: QueueMessage = QueueMessage(self.latest_id, topic, body, time.monotonic())
+            self.messages.append(message)
+            self._condition.notify_all()
+        return message
+
+    def clear(self) -> None:
+        """Empties the queue and starts a new epoch, as the STS server does after idling"""
+        with self._condition:
+            self.messages = []
+            self.first_id = 0
+            self.epoch = max(int(time.time() * 1000), self.epoch + 1)
+            self._condition.notify_all()
+
+    def trim(self, keep: int) -> None:
+        """Drops all but the newest `keep` messages, as the STS server does on overflow"""
+        with self._condition:
+            dropped: int = max(len(self.messages) - keep, 0)
+            self.messages = self.messages[dropped:]
+            self.first_id += dropped
+
+    def since(self, message_id: int, topics: list[str] | None = None) -> list[QueueMessage]:
+        """Returns the stored messages from `message_id` on, of `topics` or of all topics"""
+        with self._condition:
+            return [
+                message for message in self.messages[max(message_id - self.first_id, 0):]
+                if topics is None or "all" in topics or message.topic in topics
+            ]
+
+    def retrieve(
+        self, message_id: int, topics: list[str] | None, wait: float = 0.0
+        ) -> dict[str, Any]:
+        """Returns the response of `/retrieve` for the messages from `message_id` on,
+        waiting up to `wait` seconds for the first message.
+        Returns at once if `message_id` is past the end of the queue"""
+        deadline: float = time.monotonic() + wait
+        with self._condition:
+            while True:
+                messages: list[QueueMessage] = self.since(message_id, topics)
+                remaining: float = deadline - time.monotonic()
+                if messages or message_id > self.latest_id or remaining <= 0 or self._stopped:
+                    return {
+                        "latestId": self.latest_id, "epoch": self.epoch, "firstId": self.first_id,
+                        "messages": [message.data() for message in messages],
+                    }
+                # only messages added after the check can match
+                message_id = self.latest_id
+                self._condition.wait(remaining)
+
+    def wait_for(
+        self, topic: str, after: int = 0, match: Callable[[Any], bool] | None = None,
+        timeout: float | None = None
+        ) -> QueueMessage | None:
+        """Waits for a message of `topic` with an id of at least `after` whose body `match`es,
+        returns None on timeout"""
+        deadline: float | None = None if timeout is None else time.monotonic() + timeout
+        checked: int = after
+        with self._condition:
+            while True:
+                for message in self.since(checked):
+                    if message.topic == topic and (match is None or match(message.body)):
+                        return message
+                checked = max(checked, self.latest_id)
+                remaining: float | None = None if deadline is None else deadline - time.monotonic()
+                if self._stopped or (remaining is not None and remaining <= 0):
+                    return None
+                self._condition.wait(remaining)
+
+    def wait_for_uploads(self, count: int, timeout: float | None = None) -> bool:
+        """Waits until `count` uploads have arrived, returns whether they did"""
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self.uploads) >= count, timeout)
+
+    def _count_request(self) -> None:
+        with self._condition:
+            self.requests += 1
+
+    def _add_upload(self, upload: QueueUpload) -> None:
+        with self._condition:
+            self.uploads.append(upload)
+            self._condition.notify_all()
+
+    def _wait_new(self, message_id: int, epoch: int, timeout: float) -> bool:
+        """Waits up to `timeout` for a message with `message_id` or a new epoch,
+        returns False once stopped"""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._stopped or self.latest_id > message_id or self.epoch != epoch, timeout
+            )
+            return not self._stopped
+
+
+def _make_handler(server: QueueServer) -> type[http.server.BaseHTTPRequestHandler]:
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Handles the requests of one connection"""
+
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately, Nagle's algorithm would delay the body
+        disable_nagle_algorithm = True
+
+        def log_message(self, *_: Any) -> None:
+            pass
+
+        def _send(self, status: int, payload: Any = None) -> None:
+            data: bytes = b"" if payload is None else json.dumps(payload).encode("utf-8")
+            try:
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client aborted a held request, e.g. to reissue it with new topics
+                self.close_connection = True
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_HEAD(self) -> None:
+            server._count_request()
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self) -> None:
+            server._count_request()
+            parsed: urllib.parse.ParseResult = urllib.parse.urlparse(self.path)
+            if parsed.path == "/messageQueue/ws":
+                self._websocket()
+                return
+            if parsed.path != "/retrieve":
+                self._send(404)
+                return
+            query: dict[str, list[str]] = urllib.parse.parse_qs(parsed.query)
+            try:
+                message_id: int = int(query.get("Id", [""])[0])
+            except ValueError:
+                self._send(400, server.retrieve(server.latest_id, []))
+                return
+            topics: list[str] = query.get("topics[]", [])
+            try:
+                wait: float = min(max(float(query.get("wait", ["0"])[0]) / 1000, 0.0), MAX_RETRIEVE_WAIT)
+            except ValueError:
+                wait = 0.0
+            self._send(200, server.retrieve(message_id, topics, wait))
+
+        def do_POST(self) -> None:
+            server._count_request()
+            path: str = urllib.parse.urlparse(self.path).path
+            if path == "/measurements/upload":
+                self._upload()
+                return
+            if path != "/":
+                self._send(404)
+                return
+            if not self.headers.get("Content-Type", "").startswith("application/json"):
+                self._body()
+                self._send(415)
+                return
+            try:
+                payload: Any = json.loads(self._body())
+            except ValueError:
+                self._send(400)
+                return
+            messages: list[Any] = payload if isinstance(payload, list) else [payload]
+            if not all(
+                isinstance(msg, dict) and isinstance(msg.get("topic"), str) and isinstance(msg.get("body"), dict)
+                for msg in messages
+            ):
+                self._send(400)
+                return
+            for msg in messages:
+                server.post(msg["topic"], msg["body"])
+            self._send(200)
+
+        def _upload(self) -> None:
+            """Parses the form fields of a multipart upload, counting the file bytes"""
+            body: bytes = self._body()
+            boundary: str = self.headers.get("Content-Type", "").partition("boundary=")[2]
+            fields: dict[str, str] = {}
+            size: int | None = None
+            for part in body.split(b"--" + boundary.encode("utf-8")):
+                head, _, content = part.partition(b"\r\n\r\n")
+                disposition: str = head.decode("utf-8", "replace")
+                if 'name="' not in disposition:
+                    continue
+                name: str = disposition.split('name="', 1)[1].split('"', 1)[0]
+                content = content[:-2] if content.endswith(b"\r\n") else content
+                if name == "file":
+                    size = len(content)
+                else:
+                    fields[name] = content.decode("utf-8")
+            if size is None:
+                self._send(400)
+                return
+            server._add_upload(QueueUpload(fields, size, time.monotonic()))
+            self._send(200)
+
+        def _websocket(self) -> None:
+            """Upgrades the connection and pushes every new message until it closes"""
+            key: str | None = self.headers.get("Sec-WebSocket-Key")
+            if key is None:
+                self._send(400)
+                return
+            accept: str = base64.b64encode(hashlib.sha1(key.encode("ascii") + WS_GUID).digest()).decode()
+            self.send_response(101)
+            self.send_header("Upgrade", "websocket")
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Sec-WebSocket-Accept", accept)
+            self.end_headers()
+            self.wfile.flush()
+            self.close_connection = True
+            closed: threading.Event = threading.Event()
+            lock: threading.Lock = threading.Lock()
+            threading.Thread(target=self._ws_receive, args=(closed, lock), daemon=True).start()
+            next_id: int = server.latest_id
+            epoch: int = server.epoch
+            try:
+                while not closed.is_set():
+                    if not server._wait_new(next_id, epoch, 0.2):
+                        break
+                    if server.epoch != epoch:
+                        # the queue was cleared, continue with its new messages
+                        next_id, epoch = 0, server.epoch
+                    for message in server.since(next_id):
+                        with lock:
+                            frame: dict[str, Any] = dict(message.data(), id=message.id, epoch=epoch)
+                            self._ws_send(WS_TEXT, json.dumps(frame).encode("utf-8"))
+                        next_id = message.id + 1
+                with lock:
+                    self._ws_send(WS_CLOSE, b"")
+            except OSError:
+                pass
+            closed.set()
+
+        def _ws_send(self, opcode: int, payload: bytes) -> None:
+            header: bytes = bytes([0x80 | opcode])
+            if len(payload) < 126:
+                header += bytes([len(payload)])
+            elif len(payload) < 1 << 16:
+                header += bytes([126]) + struct.pack(">H", len(payload))
+            else:
+                header += bytes([127]) + struct.pack(">Q", len(payload))
+            self.connection.sendall(header + payload)
+
+        def _ws_receive(self, closed: threading.Event, lock: threading.Lock) -> None:
+            """Reads client frames: messages are added to the queue, pings answered"""
+            try:
+                while not closed.is_set():
+                    head: bytes = self.rfile.read(2)
+                    if len(head) < 2:
+                        break
+                    opcode: int = head[0] & 0x0F
+                    length: int = head[1] & 0x7F
+                    if length == 126:
+                        length = struct.unpack(">H", self.rfile.read(2))[0]
+                    elif length == 127:
+                        length = struct.unpack(">Q", self.rfile.read(8))[0]
+                    mask: bytes = self.rfile.read(4) if head[1] & 0x80 else bytes(4)
+                    payload: bytes = bytes(
+                        byte ^ mask[i % 4] for i, byte in enumerate(self.rfile.read(length))
+                    )
+                    if opcode == WS_CLOSE:
+                        break
+                    if opcode == WS_PING:
+                        with lock:
+                            self._ws_send(WS_PONG, payload)
+                    elif opcode == WS_TEXT:
+                        try:
+                            msg: Any = json.loads(payload)
+                        except ValueError:
+                            continue
+                        if isinstance(msg, dict) and isinstance(msg.get("topic"), str):
+                            server.post(msg["topic"], msg.get("body", {}))
+            except (OSError, ValueError, struct.error):
+                pass
+            closed.set()
+
+    return Handler
+
+
+if __name__ == "__main__":
+    with QueueServer("0.0.0.0", 80) as queue_server:
+        print(f"Serving the message queue at {queue_server.url}, press enter to exit")
+        input()
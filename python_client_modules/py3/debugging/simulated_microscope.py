@@ -0,0 +1,49 @@
+"""Runs the SOLIS stage client of prior_solis.py against a simulated stage and SOLIS macro,
+for measuring throughput and latency without the hardware.
+Run from python_client_modules with `python -m py3.debugging.simulated_microscope`"""
+import os.path
+import tempfile
+from py3.sts_client import STSClient, STSPoint
+from py3.prior_solis.coordinate import Coordinate
+from py3.prior_solis.mover import MicroscopeMover
+from py3.prior_solis.path_planning import StageMotion
+from py3.prior_solis.simulator import Fault, SimulatedFaults, SimulatedSolis, SimulatedStage
+from py3.prior_solis.spectrum import convert_asc
+from py3.sts_logging import configure
+from py3.sts_tracing import TraceFormat, Tracer, set_tracer
+
+directory=tempfile.mkdtemp(prefix="sts_simulated_")
+configure(path=os.path.join(directory,"log.jsonl"))
+simulator=SimulatedSolis(
+    SimulatedStage(StageMotion(speed=25000, acceleration=250000, settle=0.05)),
+    output_directory=directory,
+    acquisition_time=0.5,
+    jitter=0.05,
+    faults=SimulatedFaults({Fault.STAGE_ERROR:0.0, Fault.DROP_RESPONSE:0.0}),
+)
+MicroscopeMover.serial_factory=simulator.open
+trace_path=os.path.join(directory,"trace.json")
+set_tracer(Tracer(trace_path, TraceFormat.CHROME))
+
+with STSClient('http://localhost', True, 1, "SIMULATED_STAGE", True, True) as sts_client:
+    with MicroscopeMover() as mover:
+        def move(pt:STSPoint):
+            mover.set_coordinates(Coordinate(pt.x, pt.y))
+        def measure(pt_num:int, exp_id:int):
+            filename=f"{exp_id}_{pt_num}.asc"
+            mover.set_output_directory(directory, blocking=False)
+            mover.take_capture(filename)
+            sts_client.queue_file(convert_asc(os.path.join(directory,filename)),pt_num=pt_num,ex_id=exp_id)
+        def get_point():
+            x,y=mover.get_coordinates().to_tuple(True)
+            return STSPoint(int(x),int(y),0)
+
+        sts_client.onmeasure=measure
+        sts_client.onmove=move
+        sts_client.get_points=get_point
+        sts_client.current_cal_a=STSPoint(0,0,0)
+        sts_client.current_cal_b=STSPoint(1,0,0)
+        sts_client.current_cal_c=STSPoint(0,1,0)
+        print(f"Simulated microscope saving to {directory}, press enter to exit")
+        input()
+        print(f"{len(simulator.captures)} captures taken, trace in {trace_path}")
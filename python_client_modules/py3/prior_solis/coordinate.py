@@ -1,15 +1,18 @@
 """Contains the Coordinate class, made for storage and manipulation of coordinates"""
 
 from __future__ import annotations
-from typing import Literal, Any
+from typing import Iterator, Literal, Any, overload
 
 import csv
 from math import atan2, cos, degrees, radians, sin, sqrt
 
-from logging import Logger
+import numpy as np
+import numpy.typing as npt
+
+from logging import Logger, getLogger
 #from .logger import Logger as CustomLogger
 
-logger_instance: Logger = Logger(__name__)#CustomLogger(__name__).get_logger()
+logger_instance: Logger = getLogger(__name__)
 
 
 UNIT_TO_NANOMETER: Literal[40] = 40
@@ -51,38 +54,112 @@ def get_translation(
     return Coordinate(x_transl, y_transl)
 
 
+class CornerFitException(Exception):
+    """Raised when corners cannot be fitted or the fit is worse than allowed"""
+
+
+class CornerFit:
+    """A transform fitted from old to new corner positions, `new = matrix @ old + translation`.
+
+    `residuals` holds the distance between each fitted and measured new corner,
+    a large `max_residual` means the corners do not match (e.g. a wrong re-mount).
+    """
+
+    def __init__(self, matrix: np.ndarray, translation: np.ndarray, residuals: np.ndarray) -> None:
+        self.matrix: np.ndarray = matrix
+        self.translation: np.ndarray = translation
+        self.residuals: np.ndarray = residuals
+
+    @property
+    def rms(self) -> float:
+        """Root mean square of the corner residuals"""
+        return float(np.sqrt(np.mean(self.residuals**2)))
+
+    @property
+    def max_residual(self) -> float:
+        """The largest corner residual"""
+        return float(np.max(self.residuals))
+
+    @property
+    def rotation(self) -> float:
+        """Rotation of the transform in degrees"""
+        return degrees(atan2(self.matrix[1, 0], self.matrix[0, 0]))
+
+    def apply(self, points: CoordinateArray) -> CoordinateArray:
+        """Transforms all `points` with a single matrix multiplication"""
+        return CoordinateArray(points.array @ self.matrix.T + self.translation)
+
+
+def fit_transform(
+    old_corners: list[Coordinate] | CoordinateArray,
+    new_corners: list[Coordinate] | CoordinateArray,
+    rigid: bool = True
+    ) -> CornerFit:
+    """Fits the transform mapping `old_corners` onto `new_corners` by least squares
+    Args:
+        old_corners: Sorted old corners
+        new_corners: New corners, in the same order
+        rigid (bool): Fit rotation and translation only (at least 2 corners),
+            otherwise a full affine transform (at least 3 corners)
+    Returns:
+        CornerFit: The transform with its residuals
+    """
+    old: np.ndarray = (old_corners if isinstance(old_corners, CoordinateArray)
+                       else CoordinateArray.from_coordinates(old_corners)).array
+    new: np.ndarray = (new_corners if isinstance(new_corners, CoordinateArray)
+                       else CoordinateArray.from_coordinates(new_corners)).array
+    if len(old) != len(new):
+        raise CornerFitException(f"Got {len(old)} old corners but {len(new)} new corners")
+    required: int = 2 if rigid else 3
+    if len(old) < required:
+        raise CornerFitException(f"At least {required} corners are required, got {len(old)}")
+
+    matrix: np.ndarray
+    translation: np.ndarray
+    if rigid:
+        # Kabsch: rotation best aligning the centred corner sets
+        old_centroid: np.ndarray = old.mean(axis=0)
+        new_centroid: np.ndarray = new.mean(axis=0)
+        covariance: np.ndarray = (old - old_centroid).T @ (new - new_centroid)
+        u_mat, _, vt_mat = np.linalg.svd(covariance)
+        reflection: float = float(np.sign(np.linalg.det(vt_mat.T @ u_mat.T))) or 1.0
+        matrix = vt_mat.T @ np.diag([1.0, reflection]) @ u_mat.T
+        translation = new_centroid - matrix @ old_centroid
+    else:
+        homogeneous: np.ndarray = np.hstack([old, np.ones((len(old), 1))])
+        solution: np.ndarray = np.linalg.lstsq(homogeneous, new, rcond=None)[0]
+        matrix = solution[:2].T
+        translation = solution[2]
+
+    residuals: np.ndarray = np.hypot(*(old @ matrix.T + translation - new).T)
+    return CornerFit(matrix, translation, residuals)
+
+
 def get_new_points(
     old_points: list[Coordinate],
     old_corners: list[Coordinate],
-    new_corners: list[Coordinate]
+    new_corners: list[Coordinate],
+    rigid: bool = True,
+    max_residual: float | None = None
     ) -> list[Coordinate]:
     """Returns new points of interest based on rotation and/or translation of new corners
     Args:
         old_points (list[Coordinate]): List of old point of interest
-        old_corners (list[Coordinate]): Sorted list of old corners
+        old_corners (list[Coordinate]): Sorted list of old corners, all of them are used
         new_corners (list[Coordinate]): Sorted list of new corners
+        rigid (bool): See `fit_transform`
+        max_residual (float|None): Raise `CornerFitException` if a corner
+            is further than this from its fitted position
     Returns:
         list[Coordinate]: List of new calculated points
     """
-    new_points: list[Coordinate] = []
-    # Get total rotation from both new and old corners
-    rotation_old: float = get_rotation(old_corners[0], old_corners[1])
-    rotation_new: float = get_rotation(new_corners[0], new_corners[1])
-    total_rotation: float = rotation_new - rotation_old
-
-    # Calculate translation using old corner points and new corner points
-    translation1: Coordinate = get_translation(old_corners[0], new_corners[0], total_rotation)
-    translation2: Coordinate = get_translation(old_corners[1], new_corners[1], total_rotation)
-    average_translation: Coordinate = (translation1 + translation2) / 2
-
-    for point in old_points:
-        # Generate rotated point from rotation and old point
-        point_rotated: Coordinate = rotate_point(point, total_rotation)
-        # Calculate new rotated and/or translated point
-        new_point: Coordinate = point_rotated + average_translation
-        new_points.append(new_point)
-
-    return new_points
+    fit: CornerFit = fit_transform(old_corners, new_corners, rigid)
+    logger_instance.info("Corner fit rotation %f, rms residual %f", fit.rotation, fit.rms)
+    if max_residual is not None and fit.max_residual > max_residual:
+        logger_instance.error("Corner fit residual %f exceeds %f", fit.max_residual, max_residual)
+        raise CornerFitException(
+            f"Corner fit residual {fit.max_residual} exceeds {max_residual}")
+    return fit.apply(CoordinateArray.from_coordinates(old_points)).to_coordinates()
 
 
 def read_all_points_from_file(path_to_file: str)->list[Coordinate]:
@@ -118,17 +195,33 @@ def save_all_points_to_file(points: list[Coordinate], path: str)->None:
 
 class Coordinate:
     """Holds x and y coordinate. Has manipulation functionality, behaving similarly to vectors"""
+    __slots__ = ("x", "y")
+
     def __init__(self, x: int | float, y: int | float, rounding:bool=False) -> None: # pylint: disable=invalid-name
 
         # make an exception for x and y
         self.x: int | float = x if not rounding else round(x)# pylint: disable=invalid-name
         self.y: int | float = y if not rounding else round(y)# pylint: disable=invalid-name
 
-        self.x_qm: float = self.x * UNIT_TO_NANOMETER / NM_TO_QM
-        self.y_qm: float = self.y * UNIT_TO_NANOMETER / NM_TO_QM
+    @property
+    def x_qm(self) -> float:
+        """x converted from stage units"""
+        return self.x * UNIT_TO_NANOMETER / NM_TO_QM
 
-        self.tuple: tuple[int | float, int | float] = self.x, self.y
-        self.tuple_qm: tuple[float, float] = self.x_qm, self.y_qm
+    @property
+    def y_qm(self) -> float:
+        """y converted from stage units"""
+        return self.y * UNIT_TO_NANOMETER / NM_TO_QM
+
+    @property
+    def tuple(self) -> tuple[int | float, int | float]:
+        """The coordinate as an `(x, y)` tuple"""
+        return self.x, self.y
+
+    @property
+    def tuple_qm(self) -> tuple[float, float]:
+        """The converted coordinate as an `(x_qm, y_qm)` tuple"""
+        return self.x_qm, self.y_qm
 
     def __str__(self) -> str:
         return f"X: {self.x} Y: {self.y}"
@@ -184,3 +277,127 @@ class Coordinate:
     def from_dict(dictionary:dict[str,int|float]) -> Coordinate:
         """Converts a dictionary to a Coordinate"""
         return Coordinate(dictionary["x"],dictionary["y"])
+
+
+class CoordinateArray:
+    """Holds many coordinates in an (N,2) NumPy array.
+
+    Supports the vector arithmetic of `Coordinate` (with a `Coordinate` or another
+    array of the same length), rotation and translation over the whole set at once.
+    Indexing with an integer returns a `Coordinate`, slicing returns a `CoordinateArray`.
+    """
+    __slots__ = ("array",)
+
+    def __init__(self, array: npt.ArrayLike) -> None:
+        """`array`: points of shape (N,2), or a single point of shape (2,).
+        Raises ValueError for any other shape instead of reinterpreting it"""
+        values: np.ndarray = np.asarray(array, dtype=np.float64)
+        if values.shape == (2,) or (values.ndim == 1 and values.size == 0):
+            values = values.reshape(-1, 2)
+        elif values.ndim != 2 or values.shape[1] != 2:
+            raise ValueError(f"Coordinates must have shape (N,2), got {values.shape}")
+        self.array: np.ndarray = values
+
+    @staticmethod
+    def from_coordinates(coordinates: list[Coordinate]) -> CoordinateArray:
+        """Packs a list of `Coordinate`s into an array"""
+        return CoordinateArray([(coord.x, coord.y) for coord in coordinates])
+
+    def to_coordinates(self, rounding:bool=False) -> list[Coordinate]:
+        """Unpacks the array into a list of `Coordinate`s"""
+        return [Coordinate(x, y, rounding) for x, y in self.array.tolist()]
+
+    @property
+    def x(self) -> np.ndarray: # pylint: disable=invalid-name
+        """View of all x coordinates"""
+        return self.array[:, 0]
+
+    @property
+    def y(self) -> np.ndarray: # pylint: disable=invalid-name
+        """View of all y coordinates"""
+        return self.array[:, 1]
+
+    @property
+    def x_qm(self) -> np.ndarray:
+        """All x coordinates converted from stage units"""
+        return self.x * UNIT_TO_NANOMETER / NM_TO_QM
+
+    @property
+    def y_qm(self) -> np.ndarray:
+        """All y coordinates converted from stage units"""
+        return self.y * UNIT_TO_NANOMETER / NM_TO_QM
+
+    def __len__(self) -> int:
+        return len(self.array)
+
+    @overload
+    def __getitem__(self, index: int) -> Coordinate: ...
+    @overload
+    def __getitem__(self, index: slice | npt.ArrayLike) -> CoordinateArray: ...
+    def __getitem__(self, index: Any) -> Coordinate | CoordinateArray:
+        if isinstance(index, (int, np.integer)):
+            x_coord, y_coord = self.array[index].tolist()
+            return Coordinate(x_coord, y_coord)
+        return CoordinateArray(self.array[index])
+
+    def __iter__(self) -> Iterator[Coordinate]:
+        for x_coord, y_coord in self.array.tolist():
+            yield Coordinate(x_coord, y_coord)
+
+    def __str__(self) -> str:
+        return f"CoordinateArray of {len(self)} points"
+
+    @staticmethod
+    def _operand(other: Coordinate | CoordinateArray) -> np.ndarray:
+        if isinstance(other, Coordinate):
+            return np.array(other.tuple, dtype=np.float64)
+        return other.array
+
+    def __add__(self, other: Coordinate | CoordinateArray) -> CoordinateArray:
+        return CoordinateArray(self.array + CoordinateArray._operand(other))
+
+    def __sub__(self, other: Coordinate | CoordinateArray) -> CoordinateArray:
+        return CoordinateArray(self.array - CoordinateArray._operand(other))
+
+    def __mul__(self, multiplier: int | float) -> CoordinateArray:
+        return CoordinateArray(self.array * multiplier)
+
+    def __truediv__(self, divider: int | float) -> CoordinateArray:
+        return CoordinateArray(self.array / divider)
+
+    def __abs__(self) -> CoordinateArray:
+        return CoordinateArray(np.abs(self.array))
+
+    def mag(self) -> np.ndarray:
+        """Returns the magnitude of every coordinate as if it was a vector"""
+        return np.hypot(self.x, self.y)
+
+    def mag_sq(self) -> np.ndarray:
+        """Returns the squared magnitude of every coordinate as if it was a vector"""
+        return np.einsum("ij,ij->i", self.array, self.array)
+
+    def rounded(self) -> CoordinateArray:
+        """Returns a new array with rounded coordinates"""
+        return CoordinateArray(np.round(self.array))
+
+    def dot(self, other: Coordinate | CoordinateArray) -> np.ndarray:
+        """Computes the dot product of every coordinate with `other`"""
+        if isinstance(other, Coordinate):
+            return self.array @ CoordinateArray._operand(other)
+        return np.einsum("ij,ij->i", self.array, other.array)
+
+    def rotated(self, angle: int | float, origin: Coordinate | None = None) -> CoordinateArray:
+        """Rotates all coordinates around `origin` (default `(0,0)`) by `angle` in degrees"""
+        rad_angle: float = radians(angle)
+        rotation: np.ndarray = np.array([
+            [cos(rad_angle), -sin(rad_angle)],
+            [sin(rad_angle), cos(rad_angle)],
+        ])
+        if origin is None:
+            return CoordinateArray(self.array @ rotation.T)
+        pivot: np.ndarray = CoordinateArray._operand(origin)
+        return CoordinateArray((self.array - pivot) @ rotation.T + pivot)
+
+    def translated(self, offset: Coordinate) -> CoordinateArray:
+        """Moves all coordinates by `offset`"""
+        return self + offset
@@ -0,0 +1,192 @@
+"""Contains serial port discovery, finding the SOLIS macro and the PRIOR stage among the COM ports.
+
+All candidate ports are probed at once, each with short timeouts:
+- `PING` is answered with `OK` by the SOLIS macro
+- `SERIAL` is answered with a serial number containing `PRIOR_SIGNATURE` by the PRIOR stage.
+  A stage answers the `PING` before it with an error, which is discarded first.
+
+The ports found are cached in `CACHE_PATH` and checked before any other port
+the next time, so usually only the known ports are probed.
+"""
+from __future__ import annotations
+from typing import Any, Callable, Iterable
+
+import json
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from enum import Enum
+from logging import Logger, getLogger
+
+import serial  # type: ignore
+import serial.tools.list_ports  # type: ignore
+
+logger: Logger = getLogger(__name__)
+
+BAUDRATE: int = 9600
+PROBE_TIMEOUT: float = 0.5
+"""Seconds a device has to answer a probe"""
+QUIET_TIME: float = 0.05
+"""Seconds without input after which a port is taken to have nothing more to say"""
+PRIOR_SIGNATURE: bytes = b"00000"
+"""Part of the serial numbers of the PRIOR stages"""
+MAX_PROBES: int = 16
+"""Most ports probed at the same time"""
+CACHE_PATH: str = os.path.join(os.path.expanduser("~"), ".sts_client", "ports.json")
+"""File storing the ports of the devices found last"""
+
+
+class DeviceType(Enum):
+    """Enum of the devices that can be discovered"""
+
+    SOLIS = 1
+    PRIOR = 2
+
+
+def _read_line(port: serial.Serial, timeout: float) -> bytes:
+    """Reads a `\\r` terminated line, or what arrived before `timeout`"""
+    deadline: float = time.monotonic() + timeout
+    line: bytes = b""
+    while not line.endswith(b"\r"):
+        remaining: float = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        port.timeout = remaining
+        chunk: bytes = port.read(1)
+        if not chunk:
+            break
+        line += chunk
+    return line.strip()
+
+
+def _drain(port: serial.Serial, timeout: float) -> None:
+    """Discards input until none arrives for `QUIET_TIME`, or for at most `timeout`"""
+    deadline: float = time.monotonic() + timeout
+    port.timeout = QUIET_TIME
+    while time.monotonic() < deadline:
+        if not port.read(max(port.in_waiting, 1)):
+            return
+
+
+def probe_port(
+    port_name: str, timeout: float = PROBE_TIMEOUT,
+    serial_factory: Callable[..., serial.Serial] = serial.Serial
+    ) -> DeviceType | None:
+    """Returns the device answering on `port_name`, None if it is unknown or unavailable"""
+    try:
+        port: serial.Serial = serial_factory(port=port_name, baudrate=BAUDRATE)
+    except (serial.SerialException, ValueError, OSError) as exc:
+        logger.info("Cannot open %s: %s", port_name, exc)
+        return None
+    try:
+        port.write_timeout = timeout
+        port.reset_input_buffer()
+        # the SOLIS macro answers PING itself and forwards SERIAL to the stage,
+        # so PING has to come first
+        port.write(b"PING\r")
+        if _read_line(port, timeout) == b"OK":
+            return DeviceType.SOLIS
+        # the stage answers PING with an error, which may arrive after the read
+        # above gave up and would be taken for the answer to SERIAL
+        _drain(port, timeout)
+        port.write(b"SERIAL\r")
+        deadline: float = time.monotonic() + timeout
+        while True:
+            remaining: float = deadline - time.monotonic()
+            line: bytes = _read_line(port, remaining) if remaining > 0 else b""
+            if not line:
+                return None
+            if PRIOR_SIGNATURE in line:
+                return DeviceType.PRIOR
+    except (serial.SerialException, OSError) as exc:
+        logger.info("Probing %s failed: %s", port_name, exc)
+        return None
+    finally:
+        port.close()
+
+
+def load_cache(path: str = CACHE_PATH) -> dict[DeviceType, str]:
+    """Returns the cached ports of the devices, empty if there is no valid cache"""
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            cached: dict[str, str] = json.load(file)
+        return {DeviceType[name]: port for name, port in cached.items() if name in DeviceType.__members__}
+    except (OSError, ValueError, AttributeError) as exc:
+        logger.info("No port cache loaded: %s", exc)
+        return {}
+
+
+def save_cache(ports: dict[DeviceType, str], path: str = CACHE_PATH) -> None:
+    """Saves the ports of the devices, replacing the cache at once"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary: str = path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump({device.name: port for device, port in ports.items()}, file)
+        os.replace(temporary, path)
+    except OSError as exc:
+        logger.warning("Could not save the port cache: %s", exc)
+
+
+def _probe_all(
+    port_names: Iterable[str], wanted: set[DeviceType], timeout: float,
+    serial_factory: Callable[..., serial.Serial]
+    ) -> dict[DeviceType, str]:
+    """Probes ports concurrently until every wanted device is found"""
+    found: dict[DeviceType, str] = {}
+    names: list[str] = list(port_names)
+    if not names:
+        return found
+    pool: ThreadPoolExecutor = ThreadPoolExecutor(
+        max_workers=min(MAX_PROBES, len(names)), thread_name_prefix="probe"
+    )
+    futures: dict[Future[DeviceType | None], str] = {
+        pool.submit(probe_port, name, timeout, serial_factory): name for name in names
+    }
+    for future in as_completed(futures):
+        device: DeviceType | None = future.result()
+        if device in wanted and device not in found:
+            found[device] = futures[future]
+            logger.info("Found %s on %s", device.name, futures[future])
+        if wanted <= found.keys():
+            break
+    # probes of the other ports are left to time out in the background
+    pool.shutdown(wait=False, cancel_futures=True)
+    return found
+
+
+def discover(
+    devices: Iterable[DeviceType] = tuple(DeviceType), port_names: Iterable[str] | None = None,
+    timeout: float = PROBE_TIMEOUT, cache_path: str | None = CACHE_PATH,
+    serial_factory: Callable[..., serial.Serial] = serial.Serial
+    ) -> dict[DeviceType, str]:
+    """Finds the ports of `devices`, returning those that were found.
+
+    `port_names`: ports to search, all COM ports by default
+    `cache_path`: where the found ports are cached, None disables the cache
+    """
+    wanted: set[DeviceType] = set(devices)
+    cached: dict[DeviceType, str] = {} if cache_path is None else load_cache(cache_path)
+    found: dict[DeviceType, str] = _probe_all(
+        {port for device, port in cached.items() if device in wanted}, wanted, timeout, serial_factory
+    )
+    # the cached ports are confirmed first, all others are only probed for missing devices
+    if not wanted <= found.keys():
+        if port_names is None:
+            port_names = sorted(info.device for info in serial.tools.list_ports.comports())
+        remaining: list[str] = [name for name in port_names if name not in found.values()]
+        found.update(_probe_all(remaining, wanted - found.keys(), timeout, serial_factory))
+    # forget the cached ports of wanted devices that were not found again
+    updated: dict[DeviceType, str] = {
+        **{device: port for device, port in cached.items() if device not in wanted}, **found
+    }
+    if cache_path is not None and updated != cached:
+        save_cache(updated, cache_path)
+    for device in wanted - found.keys():
+        logger.warning("%s not found", device.name)
+    return found
+
+
+def find_port(device: DeviceType, **kwargs: Any) -> str | None:
+    """Returns the port of `device`, None if it was not found. Accepts the arguments of `discover`"""
+    return discover((device,), **kwargs).get(device)
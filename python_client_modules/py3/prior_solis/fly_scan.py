@@ -0,0 +1,178 @@
+"""Contains FlyScanner, capturing dense grids while the stage sweeps each row at constant speed.
+
+Instead of stopping at every point (`G,x,y`, waiting for `R`, then `RUN`), the stage is
+started along a row with `VS` and captures are triggered at the times the stage passes
+the frame positions. The SOLIS macro handles one command at a time, so the stage
+position is read with `P` right before and right after every capture and the frame is
+tagged with the position interpolated at the middle of the capture.
+The distance travelled during the capture is kept as the frame's blur.
+"""
+from __future__ import annotations
+from typing import Any
+
+import time
+from logging import Logger, getLogger
+
+from .coordinate import Coordinate
+from .mover import MicroscopeMover
+
+logger: Logger = getLogger(__name__)
+
+
+class FlyScanException(Exception):
+    """Raised when a row cannot be scanned as requested"""
+
+
+class FlyFrame:
+    """A capture taken while the stage was moving.
+
+    `position` is the interpolated stage position at the middle of the capture,
+    `start` and `end` the positions read right before and after it.
+    """
+
+    __slots__ = ("filename", "row", "index", "position", "start", "end", "duration")
+
+    def __init__(
+        self, filename: str, row: int, index: int, position: Coordinate,
+        start: Coordinate, end: Coordinate, duration: float
+        ) -> None:
+        self.filename: str = filename
+        self.row: int = row
+        self.index: int = index
+        self.position: Coordinate = position
+        self.start: Coordinate = start
+        self.end: Coordinate = end
+        self.duration: float = duration
+
+    @property
+    def blur(self) -> float:
+        """Distance the stage moved while the frame was captured, in stage units"""
+        return (self.end - self.start).mag()
+
+    def to_dict(self) -> dict[str, Any]:
+        """Returns the frame as a JSON serializable dictionary"""
+        return {
+            "filename": self.filename,
+            "row": self.row,
+            "index": self.index,
+            "position": self.position.to_dict(),
+            "blur": self.blur,
+            "duration": self.duration,
+        }
+
+
+def _interpolate(
+    first: tuple[float, Coordinate], second: tuple[float, Coordinate], at: float
+    ) -> Coordinate:
+    """Linearly interpolates between two timed positions"""
+    (t_first, p_first), (t_second, p_second) = first, second
+    if t_second <= t_first:
+        return p_first
+    return p_first + (p_second - p_first) * ((at - t_first) / (t_second - t_first))
+
+
+class FlyScanner:
+    """Scans rows of frames with the stage in continuous motion.
+
+    `velocity`: stage speed along a row, in stage units per second
+    `lead_in`: distance travelled before the first frame, to let the stage reach
+    `velocity`, in stage units
+    `max_blur`: frames that moved further while being captured are logged as warnings
+
+    The mover must be connected. Use with a capture setup (exposure and
+    accumulations in SOLIS) short enough for the expected blur.
+    """
+
+    def __init__(
+        self, mover: MicroscopeMover, velocity: float,
+        lead_in: float = 0.0, max_blur: float | None = None
+        ) -> None:
+        if velocity <= 0:
+            raise ValueError("Velocity must be positive")
+        self.mover: MicroscopeMover = mover
+        self.velocity: float = velocity
+        self.lead_in: float = lead_in
+        self.max_blur: float | None = max_blur
+        # running estimate of how long a capture takes, to center captures on their positions
+        self._capture_time: float = 0.0
+
+    def _timed_position(self) -> tuple[float, Coordinate]:
+        """Reads the stage position, timed at the middle of the request"""
+        before: float = time.monotonic()
+        position: Coordinate = self.mover.get_coordinates()
+        return (before + time.monotonic()) / 2, position
+
+    def scan_row(
+        self, start: Coordinate, end: Coordinate, frames: int, row: int = 0, prefix: str = "fly"
+        ) -> list[FlyFrame]:
+        """Sweeps from `start` to `end`, capturing `frames` frames centered on equal segments.
+
+        Frames are saved by SOLIS as `{prefix}_{row}_{index}.asc`.
+        Raises FlyScanException if the captures cannot keep up with the stage.
+        """
+        if frames < 1:
+            raise ValueError("A row needs at least one frame")
+        length: float = (end - start).mag()
+        if length == 0:
+            raise FlyScanException("Row start and end are the same point")
+        direction: Coordinate = (end - start) / length
+        step: float = length / frames
+
+        self.mover.set_coordinates(start - direction * self.lead_in)
+        result: list[FlyFrame] = []
+        self.mover.set_velocity(direction * self.velocity)
+        try:
+            moving_since: float = time.monotonic()
+            for index in range(frames):
+                # time at which the stage passes the middle of the frame's segment
+                target: float = moving_since + (self.lead_in + step * (index + 0.5)) / self.velocity
+                delay: float = target - self._capture_time / 2 - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif -delay > step / self.velocity:
+                    raise FlyScanException(
+                        f"Frame {index} of row {row} is late by {-delay:.3f} s, "
+                        f"lower the velocity or the exposure")
+                result.append(self._capture(f"{prefix}_{row}_{index}.asc", row, index))
+        finally:
+            self.mover.stop()
+        return result
+
+    def _capture(self, filename: str, row: int, index: int) -> FlyFrame:
+        before: tuple[float, Coordinate] = self._timed_position()
+        capture_start: float = time.monotonic()
+        self.mover.take_capture(filename)
+        capture_end: float = time.monotonic()
+        after: tuple[float, Coordinate] = self._timed_position()
+
+        duration: float = capture_end - capture_start
+        self._capture_time = duration if not self._capture_time else (self._capture_time + duration) / 2
+        frame: FlyFrame = FlyFrame(
+            filename, row, index,
+            _interpolate(before, after, (capture_start + capture_end) / 2),
+            before[1], after[1], duration,
+        )
+        if self.max_blur is not None and frame.blur > self.max_blur:
+            logger.warning("Frame %s blurred over %.1f units", filename, frame.blur)
+        return frame
+
+    def scan_grid(
+        self, corner_a: Coordinate, corner_b: Coordinate, rows: int, columns: int, prefix: str = "fly"
+        ) -> list[FlyFrame]:
+        """Scans a rectangular grid between two opposite corners row by row,
+        reversing the direction of every other row"""
+        if rows < 1:
+            raise ValueError("A grid needs at least one row")
+        row_step: float = (corner_b.y - corner_a.y) / rows
+        result: list[FlyFrame] = []
+        for row in range(rows):
+            y: float = corner_a.y + row_step * (row + 0.5)
+            # frames are centered on the cells of the grid
+            left: Coordinate = Coordinate(corner_a.x, y)
+            right: Coordinate = Coordinate(corner_b.x, y)
+            if row % 2 == 1:
+                left, right = right, left
+            logger.info("Scanning row %i of %i", row + 1, rows)
+            result.extend(self.scan_row(left, right, columns, row, prefix))
+        logger.info("Scanned %i frames", len(result))
+        return result
@@ -1,22 +1,45 @@
 """Contains the class responsible for connecting to SOLIS and stage control"""
-import time
-from logging import Logger
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from logging import Logger, getLogger
 from typing import Callable, Any
 from enum import Enum
 import serial  # type: ignore
 import serial.tools.list_ports  # type: ignore
 
 from .coordinate import Coordinate
+from .discovery import DeviceType, find_port
+from .serial_link import SerialLink, any_line, wait
+from ..sts_tracing import get_tracer
 
 # from .event import CustomEvent
 # from .logger import Logger
 # from ..helpers.configuration import BAUDRATE, LOOPBACK_A
 
-logger: Logger = Logger(__name__)  # .get_logger()
+logger: Logger = getLogger(__name__)
 
 LOOPBACK_A = "COM6"
 BAUDRATE = 9600
 
+PING_TIMEOUT: float = 0.3
+"""Seconds SOLIS and the stage have to answer a ping"""
+COMMAND_TIMEOUT: float | None = 10
+"""Default seconds to wait for the response to a command"""
+MOVE_TIMEOUT: float | None = 120
+"""Default seconds to wait for the stage to reach its destination"""
+CAPTURE_TIMEOUT: float | None = None
+"""Default seconds to wait for an acquisition, None as exposures can be arbitrarily long"""
+
+
+BATCH_DONE: bytes = b"DONE"
+"""Prefix of the line reporting a captured point of a batch"""
+BATCH_ERROR: bytes = b"ERROR"
+"""Prefix of the line reporting a point of a batch the stage could not move to"""
+
+
+def move_finished(line: bytes) -> bool:
+    """Response predicate of moves, the stage reports `R` once it has stopped"""
+    return line.endswith(b"R")
+
 
 class MicroscopeStatus(Enum):
     """Enum of possible microscope connection statuses"""
@@ -38,6 +61,10 @@ class MicroscopeAlreadyActive(Exception):
     but something is attempting to engage it again."""
 
 
+class MicroscopeTimeoutException(Exception):
+    """Called when SOLIS or the stage did not respond to a command in time"""
+
+
 class MicroscopeMover:
     """
     A singleton class of the mover.py module instantiated privately.
@@ -56,11 +83,17 @@ class MicroscopeMover:
     thus not being able to respond in time
     (`ontimeout` is called as well)
 
-    May block endlessly if messages are sent to a severed connection
+    Responses are read by a background `SerialLink`. Commands time out after
+    `command_timeout`, `move_timeout` or `capture_timeout` seconds
+    (`None` blocks until answered), raising `MicroscopeTimeoutException`.
     """
 
     __instance: "MicroscopeMover|None" = None
 
+    serial_factory: Callable[..., serial.Serial] = serial.Serial
+    """Opens the serial port, called with `port` and `baudrate`.
+    Replace with a simulator to run without hardware."""
+
     # ontimeout:CustomEvent=CustomEvent("MicroscopeMover.ontimeout")
     # ondisconnect:CustomEvent=CustomEvent("MicroscopeMover.ondisconnect")
     # onsolisunresponsive:CustomEvent=CustomEvent("MicroscopeMover.onsolisunresponsive")
@@ -75,13 +108,20 @@ class MicroscopeMover:
     def __init__(self) -> None:
         self.last_status: MicroscopeStatus = MicroscopeStatus.DISCONNECTED
         self.serial: serial.Serial = serial.Serial()
+        self.link: SerialLink | None = None
         self.connection_active: bool = False
+        self.command_timeout: float | None = COMMAND_TIMEOUT
+        self.move_timeout: float | None = MOVE_TIMEOUT
+        self.capture_timeout: float | None = CAPTURE_TIMEOUT
+        # last state set on the devices, to skip commands that would not change it
+        self._speed: int | None = None
+        self._output_directory: str | None = None
 
     def __enter__(self):
         if self.connection_active:
             logger.error("Microscope activated twice simultaneously")
             raise MicroscopeAlreadyActive()
-        MicroscopeMover._connect(self, LOOPBACK_A)
+        MicroscopeMover._connect_any(self)
         logger.info("Accessing microscope")
         self.connection_active = True
         return self
@@ -109,7 +149,7 @@ class MicroscopeMover:
             micro_m = MicroscopeMover.__instance
         else:
             micro_m = MicroscopeMover()
-        if MicroscopeMover._connect(micro_m, LOOPBACK_A):
+        if MicroscopeMover._connect_any(micro_m):
             logger.info("Converse start.")
             callback(micro_m)
             logger.info("Converse end.")
@@ -132,7 +172,7 @@ class MicroscopeMover:
 
         # Attempt connection
         try:
-            micro_m.serial = serial.Serial(port=com_port, baudrate=BAUDRATE)
+            micro_m.serial = MicroscopeMover.serial_factory(port=com_port, baudrate=BAUDRATE)
             logger.info("Successfully connected to %s", com_port)
 
         except serial.SerialException as exception:
@@ -143,6 +183,11 @@ class MicroscopeMover:
             logger.error(exception)
             return False
 
+        micro_m.link = SerialLink(micro_m.serial)
+        micro_m.link.start()
+        micro_m._speed = None
+        micro_m._output_directory = None
+
         # test connection
         micro_m.last_status = micro_m.ping_all()
         if micro_m.last_status == MicroscopeStatus.CONNECTED:
@@ -151,6 +196,21 @@ class MicroscopeMover:
 
         return False
 
+    @staticmethod
+    def _connect_any(micro_m: "MicroscopeMover") -> bool:
+        """
+        Connects to `LOOPBACK_A`, or if SOLIS does not answer there,
+        to the port found by discovery. Returns whether connection has been established
+        """
+        if MicroscopeMover._connect(micro_m, LOOPBACK_A):
+            return True
+        MicroscopeMover._close_connection(micro_m)
+        logger.info("SOLIS not found on %s, searching all ports", LOOPBACK_A)
+        com_port: str | None = find_port(DeviceType.SOLIS, serial_factory=MicroscopeMover.serial_factory)
+        if com_port is None or com_port == LOOPBACK_A:
+            return False
+        return MicroscopeMover._connect(micro_m, com_port)
+
     def ping_all(self) -> MicroscopeStatus:
         """
         Pings SOLIS and the stage to check the connection status.
@@ -158,41 +218,28 @@ class MicroscopeMover:
         """
 
         logger.info("Checking port status")
-        timeout: float = 0.3
-        if self.serial.is_open:
-            previous_timeout: float | None = self.serial.timeout  # type: ignore
-            previous_write_timeout: float | None = self.serial.write_timeout  # type: ignore
-            self.serial.timeout = timeout
-            self.serial.write_timeout = timeout
+        if self.serial.is_open and self.link is not None and self.link.alive:
             logger.info("Pinging SOLIS")
-            self.serial.write(b"PING\r")  # type: ignore
-            response: str = (
-                self.serial.read_until(b"PING\r").decode("utf-8").strip()
-            )  # type:ignore
-
-            # SOLIS is unresponsive
-            if len(response) == 0:
+            try:
+                self._command(b"PING\r", timeout=PING_TIMEOUT)
+            except MicroscopeTimeoutException:
+                # SOLIS is unresponsive
                 logger.info("SOLIS unresponsive.")
                 # MicroscopeMover.onsolisunresponsive()
                 # MicroscopeMover.ontimeout()
-                self.serial.write_timeout = previous_write_timeout
-                self.serial.timeout = previous_timeout
                 return MicroscopeStatus.SOLIS_UNRESPONSIVE
 
             # SOLIS is responsive, check if stage responds
-            self.serial.write(b"SERIAL\r")  # type: ignore
-            response: str = self.serial.read_until(b"\r").decode("utf-8").rstrip()  # type: ignore
+            try:
+                response: str = self._command(b"SERIAL\r", timeout=PING_TIMEOUT).decode("utf-8").rstrip()
+            except MicroscopeTimeoutException:
+                response = ""
             if not response.isnumeric():
                 logger.info("Stage unresponsive")
                 # MicroscopeMover.onstageunresponsive()
                 # MicroscopeMover.ontimeout()
-                self.serial.write_timeout = previous_write_timeout
-                self.serial.timeout = previous_timeout
                 return MicroscopeStatus.STAGE_UNRESPONSIVE
 
-            # reset serial connection settings and send ok status
-            self.serial.write_timeout = previous_write_timeout
-            self.serial.timeout = previous_timeout
             # MicroscopeMover.onconnect()
             logger.info("Ping successful")
             return MicroscopeStatus.CONNECTED
@@ -200,6 +247,39 @@ class MicroscopeMover:
         # MicroscopeMover.ondisconnect()
         return MicroscopeStatus.DISCONNECTED
 
+    def _request(self, cmd: bytes, is_final: Callable[[bytes], bool] = any_line,
+                 pipelined: bool = False) -> "Future[list[bytes]]":
+        """Queues `cmd` on the serial link, returning a future of its response lines"""
+        if self.link is None or not self.link.alive:
+            raise MicroscopeUnavailableException()
+        return self.link.request(cmd, is_final, pipelined)
+
+    def _send_state(self, cmd: bytes, blocking: bool) -> None:
+        """Sends a pipelined state setting command.
+        If not `blocking`, returns without waiting and only logs failures"""
+        response: Future[list[bytes]] = self._request(cmd, pipelined=True)
+        if blocking:
+            self._result(response, self.command_timeout, cmd)
+            return
+
+        def _log_failure(done: "Future[list[bytes]]") -> None:
+            if not done.cancelled() and done.exception() is not None:
+                logger.error('"%s" failed: %s', cmd.strip(), done.exception())
+        response.add_done_callback(_log_failure)
+
+    def _command(self, cmd: bytes, timeout: float | None = None,
+                 is_final: Callable[[bytes], bool] = any_line) -> bytes:
+        """Sends `cmd` and blocks until its final response line, which is returned"""
+        return self._result(self._request(cmd, is_final), timeout, cmd)[-1]
+
+    def _result(self, future: "Future[list[bytes]]", timeout: float | None, cmd: bytes) -> list[bytes]:
+        """Waits for the response lines of `cmd`, abandoning it on timeout"""
+        try:
+            return wait(future, timeout, self.link)
+        except FutureTimeoutError as exc:
+            logger.error('No response to "%s" in %s s', cmd.strip(), timeout)
+            raise MicroscopeTimeoutException(cmd) from exc
+
     def _test_status(self) -> MicroscopeStatus:
         """Pings SOLIS and the stage to check the connection status.
         Closes the connection if timeout is discovered.
@@ -227,29 +307,67 @@ class MicroscopeMover:
         """
         if self.last_status != MicroscopeStatus.CONNECTED:
             raise MicroscopeUnavailableException()
-        self.serial.write("P \r".encode())  # type: ignore
-        coord_string: list[str] = self.serial.read_until(b"\r").decode().split(",")[:2]
+        coord_string: list[str] = self._result(
+            self._request("P \r".encode(), pipelined=True), self.command_timeout, b"P"
+        )[-1].decode().split(",")[:2]
         coord: Coordinate = Coordinate(int(coord_string[0]), int(coord_string[1]))
         logger.info("Read point %s", coord)
         return coord
 
-    def set_coordinates(self, coord: Coordinate) -> None:
+    def move_to(self, coord: Coordinate) -> "Future[None]":
         """
-        Sends a command to the stage to move to specific coordinates
+        Sends a command to the stage to move to specific coordinates without waiting.
 
-        `cord`: The absolute coordinates to where should the stage be moved to
-        returns True if successful
+        Returns a future resolving the instant the stage reports it has arrived.
+        Cancelling the future, or timing out on it, only stops waiting,
+        the stage still completes the move.
         """
+        return self._move_to(coord)[0]
+
+    def _move_to(self, coord: Coordinate) -> "tuple[Future[None], Future[list[bytes]]]":
+        """Sends the move, returns the future of the move and of the serial request"""
         if self.last_status != MicroscopeStatus.CONNECTED:
             raise MicroscopeUnavailableException()
         rounded_coord: Coordinate = coord.rounded()
         logger.info("Going to: %i, %i", rounded_coord.x, rounded_coord.y)
         string: str = f"G,{rounded_coord.x},{rounded_coord.y} \r"
-        self.serial.write(string.encode())  # type: ignore
+        moved: Future[None] = Future()
+        response: Future[list[bytes]] = self._request(string.encode(), move_finished)
+
+        def _resolve(done: "Future[list[bytes]]") -> None:
+            if done.cancelled() or not moved.set_running_or_notify_cancel():
+                return
+            exc: BaseException | None = done.exception()
+            if exc is not None:
+                moved.set_exception(exc)
+            else:
+                moved.set_result(None)
+        response.add_done_callback(_resolve)
+        # cancelling the move stops waiting for its response
+        moved.add_done_callback(lambda done: response.cancel() if done.cancelled() else None)
+        return moved, response
+
+    def set_coordinates(self, coord: Coordinate, timeout: float | None = None) -> None:
+        """
+        Sends a command to the stage to move to specific coordinates
+        and blocks until the stage reaches them
 
-        # wait until stage reaches it's destination
-        while self.serial.read_until(b"\r")[-2:] != b"R\r":  # type: ignore
-            time.sleep(0.05)
+        `cord`: The absolute coordinates to where should the stage be moved to
+        `timeout`: Seconds to wait, `move_timeout` by default. On timeout the move
+        is abandoned, see `SerialLink.abandon()`, so later commands are not held up
+        """
+        with get_tracer().span("stage.move", x=coord.x, y=coord.y):
+            moved, response = self._move_to(coord)
+            timeout = self.move_timeout if timeout is None else timeout
+            try:
+                moved.result(timeout)
+            except FutureTimeoutError as exc:
+                # a silent stage would hold every later command behind the move
+                if self.link is not None:
+                    self.link.abandon(response)
+                moved.cancel()
+                logger.error("Stage did not reach %s in %s s", coord, timeout)
+                raise MicroscopeTimeoutException(coord) from exc
 
     def reset_coordinates(self) -> None:
         """
@@ -258,8 +376,7 @@ class MicroscopeMover:
         if self.last_status != MicroscopeStatus.CONNECTED:
             raise MicroscopeUnavailableException()
         logger.info("Resetting stage position")
-        self.serial.write(b"PS,0,0 \r")  # type: ignore
-        self.serial.read(2)
+        self._command(b"PS,0,0 \r", self.command_timeout)
 
     def set_relative_coordinates(self, coord: Coordinate) -> None:
         """
@@ -272,36 +389,73 @@ class MicroscopeMover:
             raise MicroscopeUnavailableException()
         logger.info("Moving by: %i, %i", coord.x, coord.y)
         string: str = f"GR {coord.x},{coord.y} \r"
-        self.serial.write(string.encode("utf-8"))  # type: ignore
-        self.serial.read_until(b"\r")  # type: ignore
+        self._command(string.encode("utf-8"), self.command_timeout)
 
-    def set_speed(self, speed: int = 40) -> None:
+    def set_velocity(self, velocity: Coordinate) -> None:
+        """
+        Starts moving the stage at a constant velocity until `stop()` is called
+        or a limit is reached
+
+        `velocity`: stage units per second along each axis
+        """
+        if self.last_status != MicroscopeStatus.CONNECTED:
+            raise MicroscopeUnavailableException()
+        rounded_velocity: Coordinate = velocity.rounded()
+        logger.info("Moving at: %i, %i", rounded_velocity.x, rounded_velocity.y)
+        string: str = f"VS,{rounded_velocity.x},{rounded_velocity.y} \r"
+        self._command(string.encode(), self.command_timeout)
+
+    def stop(self) -> None:
+        """
+        Stops any stage movement, decelerating smoothly
+        """
+        if self.last_status != MicroscopeStatus.CONNECTED:
+            raise MicroscopeUnavailableException()
+        logger.info("Stopping stage")
+        self._command(b"I \r", self.command_timeout)
+
+    def set_speed(self, speed: int = 40, blocking: bool = True, force: bool = False) -> None:
         """
         Sets the speed of the stage
 
         `speed`: an integer corresponding to the speed
+        `blocking`: block until the stage confirms, otherwise only queue the command
+        `force`: send the command even if the speed is already set
         """
         if self.last_status != MicroscopeStatus.CONNECTED:
             raise MicroscopeUnavailableException()
+        if speed == self._speed and not force:
+            return
         string: bytes = f"SMS,{speed} \r".encode()
-        self.serial.write(string)  # type: ignore
-        self.serial.read_until(b"\r")  # type: ignore
+        self._speed = speed
+        try:
+            self._send_state(string, blocking)
+        except Exception:
+            self._speed = None
+            raise
 
         logger.info("Set speed to %i%%", speed)
 
-    def set_output_directory(self, directory: str) -> None:
+    def set_output_directory(self, directory: str, blocking: bool = True, force: bool = False) -> None:
         """
         Sends information to SOLIS script where to save future captures
 
         `directory`: Absolute path to where future saving should accur
+        `blocking`: block until SOLIS confirms, otherwise only queue the command
+        `force`: send the command even if the directory is already set
         """
         if self.last_status != MicroscopeStatus.CONNECTED:
             raise MicroscopeUnavailableException()
+        if directory == self._output_directory and not force:
+            return
         logger.info("Changing SOLIS output directory")
         # Change the target directory
-        self.serial.write(f"SDIR {directory}\r".encode("utf-8"))  # type: ignore
-        # block until received response
-        self.serial.read_until(b"\r")  # type: ignore
+        self._output_directory = directory
+        try:
+            self._send_state(f"SDIR {directory}\r".encode("utf-8"), blocking)
+        except Exception:
+            self._output_directory = None
+            raise
 
     def take_capture(self, filename: str) -> None:
         """
@@ -315,14 +469,74 @@ class MicroscopeMover:
         if self.last_status != MicroscopeStatus.CONNECTED:
             raise MicroscopeUnavailableException()
         logger.info("Capturing and saving in %s", filename)
-        self.serial.write(f"RUN {filename}\r".encode("utf-8"))  # type: ignore
-        self.serial.read_until(b"\r")  # type: ignore
+        with get_tracer().span("solis.capture", file=filename):
+            self._command(f"RUN {filename}\r".encode("utf-8"), self.capture_timeout)
+
+    def capture_batch(
+        self, points: "list[tuple[Coordinate, str]]",
+        on_point: "Callable[[str, bytes | None], None] | None" = None,
+        timeout: float | None = None
+    ) -> "dict[str, bytes | None]":
+        """
+        Sends a list of points to SOLIS script, which moves to, captures and saves
+        each of them without further round trips
+
+        NOTE: Files are saved in a directory set by `set_output_directory()`
+
+        `points`: coordinates and the filename of each capture, in capture order
+        `on_point`: called on the serial reader thread as soon as a point is done,
+        with its filename and None, or the stage response if the stage could not move there
+        `timeout`: Seconds to wait for the whole batch, `capture_timeout` by default
+
+        Returns the outcome of every point, as passed to `on_point`
+        """
+        if self.last_status != MicroscopeStatus.CONNECTED:
+            raise MicroscopeUnavailableException()
+        if not points:
+            return {}
+        lines: list[str] = [f"BATCH {len(points)}\r"]
+        for coord, filename in points:
+            if "\r" in filename or "\n" in filename or not filename:
+                raise ValueError(f"Invalid capture filename {filename!r}")
+            rounded_coord: Coordinate = coord.rounded()
+            lines.append(f"{rounded_coord.x},{rounded_coord.y},{filename}\r")
+        results: dict[str, bytes | None] = {}
+
+        def _batch_finished(line: bytes) -> bool:
+            status, _, rest = line.partition(b" ")
+            if status not in (BATCH_DONE, BATCH_ERROR):
+                return True
+            filename: str = rest.decode("utf-8")
+            error: bytes | None = None
+            if status == BATCH_ERROR:
+                name, _, error = rest.rpartition(b" ")
+                filename = name.decode("utf-8")
+                logger.error("Batch point %s failed: %s", filename, error)
+            results[filename] = error
+            if on_point is not None:
+                try:
+                    on_point(filename, error)
+                except Exception as exc:  # pylint: disable = broad-exception-caught
+                    logger.error("Batch point callback failed: %s", exc)
+            return False
+
+        logger.info("Capturing a batch of %i points", len(points))
+        timeout = self.capture_timeout if timeout is None else timeout
+        with get_tracer().span("solis.batch", points=len(points)):
+            self._result(
+                self._request("".join(lines).encode("utf-8"), _batch_finished), timeout, b"BATCH")
+        return results
 
     @staticmethod
     def _close_connection(micro_m: "MicroscopeMover") -> None:
         """
         Closes the connection to the serial port
         """
+        if micro_m.link is not None:
+            micro_m.link.stop()
+            micro_m.link = None
+        micro_m._speed = None
+        micro_m._output_directory = None
         micro_m.serial.close()
         logger.info("Connection terminated")
 
@@ -340,11 +554,14 @@ class MicroscopeMover:
         """
         if self.last_status != MicroscopeStatus.CONNECTED:
             raise MicroscopeUnavailableException()
+        # the command may change any state
+        self._speed = None
+        self._output_directory = None
         # send command
-        self.serial.write(cmd + b"\r")  # type: ignore
+        response: Future[list[bytes]] = self._request(cmd + b"\r")
 
         # custom commands should not be used, this is logged as an error
         logger.warning('Sent custom command: "%s"', cmd)
 
         # block until respnse received
-        return self.serial.read_until(b"\r")  # type: ignore
+        return self._result(response, None, cmd)[-1] + b"\r"
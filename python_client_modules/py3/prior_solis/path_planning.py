@@ -0,0 +1,353 @@
+"""Contains path planning, ordering pointsets to minimize stage travel.
+
+The server measures points in `pointNumber` order, so a pointset is planned
+before it is uploaded: `plan_path` returns the points in visiting order,
+which become point numbers 1..N, together with the original point number of
+every visited point, so measurements can be labelled as before.
+
+Routes are either
+- a serpentine (boustrophedon) over the rows of a grid, or
+- a nearest neighbour tour improved with 2-opt and Or-opt moves
+for hand drawn and sparse pointsets.
+
+Costs are stage travel times from `StageMotion` when it is given, straight line
+distances otherwise.
+"""
+from __future__ import annotations
+from typing import Callable, Literal
+
+import csv
+import time
+from logging import Logger, getLogger
+
+import numpy as np
+import numpy.typing as npt
+
+from .coordinate import Coordinate, CoordinateArray
+
+logger_instance: Logger = getLogger(__name__)
+
+DEFAULT_SPEED: float = 25000
+"""Stage speed in stage units per second, a placeholder to be measured on the stage in use"""
+DEFAULT_ACCELERATION: float = 250000
+"""Stage acceleration in stage units per second squared, a placeholder as `DEFAULT_SPEED`"""
+OR_OPT_SEGMENTS: tuple[int, ...] = (1, 2, 3)
+"""Lengths of the segments relocated by Or-opt"""
+_IMPROVEMENT_EPSILON: float = 1e-9
+
+_Cost = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+
+class StageMotion:
+    """Travel time model of the stage.
+
+    Both axes move at once, each along a trapezoidal velocity profile
+    (or a triangular one for moves too short to reach `speed`),
+    so a move takes as long as its slower axis, plus `settle` seconds.
+    """
+
+    def __init__(
+        self, speed: float = DEFAULT_SPEED, acceleration: float = DEFAULT_ACCELERATION,
+        settle: float = 0.0
+        ) -> None:
+        if speed <= 0 or acceleration <= 0:
+            raise ValueError("Speed and acceleration must be positive")
+        self.speed: float = speed
+        self.acceleration: float = acceleration
+        self.settle: float = settle
+
+    def axis_time(self, distance: npt.ArrayLike) -> np.ndarray:
+        """Returns the time needed to move each axis by `distance`"""
+        dist: np.ndarray = np.abs(np.asarray(distance, dtype=np.float64))
+        # distance covered while accelerating to full speed and braking again
+        ramp: float = self.speed ** 2 / self.acceleration
+        return np.where(
+            dist < ramp,
+            2 * np.sqrt(dist / self.acceleration),
+            dist / self.speed + self.speed / self.acceleration,
+        )
+
+    def move_time(self, start: npt.ArrayLike, end: npt.ArrayLike) -> np.ndarray:
+        """Returns the times of the moves from `start` to `end`, both of shape (N,2)"""
+        delta: np.ndarray = np.asarray(end, dtype=np.float64) - np.asarray(start, dtype=np.float64)
+        times: np.ndarray = self.axis_time(delta).max(axis=-1)
+        return np.where(times > 0, times + self.settle, 0.0)
+
+
+class PlannedPath:
+    """A pointset in visiting order.
+
+    `order[i]` is the index, in the planned pointset, of the i-th visited point
+    and `point_numbers[i]` its original point number.
+    `cost` and `original_cost` are the travel times (or distances) of the planned
+    and the original order.
+    """
+
+    def __init__(
+        self, points: CoordinateArray, order: np.ndarray, point_numbers: np.ndarray,
+        cost: float, original_cost: float
+        ) -> None:
+        self.points: CoordinateArray = points
+        self.order: np.ndarray = order
+        self.point_numbers: np.ndarray = point_numbers
+        self.cost: float = cost
+        self.original_cost: float = original_cost
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    @property
+    def improvement(self) -> float:
+        """Fraction of the original travel saved, 0 when nothing was saved"""
+        if self.original_cost <= 0:
+            return 0.0
+        return 1 - self.cost / self.original_cost
+
+    def original_number(self, new_number: int) -> int:
+        """Returns the original point number of the 1-based `new_number`"""
+        return int(self.point_numbers[new_number - 1])
+
+    def renumbering(self) -> dict[int, int]:
+        """Maps the new 1-based point numbers to the original ones"""
+        return {i + 1: int(number) for i, number in enumerate(self.point_numbers)}
+
+    def save_mapping(self, path: str) -> None:
+        """Saves `new_number,original_number` rows to a CSV file"""
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerows(self.renumbering().items())
+        logger_instance.info("Saved point number mapping of %i points at %s", len(self), path)
+
+
+def _cost_function(points: np.ndarray, motion: StageMotion | None) -> _Cost:
+    """Returns the cost of the edges between two index arrays.
+    The index `len(points)` is a free virtual endpoint of open paths."""
+    end: int = len(points)
+
+    def cost(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        first, second = np.broadcast_arrays(first, second)
+        result: np.ndarray = np.zeros(first.shape, dtype=np.float64)
+        real: np.ndarray = (first != end) & (second != end)
+        start_pts: np.ndarray = points[first[real]]
+        end_pts: np.ndarray = points[second[real]]
+        if motion is None:
+            result[real] = np.hypot(*(end_pts - start_pts).T)
+        else:
+            result[real] = motion.move_time(start_pts, end_pts)
+        return result
+    return cost
+
+
+def path_cost(
+    points: CoordinateArray | npt.ArrayLike, start: Coordinate | None = None,
+    motion: StageMotion | None = None
+    ) -> float:
+    """Returns the travel time (or distance without `motion`) of visiting `points` in order,
+    starting at `start` if it is given"""
+    array: np.ndarray = _as_array(points)
+    if start is not None:
+        array = np.vstack([[start.x, start.y], array])
+    indices: np.ndarray = np.arange(len(array))
+    return float(_cost_function(array, motion)(indices[:-1], indices[1:]).sum())
+
+
+def _as_array(points: CoordinateArray | npt.ArrayLike) -> np.ndarray:
+    array: np.ndarray = points.array if isinstance(points, CoordinateArray) else np.asarray(points)
+    if array.ndim != 2 or array.shape[1] < 2:
+        raise ValueError(f"Points must have shape (N,2), got {array.shape}")
+    return np.asarray(array[:, :2], dtype=np.float64)
+
+
+def serpentine_order(points: CoordinateArray | npt.ArrayLike, tolerance: float | None = None) -> np.ndarray:
+    """Orders points row by row (by y), alternating the x direction of every other row.
+
+    Points whose y differ by no more than `tolerance` share a row,
+    by default half of the smallest spacing between distinct rows.
+    """
+    array: np.ndarray = _as_array(points)
+    if len(array) == 0:
+        return np.empty(0, dtype=np.intp)
+    by_y: np.ndarray = np.argsort(array[:, 1], kind="stable")
+    y_sorted: np.ndarray = array[by_y, 1]
+    gaps: np.ndarray = np.diff(y_sorted)
+    if tolerance is None:
+        distinct: np.ndarray = gaps[gaps > 0]
+        tolerance = float(distinct.min()) / 2 if len(distinct) else 0.0
+    rows: np.ndarray = np.concatenate([[0], np.cumsum(gaps > tolerance)])
+    # odd rows run backwards
+    x_key: np.ndarray = np.where(rows % 2 == 1, -array[by_y, 0], array[by_y, 0])
+    return by_y[np.lexsort((x_key, rows))]
+
+
+def is_grid(points: CoordinateArray | npt.ArrayLike, tolerance: float = 0.0) -> bool:
+    """Returns whether the points fill every row and column of a regular grid once"""
+    array: np.ndarray = _as_array(points)
+    if len(array) < 4:
+        return False
+    cells: int = 1
+    for axis in (0, 1):
+        values: np.ndarray = np.unique(array[:, axis])
+        if len(values) < 2:
+            return False
+        cells *= len(values)
+        steps: np.ndarray = np.diff(values)
+        if np.ptp(steps) > max(tolerance, 1e-9 * float(np.abs(values).max() + 1)):
+            return False
+    # a grid with points missing is better served by a tour
+    return cells == len(array) and len(np.unique(array, axis=0)) == len(array)
+
+
+def _nearest_neighbour(count: int, cost: _Cost, first: int) -> list[int]:
+    """Greedily visits the cheapest unvisited point next, starting at `first`,
+    or at the first point if `first` is the virtual endpoint `count`"""
+    unvisited: np.ndarray = np.ones(count, dtype=bool)
+    route: list[int] = []
+    current: int = first
+    if current < count:
+        unvisited[current] = False
+        route.append(current)
+    candidates: np.ndarray = np.arange(count)
+    for _ in range(count - len(route)):
+        remaining: np.ndarray = candidates[unvisited]
+        if current == count:
+            # no start position, begin with the first point
+            nearest: int = int(remaining[0])
+        else:
+            nearest = int(remaining[np.argmin(cost(np.full(len(remaining), current), remaining))])
+        unvisited[nearest] = False
+        route.append(nearest)
+        current = nearest
+    return route
+
+
+def _two_opt(tour: np.ndarray, cost: _Cost, deadline: float) -> bool:
+    """Reverses the best improving section for every edge, returns whether anything improved.
+    The first and last entries of `tour` stay in place."""
+    improved: bool = False
+    for i in range(len(tour) - 3):
+        if time.monotonic() > deadline:
+            break
+        a: np.ndarray = tour[i:i+1]
+        b: np.ndarray = tour[i+1:i+2]
+        c: np.ndarray = tour[i+2:-1]
+        d: np.ndarray = tour[i+3:]
+        delta: np.ndarray = cost(a, c) + cost(b, d) - cost(a, b) - cost(c, d)
+        best: int = int(np.argmin(delta))
+        if delta[best] < -_IMPROVEMENT_EPSILON:
+            j: int = i + 2 + best
+            tour[i+1:j+1] = tour[i+1:j+1][::-1].copy()
+            improved = True
+    return improved
+
+
+def _or_opt(tour: np.ndarray, cost: _Cost, deadline: float) -> bool:
+    """Moves short segments, possibly reversed, to their cheapest place in the tour.
+    Returns whether anything improved. The first and last entries of `tour` stay in place."""
+    improved: bool = False
+    for length in OR_OPT_SEGMENTS:
+        i: int = 1
+        while i + length < len(tour):
+            if time.monotonic() > deadline:
+                return improved
+            head, tail = tour[i], tour[i+length-1]
+            prev, after = tour[i-1:i], tour[i+length:i+length+1]
+            removal: float = float((cost(prev, tour[i:i+1]) + cost(tour[i+length-1:i+length], after)
+                                    - cost(prev, after))[0])
+            rest: np.ndarray = np.concatenate([tour[:i], tour[i+length:]])
+            c: np.ndarray = rest[:-1]
+            d: np.ndarray = rest[1:]
+            forward: np.ndarray = cost(c, head) + cost(tail, d) - cost(c, d)
+            backward: np.ndarray = cost(c, tail) + cost(head, d) - cost(c, d)
+            insertion: np.ndarray = np.minimum(forward, backward)
+            best: int = int(np.argmin(insertion))
+            if insertion[best] - removal < -_IMPROVEMENT_EPSILON:
+                segment: np.ndarray = tour[i:i+length]
+                if backward[best] < forward[best]:
+                    segment = segment[::-1]
+                tour[:] = np.concatenate([rest[:best+1], segment, rest[best+1:]])
+                improved = True
+            else:
+                i += 1
+    return improved
+
+
+def tsp_order(
+    points: CoordinateArray | npt.ArrayLike, start: Coordinate | None = None,
+    motion: StageMotion | None = None, time_limit: float | None = 10.0,
+    initial: npt.ArrayLike | None = None
+    ) -> np.ndarray:
+    """Orders points to minimize travel, starting at `start` (or anywhere) and ending anywhere.
+
+    A nearest neighbour tour, or the `initial` order, is improved by 2-opt and Or-opt
+    moves until neither improves it further or `time_limit` seconds have passed.
+    """
+    array: np.ndarray = _as_array(points)
+    count: int = len(array)
+    if count < 3:
+        return np.arange(count)
+    # the start position is index `count`, the free end of the path the last index
+    with_start: np.ndarray = array if start is None else np.vstack([array, [start.x, start.y]])
+    end: int = len(with_start)
+    cost: _Cost = _cost_function(with_start, motion)
+    route: list[int] = (_nearest_neighbour(len(with_start), cost, end if start is None else count)
+                        if initial is None else
+                        ([] if start is None else [count]) + np.asarray(initial).tolist())
+    tour: np.ndarray = np.array(([end] if start is None else []) + route + [end])
+
+    deadline: float = float("inf") if time_limit is None else time.monotonic() + time_limit
+    while time.monotonic() < deadline:
+        improved: bool = _two_opt(tour, cost, deadline)
+        improved = _or_opt(tour, cost, deadline) or improved
+        if not improved:
+            break
+    else:
+        logger_instance.warning("Path planning stopped after the %s s time limit", time_limit)
+    return tour[tour < count]
+
+
+def plan_path(
+    points: CoordinateArray | npt.ArrayLike,
+    point_numbers: npt.ArrayLike | None = None,
+    start: Coordinate | None = None,
+    motion: StageMotion | None = None,
+    method: Literal["auto", "tsp", "serpentine", "none"] = "auto",
+    time_limit: float | None = 10.0,
+    ) -> PlannedPath:
+    """Plans the order in which `points` are visited.
+
+    `point_numbers`: the original point numbers, 1..N by default
+    `start`: the stage position the path starts from, if known
+    `motion`: the travel time model, straight line distance is minimized without it
+    `method`: `serpentine` for grids, `tsp` for any pointset, `auto` improves the
+    serpentine route of a full grid like a tour and plans a tour for any other pointset.
+    The given order is kept if the planned route is not cheaper
+    """
+    array: np.ndarray = _as_array(points)
+    numbers: np.ndarray = (np.arange(1, len(array) + 1) if point_numbers is None
+                           else np.asarray(point_numbers))
+    if len(numbers) != len(array):
+        raise ValueError(f"Got {len(numbers)} point numbers for {len(array)} points")
+
+    def route_cost(order: np.ndarray) -> float:
+        return path_cost(array[order], start, motion)
+
+    original: np.ndarray = np.arange(len(array))
+    order: np.ndarray = original
+    if method == "serpentine":
+        order = serpentine_order(array)
+    elif method == "auto" and is_grid(array):
+        # the serpentine is a good start, but not the cheapest route from every
+        # start position or with axes of different speeds
+        order = tsp_order(array, start, motion, time_limit, initial=serpentine_order(array))
+    elif method in ("tsp", "auto"):
+        order = tsp_order(array, start, motion, time_limit)
+    elif method != "none":
+        raise ValueError(f"Unknown path planning method {method}")
+    # never return a route worse than the one given
+    if route_cost(order) > route_cost(original):
+        order = original
+    planned: PlannedPath = PlannedPath(
+        CoordinateArray(array[order]), order, numbers[order], route_cost(order), route_cost(original)
+    )
+    logger_instance.info("Planned path of %i points, %.1f%% shorter", len(planned), 100 * planned.improvement)
+    return planned
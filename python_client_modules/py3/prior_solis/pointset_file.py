@@ -0,0 +1,165 @@
+"""Contains the binary pointset file format and streaming CSV import/export.
+
+A binary pointset file is a fixed 32 byte little-endian header followed by the
+packed points, row by row:
+
+| offset | type    | content                           |
+|--------|---------|-----------------------------------|
+| 0      | 8 bytes | magic `STSPTS\\0\\0`              |
+| 8      | uint16  | format version (1)                |
+| 10     | uint8   | value type, 1: int32, 2: float64  |
+| 11     | uint8   | columns per point, 2 (x,y) or 3 (x,y,z) |
+| 12     | uint32  | reserved, 0                       |
+| 16     | uint64  | number of points                  |
+| 24     | uint64  | offset of the first point (32)    |
+
+Files are opened with `numpy.memmap`, so slicing or random access
+only reads the pages that are touched.
+`read_all_points_from_file` and `save_all_points_to_file` in `coordinate.py`
+remain the CSV compatibility path.
+"""
+from __future__ import annotations
+from typing import Iterable, Iterator
+
+import csv
+import struct
+from logging import Logger, getLogger
+
+import numpy as np
+import numpy.typing as npt
+
+from .coordinate import CoordinateArray
+
+logger_instance: Logger = getLogger(__name__)
+
+MAGIC: bytes = b"STSPTS\0\0"
+VERSION: int = 1
+HEADER: struct.Struct = struct.Struct("<8sHBBIQQ")
+DTYPES: dict[int, np.dtype] = {1: np.dtype("<i4"), 2: np.dtype("<f8")}
+DEFAULT_CHUNK_SIZE: int = 65536
+"""Points per chunk when streaming CSV files"""
+
+
+class PointsetFileException(Exception):
+    """Raised when a file is not a valid pointset file"""
+
+
+def _dtype_code(dtype: npt.DTypeLike) -> int:
+    for code, known in DTYPES.items():
+        if np.dtype(dtype) == known:
+            return code
+    raise ValueError(f"Unsupported pointset value type {dtype}, use int32 or float64")
+
+
+def save_points_binary(
+    points: CoordinateArray | npt.ArrayLike, path: str, dtype: npt.DTypeLike = "<i4"
+    ) -> None:
+    """Saves points ((N,2) or (N,3)) to `path` in the binary pointset format"""
+    array: np.ndarray = points.array if isinstance(points, CoordinateArray) else np.asarray(points)
+    if array.ndim != 2 or array.shape[1] not in (2, 3):
+        raise ValueError(f"Points must have shape (N,2) or (N,3), got {array.shape}")
+    code: int = _dtype_code(dtype)
+    if DTYPES[code].kind == "i":
+        array = np.round(array)
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, code, array.shape[1], 0, len(array), HEADER.size))
+        file.write(np.ascontiguousarray(array, dtype=DTYPES[code]).tobytes())
+    logger_instance.info("Successfully saved %i points at %s", len(array), path)
+
+
+def read_header(path: str) -> tuple[np.dtype, int, int, int]:
+    """Reads the header of a binary pointset file.
+    Returns the value type, columns per point, number of points and data offset"""
+    with open(path, "rb") as file:
+        raw: bytes = file.read(HEADER.size)
+    if len(raw) < HEADER.size:
+        raise PointsetFileException(f"{path} is too short to be a pointset file")
+    magic, version, code, columns, _, count, offset = HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise PointsetFileException(f"{path} is not a pointset file")
+    if version != VERSION or code not in DTYPES or columns not in (2, 3):
+        raise PointsetFileException(
+            f"{path} has an unsupported version {version}, type {code} or {columns} columns")
+    return DTYPES[code], columns, count, offset
+
+
+def load_points_binary(path: str, mode: str = "r") -> np.ndarray:
+    """Memory maps a binary pointset file as an (N,2) or (N,3) array without parsing it.
+    Use `mode="r+"` to edit the points in place."""
+    dtype, columns, count, offset = read_header(path)
+    if count == 0:
+        return np.empty((0, columns), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(count, columns))
+
+
+def iter_points_from_csv(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[CoordinateArray]:
+    """Reads a CSV file of `x,y` integer rows in chunks of up to `chunk_size` points.
+    Raises ValueError on rows that are not two integers"""
+    with open(path, "r", encoding="utf-8") as file:
+        rows: list[list[str]] = []
+        first_line: int = 1
+        for i, row in enumerate(csv.reader(file, delimiter=",")):
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield _parse_rows(rows, first_line)
+                rows = []
+                first_line = i + 2
+        if rows:
+            yield _parse_rows(rows, first_line)
+
+
+def _parse_rows(rows: list[list[str]], first_line: int) -> CoordinateArray:
+    try:
+        array: np.ndarray = np.array(rows, dtype=np.int64)
+        # rows of equal but wrong length make a valid array of the wrong shape
+        if array.ndim == 2 and array.shape[1] == 2:
+            return CoordinateArray(array)
+    except ValueError:
+        pass
+    # find the offending row to report it like read_all_points_from_file
+    for i, row in enumerate(rows):
+        if len(row) != 2:
+            logger_instance.error("Wrong file, %i columns at line %i", len(row), first_line+i)
+            raise ValueError(f"Expected 2 columns at line {first_line+i}, got {len(row)}")
+        try:
+            int(row[0])
+            int(row[1])
+        except ValueError as err:
+            logger_instance.error("Could not convert line %i to Integer", first_line+i)
+            raise ValueError(f"Could not convert line {first_line+i}: {row}") from err
+    raise ValueError(f"Could not read the points of lines {first_line} to {first_line+len(rows)-1}")
+
+
+def write_points_to_csv(chunks: Iterable[CoordinateArray | npt.ArrayLike], path: str) -> None:
+    """Writes chunks of points to `path` as a CSV file, one chunk at a time"""
+    count: int = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        for chunk in chunks:
+            array: np.ndarray = chunk.array if isinstance(chunk, CoordinateArray) else np.asarray(chunk)
+            integral: bool = array.dtype.kind in "iu" or bool(np.all(np.mod(array, 1) == 0))
+            np.savetxt(file, array, fmt="%d" if integral else "%.17g", delimiter=",")
+            count += len(array)
+    logger_instance.info("Successfully saved %i points at %s", count, path)
+
+
+def convert_csv_to_binary(
+    csv_path: str, binary_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> int:
+    """Streams a CSV pointset into the binary format, returns the number of points"""
+    count: int = 0
+    with open(binary_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, 1, 2, 0, 0, HEADER.size))
+        for chunk in iter_points_from_csv(csv_path, chunk_size):
+            file.write(np.ascontiguousarray(chunk.array, dtype=DTYPES[1]).tobytes())
+            count += len(chunk)
+        # the point count is only known at the end
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, 1, 2, 0, count, HEADER.size))
+    return count
+
+
+def iter_points_from_binary(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[CoordinateArray]:
+    """Reads the x,y columns of a binary pointset file in chunks of up to `chunk_size` points"""
+    points: np.ndarray = load_points_binary(path)
+    for start in range(0, len(points), chunk_size):
+        yield CoordinateArray(points[start:start+chunk_size, :2])
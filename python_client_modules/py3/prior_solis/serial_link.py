@@ -0,0 +1,222 @@
+"""Contains SerialLink, an event driven command/response layer over the SOLIS serial port"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from logging import Logger, getLogger
+from typing import Callable
+import serial  # type: ignore
+
+logger: Logger = getLogger(__name__)
+
+READ_INTERVAL: float = 0.05
+"""Seconds a read may block before the reader thread checks for shutdown and new commands.
+Reads return as soon as data arrives, this does not delay responses."""
+MAX_IN_FLIGHT: int = 4
+"""Most pipelined commands written before the first of them is answered"""
+RESYNC_TIME: float = 0.5
+"""Seconds the port has to stay quiet after a request is abandoned before the next command
+is written, late responses arriving before then are discarded"""
+
+
+def any_line(_: bytes) -> bool:
+    """Response predicate of commands answered with a single line"""
+    return True
+
+
+class SerialRequest:
+    """A command sent over a SerialLink and the response lines collected for it.
+
+    `is_final` is called with every response line (without the `\\r`),
+    the request is complete once it returns True.
+    `future` resolves with all collected lines.
+    A `pipelined` request may be written while other pipelined requests
+    are still waiting for their responses.
+    """
+
+    def __init__(self, command: bytes, is_final: Callable[[bytes], bool] = any_line,
+                 pipelined: bool = False) -> None:
+        self.command: bytes = command
+        self.is_final: Callable[[bytes], bool] = is_final
+        self.pipelined: bool = pipelined
+        self.lines: list[bytes] = []
+        self.future: Future[list[bytes]] = Future()
+
+
+class SerialLink:
+    """Owns a serial port: writes queued commands and matches response lines to them
+    on a background reader thread.
+
+    Commands are written one at a time, the next one as soon as the previous one is
+    answered, so futures resolve the instant their final line arrives.
+    Pipelined commands are the exception: up to `max_in_flight` of them are written
+    back to back, as SOLIS answers commands strictly in order. Commands that are not
+    pipelined (moves, captures) act as barriers and are written on their own.
+    A future that is cancelled by its caller stays queued until its response arrives,
+    so the response is not mistaken for the answer to a later command. A request that
+    timed out is given up with `abandon()` instead, which resynchronises the link.
+    A response predicate that raises fails its request, not the reader thread.
+    """
+
+    def __init__(self, port: serial.Serial, max_in_flight: int = MAX_IN_FLIGHT) -> None:
+        self.port: serial.Serial = port
+        self.max_in_flight: int = max_in_flight
+        self._lock: threading.Lock = threading.Lock()
+        self._waiting: deque[SerialRequest] = deque()
+        self._sent: deque[SerialRequest] = deque()
+        self._buffer: bytes = b""
+        # set while late responses of abandoned requests are discarded
+        self._resync: bool = False
+        self._resync_end: float = 0.0
+        self._alive: bool = False
+        self._thread: threading.Thread = threading.Thread(
+            target=self._reader_func, name="SerialLink", daemon=True
+        )
+        self._previous_timeout: float | None = None
+
+    def start(self) -> None:
+        """Starts the reader thread"""
+        self._previous_timeout = self.port.timeout  # type: ignore
+        self.port.timeout = READ_INTERVAL
+        self._alive = True
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the reader thread, failing all unanswered requests"""
+        self._alive = False
+        if self._thread.is_alive():
+            self._thread.join()
+        self._fail_pending(serial.SerialException("Serial link stopped"))
+        if self.port.is_open:
+            self.port.timeout = self._previous_timeout
+
+    def _fail_pending(self, exc: Exception) -> None:
+        """Fails all queued and unanswered requests with `exc`"""
+        with self._lock:
+            pending: list[SerialRequest] = [*self._sent, *self._waiting]
+            self._sent.clear()
+            self._waiting.clear()
+        for request in pending:
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_exception(exc)
+
+    @property
+    def alive(self) -> bool:
+        """Whether the reader thread is running"""
+        return self._alive
+
+    def request(self, command: bytes, is_final: Callable[[bytes], bool] = any_line,
+                pipelined: bool = False) -> "Future[list[bytes]]":
+        """Queues `command` (including its `\\r`), returning a future of its response lines"""
+        request: SerialRequest = SerialRequest(command, is_final, pipelined)
+        with self._lock:
+            self._waiting.append(request)
+            self._write_next()
+        return request.future
+
+    def _can_write(self) -> bool:
+        """Whether the next queued command may be written now. Requires `_lock`"""
+        if not self._waiting or self._resync:
+            return False
+        if not self._sent:
+            return True
+        return (self._waiting[0].pipelined and len(self._sent) < self.max_in_flight
+                and all(request.pipelined for request in self._sent))
+
+    def _write_next(self) -> None:
+        """Writes queued commands for as long as pipelining allows. Requires `_lock`"""
+        while self._can_write():
+            request: SerialRequest = self._waiting.popleft()
+            self._sent.append(request)
+            self.port.write(request.command)  # type: ignore
+
+    def _reader_func(self) -> None:
+        while self._alive:
+            try:
+                data: bytes = self.port.read(max(self.port.in_waiting, 1))  # type: ignore
+            except (serial.SerialException, OSError) as exc:
+                logger.error("Serial link read failed: %s", exc)
+                self._alive = False
+                self._fail_pending(exc)
+                return
+            if self._resync:
+                if data:
+                    self._resync_end = time.monotonic() + RESYNC_TIME
+                elif time.monotonic() >= self._resync_end:
+                    # the port is quiet, late responses have all been discarded
+                    with self._lock:
+                        self._resync = False
+                        self._buffer = b""
+                        self._write_next()
+                continue
+            if not data:
+                continue
+            self._buffer += data
+            while b"\r" in self._buffer:
+                line, self._buffer = self._buffer.split(b"\r", 1)
+                self._handle_line(line)
+
+    def _handle_line(self, line: bytes) -> None:
+        with self._lock:
+            if not self._sent:
+                logger.warning("Unexpected serial response: %s", line)
+                return
+            request: SerialRequest = self._sent[0]
+            request.lines.append(line)
+            error: Exception | None = None
+            try:
+                if not request.is_final(line):
+                    return
+            except Exception as exc:  # pylint: disable = broad-exception-caught
+                error = exc
+            self._sent.popleft()
+            self._write_next()
+        # cancelled futures refuse the result, their response is simply consumed
+        if request.future.set_running_or_notify_cancel():
+            if error is None:
+                request.future.set_result(request.lines)
+            else:
+                logger.error("Response of %s could not be checked: %s", request.command.strip(), error)
+                request.future.set_exception(error)
+
+    def abandon(self, future: "Future[list[bytes]]") -> None:
+        """Gives up on the request of `future`, whose caller timed out waiting for it.
+
+        A request not yet written is dropped. A written one would block the link until
+        its response arrives, so it is dropped with the requests written after it, which
+        fail with a `TimeoutError`. Input is then discarded until the port is quiet for
+        `RESYNC_TIME`, so a late response is not taken for the answer to a later command.
+        """
+        dropped: list[SerialRequest] = []
+        with self._lock:
+            for request in self._waiting:
+                if request.future is future:
+                    self._waiting.remove(request)
+                    break
+            else:
+                if any(request.future is future for request in self._sent):
+                    dropped = list(self._sent)
+                    self._sent.clear()
+                    self._resync_end = time.monotonic() + RESYNC_TIME
+                    self._resync = True
+        future.cancel()
+        for request in dropped:
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_exception(
+                    FutureTimeoutError(f"Abandoned after {request.command.strip()!r} timed out")
+                )
+
+
+def wait(future: "Future[list[bytes]]", timeout: float | None,
+         link: SerialLink | None = None) -> list[bytes]:
+    """Waits for a request's response, cancelling the wait on timeout and abandoning
+    the request on `link`, see `SerialLink.abandon()`.
+    Raises `concurrent.futures.TimeoutError` if the response does not arrive in time"""
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        if link is None:
+            future.cancel()
+        else:
+            link.abandon(future)
+        raise
@@ -0,0 +1,336 @@
+"""Contains stand-ins for the serial ports of the PRIOR stage and the SOLIS macro.
+
+`SimulatedStage` answers the PRIOR commands used by this package (P, G, GR, PS,
+SMS, VS, I, K, SERIAL). Moves take as long as the `StageMotion` model of
+its speed and acceleration says.
+
+`SimulatedSolis` answers the commands of `serialHandler.pgm` the way the macro does:
+PING, RUN, SDIR and BATCH are handled by "SOLIS", acquisitions taking
+`acquisition_time` seconds give or take `jitter`, every other line is answered by
+its stage.
+
+Commands are processed one at a time on a background thread, like the macro does,
+and `SimulatedFaults` can make them fail. Use a simulator in place of a serial port:
+
+    simulator = SimulatedSolis(acquisition_time=0.1)
+    MicroscopeMover.serial_factory = simulator.open
+"""
+from __future__ import annotations
+from typing import Any
+
+import abc
+import os
+import queue
+import random
+import threading
+import time
+from enum import Enum
+
+import numpy as np
+import numpy.typing as npt
+import serial  # type: ignore
+
+from .path_planning import StageMotion
+
+STAGE_ERROR: str = "E,1"
+"""Response of the simulated stage to commands it does not know"""
+MOVE_ERROR: str = "E,5"
+"""Response of the simulated stage to a move that failed"""
+SPECTRUM_RANGE: tuple[float, float] = (500.0, 900.0)
+"""Wavelength range of simulated spectra, in nm"""
+
+
+class Fault(Enum):
+    """Enum of faults a simulated device can be made to show"""
+
+    DROP_RESPONSE = 1
+    """The command is read but never answered"""
+    STAGE_ERROR = 2
+    """A move is answered with an error instead of `R`"""
+    DISCONNECT = 3
+    """The port disappears, as if the cable was pulled"""
+
+
+class SimulatedFaults:
+    """Decides which commands of a simulated device fail.
+
+    `rates` maps faults to the probability of any command showing them,
+    `inject()` makes the next commands fail deterministically.
+    """
+
+    def __init__(self, rates: dict[Fault, float] | None = None, seed: int | None = None) -> None:
+        self.rates: dict[Fault, float] = {} if rates is None else rates
+        self._injected: list[Fault] = []
+        self._lock: threading.Lock = threading.Lock()
+        self._random: random.Random = random.Random(seed)
+
+    def inject(self, fault: Fault, count: int = 1) -> None:
+        """Makes the next `count` commands show `fault`"""
+        with self._lock:
+            self._injected.extend([fault] * count)
+
+    def draw(self) -> Fault | None:
+        """Returns the fault of the next command, if any"""
+        with self._lock:
+            if self._injected:
+                return self._injected.pop(0)
+            for fault, rate in self.rates.items():
+                if self._random.random() < rate:
+                    return fault
+            return None
+
+
+class SimulatedPort(abc.ABC):
+    """A simulated `serial.Serial`, answering command lines on a background thread.
+
+    Every received line is recorded in `commands`. Subclasses answer the lines in `_handle`.
+    """
+
+    def __init__(self, faults: SimulatedFaults | None = None) -> None:
+        self.port: str | None = None
+        self.timeout: float | None = None
+        self.write_timeout: float | None = None
+        self.is_open: bool = False
+        self.faults: SimulatedFaults = SimulatedFaults() if faults is None else faults
+        self.commands: list[str] = []
+        self._input: bytes = b""
+        self._output: bytearray = bytearray()
+        self._condition: threading.Condition = threading.Condition()
+        self._lines: queue.Queue[str | None] = queue.Queue()
+        self._worker: threading.Thread | None = None
+
+    def open(self, port: str | None = None, **_: Any) -> SimulatedPort:
+        """Opens the simulated port, returning it.
+        Accepts the arguments of `serial.Serial` to stand in for it"""
+        self.port = port
+        self.is_open = True
+        if self._worker is None or not self._worker.is_alive():
+            self._lines = queue.Queue()
+            self._worker = threading.Thread(target=self._run, name=f"Simulated-{port}", daemon=True)
+            self._worker.start()
+        return self
+
+    def close(self) -> None:
+        """Closes the simulated port"""
+        with self._condition:
+            self.is_open = False
+            self._condition.notify_all()
+        self._lines.put(None)
+
+    def _check_open(self) -> None:
+        if not self.is_open:
+            raise serial.SerialException(f"Simulated port {self.port} is not open")
+
+    @property
+    def in_waiting(self) -> int:
+        """Number of response bytes ready to be read"""
+        self._check_open()
+        with self._condition:
+            return len(self._output)
+
+    def read(self, size: int = 1) -> bytes:
+        """Reads up to `size` response bytes, waiting up to `timeout` for the first one"""
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._output) > 0 or not self.is_open, self.timeout)
+            self._check_open()
+            data: bytes = bytes(self._output[:size])
+            del self._output[:size]
+            return data
+
+    def write(self, data: bytes) -> int:
+        """Queues the complete command lines in `data`"""
+        self._check_open()
+        self._input += data
+        while b"\r" in self._input:
+            line, self._input = self._input.split(b"\r", 1)
+            self._lines.put(line.decode("utf-8"))
+        return len(data)
+
+    def reset_input_buffer(self) -> None:
+        """Drops all unread responses"""
+        with self._condition:
+            self._output.clear()
+
+    def _respond(self, response: str) -> None:
+        with self._condition:
+            self._output += response.encode("utf-8") + b"\r"
+            self._condition.notify_all()
+
+    def _next_line(self) -> str | None:
+        """Returns the next received line, None once the port is closed"""
+        line: str | None = self._lines.get()
+        if line is not None:
+            self.commands.append(line)
+        return line
+
+    def _run(self) -> None:
+        while (line := self._next_line()) is not None:
+            fault: Fault | None = self.faults.draw()
+            if fault == Fault.DISCONNECT:
+                self.close()
+                return
+            if fault == Fault.DROP_RESPONSE:
+                continue
+            self._handle(line, fault)
+
+    @abc.abstractmethod
+    def _handle(self, line: str, fault: Fault | None) -> None:
+        """Answers a command line"""
+
+
+class SimulatedStage(SimulatedPort):
+    """Simulates a PRIOR stage.
+
+    `motion`: the stage at 100% speed (SMS), moves take as long as it says
+    """
+
+    def __init__(
+        self, motion: StageMotion | None = None, serial_number: str = "1000001",
+        faults: SimulatedFaults | None = None
+        ) -> None:
+        super().__init__(faults)
+        self.motion: StageMotion = StageMotion() if motion is None else motion
+        self.serial_number: str = serial_number
+        self.speed: int = 100
+        self._position: np.ndarray = np.zeros(2)
+        self._velocity: np.ndarray = np.zeros(2)
+        self._velocity_since: float = time.monotonic()
+        self._lock: threading.Lock = threading.Lock()
+
+    def _advance(self) -> None:
+        """Moves the stage by its velocity since the last update. Requires `_lock`"""
+        now: float = time.monotonic()
+        self._position = self._position + self._velocity * (now - self._velocity_since)
+        self._velocity_since = now
+
+    @property
+    def position(self) -> tuple[float, float]:
+        """The current stage position"""
+        with self._lock:
+            self._advance()
+            return float(self._position[0]), float(self._position[1])
+
+    def move_time(self, destination: npt.ArrayLike) -> float:
+        """Seconds a move from the current position to `destination` takes"""
+        motion: StageMotion = StageMotion(
+            self.motion.speed * self.speed / 100, self.motion.acceleration, self.motion.settle
+        )
+        return float(motion.move_time([self.position], [destination])[0])
+
+    def _set_velocity(self, x: float, y: float) -> None:
+        with self._lock:
+            self._advance()
+            self._velocity = np.array([x, y], dtype=np.float64)
+
+    def _move(self, destination: npt.ArrayLike, fault: Fault | None) -> str:
+        self._set_velocity(0, 0)
+        if fault == Fault.STAGE_ERROR:
+            return MOVE_ERROR
+        time.sleep(self.move_time(destination))
+        with self._lock:
+            self._position = np.asarray(destination, dtype=np.float64)
+        return "R"
+
+    def command(self, line: str, fault: Fault | None = None) -> str:
+        """Carries out a stage command, returning its response once it is done"""
+        command, *args = line.strip().replace(" ", ",").split(",")
+        try:
+            values: list[float] = [float(arg) for arg in args if arg]
+        except ValueError:
+            return STAGE_ERROR
+        if command == "P":
+            x, y = self.position
+            return f"{round(x)},{round(y)},0"
+        if command == "SERIAL":
+            return self.serial_number
+        if command == "G" and len(values) == 2:
+            return self._move(values, fault)
+        if command == "GR" and len(values) == 2:
+            return self._move(np.add(self.position, values), fault)
+        if command == "PS" and len(values) == 2:
+            with self._lock:
+                self._position = np.array(values)
+            return "0"
+        if command == "SMS":
+            if not values:
+                return str(self.speed)
+            self.speed = min(max(int(values[0]), 1), 100)
+            return "0"
+        if command == "VS" and len(values) == 2:
+            self._set_velocity(*values)
+            return "R"
+        if command in ("I", "K"):
+            self._set_velocity(0, 0)
+            return "R"
+        return STAGE_ERROR
+
+    def _handle(self, line: str, fault: Fault | None) -> None:
+        self._respond(self.command(line, fault))
+
+
+class SimulatedSolis(SimulatedPort):
+    """Simulates the serial port of the SOLIS macro with `stage` behind it.
+
+    Every capture is recorded in `captures`. If `output_directory` is given,
+    captures are written there as ASCII XY spectra
+    (the directory set with SDIR is only recorded).
+    """
+
+    def __init__(
+        self, stage: SimulatedStage | None = None, output_directory: str | None = None,
+        acquisition_time: float = 0.0, jitter: float = 0.0, spectrum_size: int = 1024,
+        faults: SimulatedFaults | None = None, seed: int | None = None
+        ) -> None:
+        super().__init__(faults)
+        self.stage: SimulatedStage = SimulatedStage() if stage is None else stage
+        self.output_directory: str | None = output_directory
+        self.acquisition_time: float = acquisition_time
+        self.jitter: float = jitter
+        self.spectrum_size: int = spectrum_size
+        self.save_directory: str = ""
+        self.captures: list[str] = []
+        self._random: np.random.Generator = np.random.default_rng(seed)
+
+    def _handle(self, line: str, fault: Fault | None) -> None:
+        command, _, args = line.partition(" ")
+        if command == "PING":
+            self._respond("OK")
+        elif command == "RUN":
+            self._capture(args or f"{time.time()}.asc")
+            self._respond("OK")
+        elif command == "SDIR":
+            self.save_directory = args
+            self._respond("OK")
+        elif command == "BATCH":
+            self._batch(int(args), fault)
+            self._respond("OK")
+        else:
+            self._respond(self.stage.command(line, fault))
+
+    def _batch(self, count: int, fault: Fault | None) -> None:
+        for _ in range(count):
+            line: str | None = self._next_line()
+            if line is None:
+                return
+            x, y, filename = line.split(",", 2)
+            response: str = self.stage.command(f"G,{x},{y}", fault)
+            if response == "R":
+                self._capture(filename)
+                self._respond(f"DONE {filename}")
+            else:
+                self._respond(f"ERROR {filename} {response}")
+            fault = self.faults.draw()
+
+    def _capture(self, filename: str) -> None:
+        duration: float = self.acquisition_time
+        if self.jitter:
+            duration = max(0.0, float(self._random.normal(duration, self.jitter)))
+        time.sleep(duration)
+        self.captures.append(self.save_directory + "\\" + filename)
+        if self.output_directory is None:
+            return
+        wavelengths: np.ndarray = np.linspace(*SPECTRUM_RANGE, self.spectrum_size)
+        counts: np.ndarray = (1000 * np.exp(-((wavelengths - 700) / 40) ** 2)
+                              + self._random.normal(100, 5, self.spectrum_size))
+        np.savetxt(os.path.join(self.output_directory, filename),
+                   np.column_stack([wavelengths, counts]), fmt="%.4f", delimiter=",")
@@ -0,0 +1,174 @@
+"""Contains Spectrum, loading SOLIS ASCII XY captures and storing them in a compact binary container.
+
+A spectrum container is a 24 byte little-endian header, JSON metadata and the values:
+
+| offset | type    | content                                        |
+|--------|---------|------------------------------------------------|
+| 0      | 4 bytes | magic `STSS`                                   |
+| 4      | uint16  | format version (1)                             |
+| 6      | uint16  | flags, bit 0: values are zlib compressed       |
+| 8      | uint32  | number of points N                             |
+| 12     | uint16  | number of y columns K                          |
+| 14     | uint16  | reserved, 0                                    |
+| 16     | uint32  | metadata length M                              |
+| 20     | uint32  | length of the (compressed) values              |
+| 24     | M bytes | metadata, UTF-8 JSON object                    |
+| 24+M   |         | float32 x (N), then the K y columns (N each)   |
+
+float32 keeps about 7 significant digits, more than the counts and wavelengths
+written by SaveAsciiXY resolve.
+"""
+from __future__ import annotations
+from typing import Any
+
+import json
+import os
+import re
+import struct
+import zlib
+from logging import Logger, getLogger
+
+import numpy as np
+import numpy.typing as npt
+
+logger_instance: Logger = getLogger(__name__)
+
+MAGIC: bytes = b"STSS"
+VERSION: int = 1
+HEADER: struct.Struct = struct.Struct("<4sHHIHHII")
+FLAG_ZLIB: int = 1
+EXTENSION: str = ".stss"
+"""Extension of spectrum container files"""
+_SEPARATORS: re.Pattern[str] = re.compile(r"[,;\t]")
+
+
+class SpectrumFileException(Exception):
+    """Raised when a file is not a valid spectrum file"""
+
+
+class Spectrum:
+    """A spectrum, `x` of shape (N,) and `y` of shape (N,) or (N,K) for K y columns"""
+
+    def __init__(self, x: npt.ArrayLike, y: npt.ArrayLike, metadata: dict[str, Any] | None = None) -> None:
+        self.x: np.ndarray = np.asarray(x, dtype=np.float32)
+        self.y: np.ndarray = np.asarray(y, dtype=np.float32)
+        if self.x.ndim != 1 or self.y.shape[0] != len(self.x) or self.y.ndim > 2:
+            raise ValueError(f"Spectrum shapes {self.x.shape} and {self.y.shape} do not match")
+        self.metadata: dict[str, Any] = {} if metadata is None else metadata
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    @property
+    def columns(self) -> int:
+        """Number of y columns"""
+        return 1 if self.y.ndim == 1 else self.y.shape[1]
+
+    def to_bytes(self, compress: bool = True) -> bytes:
+        """Returns the spectrum as a container, see the module documentation"""
+        metadata: bytes = json.dumps(self.metadata, separators=(",", ":")).encode("utf-8")
+        values: bytes = (
+            self.x.astype("<f4").tobytes()
+            + np.ascontiguousarray(self.y.reshape(len(self), -1).T, dtype="<f4").tobytes()
+        )
+        flags: int = 0
+        if compress:
+            values = zlib.compress(values)
+            flags |= FLAG_ZLIB
+        header: bytes = HEADER.pack(
+            MAGIC, VERSION, flags, len(self), self.columns, 0, len(metadata), len(values)
+        )
+        return header + metadata + values
+
+    @staticmethod
+    def from_bytes(data: bytes) -> Spectrum:
+        """Reads a spectrum from a container"""
+        if len(data) < HEADER.size:
+            raise SpectrumFileException("Data is too short to be a spectrum")
+        magic, version, flags, count, columns, _, meta_length, values_length = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise SpectrumFileException("Data is not a spectrum")
+        if version != VERSION:
+            raise SpectrumFileException(f"Unsupported spectrum version {version}")
+        start: int = HEADER.size + meta_length
+        if len(data) < start + values_length:
+            raise SpectrumFileException("Spectrum data is truncated")
+        metadata: dict[str, Any] = json.loads(data[HEADER.size:start].decode("utf-8"))
+        values: bytes = data[start:start + values_length]
+        if flags & FLAG_ZLIB:
+            values = zlib.decompress(values)
+        array: np.ndarray = np.frombuffer(values, dtype="<f4")
+        if len(array) != count * (columns + 1):
+            raise SpectrumFileException(f"Expected {count * (columns + 1)} values, got {len(array)}")
+        y: np.ndarray = array[count:].reshape(columns, count).T
+        return Spectrum(array[:count], y[:, 0] if columns == 1 else y, metadata)
+
+    def save(self, path: str, compress: bool = True) -> None:
+        """Saves the spectrum as a container at `path`"""
+        with open(path, "wb") as file:
+            file.write(self.to_bytes(compress))
+
+    @staticmethod
+    def load(path: str) -> Spectrum:
+        """Loads a spectrum container from `path`"""
+        with open(path, "rb") as file:
+            return Spectrum.from_bytes(file.read())
+
+
+def load_asc(path: str) -> Spectrum:
+    """Loads an ASCII XY file as saved by SOLIS, with comma, semicolon, tab or space separated columns.
+
+    The numeric block is parsed in one vectorized pass, lines before and after it
+    (headers, acquisition information) are skipped.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as file:
+        lines: list[str] = file.read().splitlines()
+    first: int | None = next((i for i, line in enumerate(lines) if _is_numeric(line)), None)
+    if first is None:
+        raise SpectrumFileException(f"{path} contains no spectrum")
+    last: int = next(i for i in range(len(lines) - 1, first - 1, -1) if _is_numeric(lines[i]))
+    separator: re.Match[str] | None = _SEPARATORS.search(lines[first])
+    try:
+        table: np.ndarray = np.loadtxt(
+            lines[first:last + 1], delimiter=separator.group() if separator else None,
+            dtype=np.float64, ndmin=2,
+        )
+    except ValueError as exc:
+        raise SpectrumFileException(f"{path} has an irregular spectrum: {exc}") from exc
+    if table.shape[1] < 2:
+        raise SpectrumFileException(f"{path} has a single column")
+    y: np.ndarray = table[:, 1] if table.shape[1] == 2 else table[:, 1:]
+    return Spectrum(table[:, 0], y, {"source": os.path.basename(path)})
+
+
+def _is_numeric(line: str) -> bool:
+    fields: list[str] = _SEPARATORS.sub(" ", line).split()
+    if not fields:
+        return False
+    try:
+        for field in fields:
+            float(field)
+    except ValueError:
+        return False
+    return True
+
+
+def convert_asc(
+    asc_path: str, path: str | None = None, metadata: dict[str, Any] | None = None,
+    compress: bool = True
+    ) -> str:
+    """Converts an ASCII XY file to a spectrum container, returns the container path.
+
+    `path`: where to save the container, `asc_path` with the `.stss` extension by default
+    `metadata`: added to the metadata of the spectrum
+    """
+    spectrum: Spectrum = load_asc(asc_path)
+    if metadata:
+        spectrum.metadata.update(metadata)
+    if path is None:
+        path = os.path.splitext(asc_path)[0] + EXTENSION
+    spectrum.save(path, compress)
+    logger_instance.info(
+        "Converted %s, %i to %i bytes", asc_path, os.path.getsize(asc_path), os.path.getsize(path)
+    )
+    return path
@@ -0,0 +1,363 @@
+"""Contains AsyncSTSClient, an asyncio counterpart of STSClient"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable
+
+try:
+    import aiohttp  # type: ignore
+except ImportError:  # aiohttp is only required for AsyncSTSClient
+    aiohttp = None
+
+from .sts_dispatch import LANES
+from .sts_position import PositionTracker
+from .sts_tracing import get_tracer
+from .sts_upload import UPLOAD_PATH
+from .sts_client import (
+    HEARTBEAT_INTERVAL, LONG_POLL_MARGIN, LONG_POLL_WAIT,
+    POLL_INTERVAL, WS_RETRY_INTERVAL,
+    STSCursor, STSMeasuring, STSPacket, STSCalibration, STSPoint, STSTransport, STSUpdate,
+    _resolve
+)
+
+
+Handler = Callable[[dict[str, Any]], Awaitable[None] | None]
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class AsyncSTSClient(STSMeasuring):
+    """An asyncio client for the IoT network for sequenced measurement.
+
+    Use with `async with` or `await start()`, `await kill()`.
+
+    Offers the handler API of `STSClient`: `on()`, `emit()`, `send_file()`,
+    `onmeasure`, `onmove` and `get_points`. Handlers may be plain functions or
+    `async def` coroutines. A plain function blocks the event loop while it runs,
+    so long acquisitions should be awaitable (or wrapped with `asyncio.to_thread`).
+
+    Messages are handled in lanes: one serial lane per topic, except measurement
+    related topics which share a lane to keep their order. A `measure` that is
+    awaiting therefore does not delay `instrument_ping` or `point_info?` replies.
+
+    Requires the `aiohttp` package.
+    """
+
+    def __init__(
+        self, url: str, sequence_number: int, name: str, priority: bool,
+        is_stage: bool = False, is_2d: bool = False,
+        transport: STSTransport = STSTransport.POLL
+    ) -> None:
+        if aiohttp is None:
+            raise ImportError("AsyncSTSClient requires the aiohttp package")
+        self.url: str = url
+        self.is_stage: bool = is_stage
+        self.is_2d: bool = is_2d
+        self._transport: STSTransport = transport
+        self._sequence_num: int = sequence_number
+        self._name: str = name
+        self._priority: bool = priority
+        self._topics: list[str] = []
+        self._callbacks: dict[str, Handler] = {}
+        self._lanes: dict[str, asyncio.Queue[dict[str, Any] | None]] = {}
+        self._tasks: list[asyncio.Task[None]] = []
+        self._lane_tasks: list[asyncio.Task[None]] = []
+        self._session: Any = None
+        """The held long-polling request, cancelled by `on()` binding a new topic"""
+        self._held: asyncio.Future[Any] | None = None
+        self.cursor: STSCursor = STSCursor()
+        self._event_crash: Exception | None = None
+        self._event_alive: bool = False
+
+        self.on("instrument_ping", self._inform)
+        self.on("measure", self._measure)
+        self.on("calibration", self._set_calibration)
+        self.on("point_info?", self._get_points)
+        self.on("set_local_calibration", self._set_local_calibration)
+        self.on("reference", self._get_ref)
+        self.on("move", self._move)
+
+        """A callback accepting a point number and experiment id (or a reference type
+        and experiment id), that is called when measurement/preparation is ordered.
+        Only return (or resolve) when measurement is finished to ensure proper sequencing.
+        """
+        self.onmeasure: Callable[[int, int], Awaitable[None] | None] = lambda _, __: None
+
+        """A callback accepting a single point, that is called when a move is ordered."""
+        self.onmove: Callable[[STSPoint], Awaitable[None] | None] = lambda _: None
+
+        """Callback requesting that the current point is supplied.
+        Return None if device does not supply point data.
+        """
+        self.get_points: Callable[[], Awaitable[STSPoint | None] | STSPoint | None] = lambda: None
+
+        self.cal_a: STSPoint = STSPoint(0, 0, 0)
+        self.cal_b: STSPoint = STSPoint(0, 0, 0)
+        self.cal_c: STSPoint = STSPoint(0, 0, 0)
+
+        self.current_cal_a: STSPoint = STSPoint(0, 0, 0)
+        self.current_cal_b: STSPoint = STSPoint(0, 0, 0)
+        self.current_cal_c: STSPoint = STSPoint(0, 0, 0)
+        self._calibration: STSCalibration | None = None
+        self.position: PositionTracker = PositionTracker()
+
+        """Callback accepting the number of messages skipped because the server's queue
+        was reset or trimmed, see `STSCursor`."""
+        self.ongap: Callable[[int], None] = lambda _: None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.kill()
+
+    async def start(self) -> None:
+        """Connects to the server and starts acquiring new messages."""
+        self._err_chk()
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=3.05, sock_read=30)
+        )
+        try:
+            async with self._session.get(f"{self.url}/retrieve", params={"Id": "0"}) as resp:
+                resp.raise_for_status()
+                lid: Any = await resp.json()
+        except Exception:
+            await self._session.close()
+            raise
+        if STSPacket.is_valid(lid):
+            self.cursor = STSCursor(STSPacket(lid))
+        self._event_alive = True
+        self._tasks.append(asyncio.create_task(self._receive_loop()))
+        self._tasks.append(asyncio.create_task(self._heartbeat_loop()))
+
+    async def kill(self) -> None:
+        """Stops receiving messages, lets queued handlers finish and closes the session."""
+        self._event_alive = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        # lanes drain their queued messages before stopping
+        for queue in self._lanes.values():
+            queue.put_nowait(None)
+        await asyncio.gather(*self._lane_tasks, return_exceptions=True)
+        self._lanes.clear()
+        self._lane_tasks.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._err_chk()
+
+    def on(self, topic: str | list[str], callback: Handler) -> None:
+        """Binds a callback function or coroutine function to a topic or topics"""
+        self._err_chk()
+        topics: list[str] = [topic] if isinstance(topic, str) else topic
+        if self._held is not None and not set(self._topics).issuperset(topics):
+            # the held request skips the new topics, reissue it with them
+            self._held.cancel()
+        for top in topics:
+            self._topics.append(top)
+            self._callbacks[top] = callback
+
+    async def emit(self, topic: str, body: dict[str, Any]) -> None:
+        """Sends jsonified `body` with `topic` to server"""
+        self._err_chk()
+        async with self._session.post(self.url, json={"topic": topic, "body": body}) as resp:
+            resp.raise_for_status()
+
+    async def send_file(self, path: str, pt_num: int, ex_id: int) -> None:
+        """Sends a file from `path` to the STS server"""
+        self._err_chk()
+        upload_id: str = uuid.uuid4().hex
+        with get_tracer().span("upload", file=os.path.basename(path)), open(path, "rb") as sendable:
+            # aiohttp streams file fields from disk
+            form: Any = aiohttp.FormData()
+            form.add_field("name", self._name)
+            form.add_field("pointNumber", str(pt_num))
+            form.add_field("experimentId", str(ex_id))
+            form.add_field("uploadId", upload_id)
+            form.add_field("file", sendable, filename=os.path.basename(path))
+            async with self._session.post(
+                self.url + UPLOAD_PATH, data=form, headers={"Idempotency-Key": upload_id}
+            ) as resp:
+                resp.raise_for_status()
+
+    def _err_chk(self) -> None:
+        """Checks if a client task has crashed and raises the error if it has"""
+        if self._event_crash:
+            raise self._event_crash
+
+    def _dispatch(self, msg: STSUpdate) -> None:
+        """Queues `msg` on the lane of its topic, creating the lane if needed"""
+        if msg.topic not in self._callbacks:
+            return
+        lane_name: str = LANES.get(msg.topic, msg.topic)
+        queue: asyncio.Queue[dict[str, Any] | None] | None = self._lanes.get(lane_name)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._lanes[lane_name] = queue
+            self._lane_tasks.append(asyncio.create_task(self._lane(queue)))
+        queue.put_nowait({"topic": msg.topic, "body": msg.message})
+
+    async def _lane(self, queue: "asyncio.Queue[dict[str, Any] | None]") -> None:
+        """Runs the handlers of queued messages one at a time, until None is queued"""
+        while True:
+            item: dict[str, Any] | None = await queue.get()
+            if item is None:
+                return
+            try:
+                await _resolve(self._callbacks[item["topic"]](item["body"]))
+            except Exception as exc:  # pylint: disable = broad-exception-caught
+                logger.error("Handler for %s has encountered an error.", item["topic"], exc_info=exc)
+
+    async def _receive_loop(self) -> None:
+        """Receives messages through the configured transport until killed"""
+        ws_retry_time: float = 0
+        while self._event_alive:
+            try:
+                if self._transport == STSTransport.WEBSOCKET and time.time() >= ws_retry_time:
+                    await self._listen_websocket()
+                    ws_retry_time = time.time() + WS_RETRY_INTERVAL
+                elif self._transport == STSTransport.LONG_POLL:
+                    started: float = time.monotonic()
+                    # a server ignoring `wait` answers at once, poll it at the normal rate
+                    if not await self._poll(LONG_POLL_WAIT) and time.monotonic() - started < LONG_POLL_WAIT / 2:
+                        await asyncio.sleep(POLL_INTERVAL)
+                else:
+                    await self._poll()
+                    await asyncio.sleep(POLL_INTERVAL)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # pylint: disable = broad-exception-caught
+                self._event_crash = exc
+                logger.error("Client has encountered an error.", exc_info=exc)
+                await asyncio.sleep(POLL_INTERVAL)
+
+    async def _poll(self, wait: float = 0) -> int:
+        """Retrieves and queues all messages since the cursor with a single request,
+        returns the number of messages. See `STSClient._poll`"""
+        topics: list[str] = list(self._topics)
+        params: list[tuple[str, str]] = [("Id", str(self.cursor.id))]
+        params.extend(("topics[]", topic) for topic in topics)
+        retrieve_json: Any
+        if wait > 0:
+            params.append(("wait", str(int(wait * 1000))))
+            held: asyncio.Future[Any] = asyncio.ensure_future(self._retrieve(
+                params, aiohttp.ClientTimeout(total=None, sock_connect=3.05, sock_read=wait + LONG_POLL_MARGIN)
+            ))
+            self._held = held
+            try:
+                await asyncio.wait((held,))
+            finally:
+                # also aborts the request when `kill()` cancels this poll
+                held.cancel()
+                self._held = None
+            if held.cancelled():
+                return await self._poll(wait)
+            retrieve_json = held.result()
+        else:
+            retrieve_json = await self._retrieve(params)
+        if topics != self._topics:
+            # subscribed during the request, which skipped the new topics
+            return 0
+        if STSPacket.is_valid(retrieve_json):
+            messages, skipped = self.cursor.update(STSPacket(retrieve_json))
+            if skipped:
+                logger.warning("Message queue reset or trimmed, %i messages skipped", skipped)
+                self.ongap(skipped)
+            for msg in messages:
+                self._dispatch(msg)
+            return len(messages)
+        return 0
+
+    async def _retrieve(self, params: list[tuple[str, str]], timeout: Any = None) -> Any:
+        """Sends a `/retrieve` request, returns its JSON or None if it failed"""
+        kwargs: dict[str, Any] = {} if timeout is None else {"timeout": timeout}
+        async with self._session.get(f"{self.url}/retrieve", params=params, **kwargs) as resp:
+            if not resp.ok:
+                return None
+            return await resp.json()
+
+    async def _listen_websocket(self) -> None:
+        """Receives pushed messages until the socket drops, see `STSClient._listen_websocket`"""
+        ws_url: str = self.url.replace("http", "ws", 1) + "/messageQueue/ws"
+        try:
+            async with self._session.ws_connect(ws_url) as socket:
+                # catch up once subscribed, see `STSClient._listen_websocket`
+                await self._poll()
+                async for raw in socket:
+                    if raw.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    msg: Any = raw.json()
+                    if not isinstance(msg, dict):
+                        continue
+                    handle, skipped = self.cursor.advance(msg.get("id"), msg.get("epoch"))
+                    if skipped:
+                        logger.warning("Message queue trimmed, %i messages skipped", skipped)
+                        self.ongap(skipped)
+                    if handle and STSUpdate.is_valid(msg):
+                        self._dispatch(STSUpdate(msg))
+        except (aiohttp.ClientError, OSError) as exc:
+            logger.warning("Websocket unavailable, polling instead: %s", exc)
+
+    async def _heartbeat_loop(self) -> None:
+        """Sends a heartbeat every `HEARTBEAT_INTERVAL` seconds, independent of handlers"""
+        while self._event_alive:
+            try:
+                await self.emit("heartbeat", {"name": self._name})
+            except (aiohttp.ClientError, OSError) as exc:
+                logger.warning("Heartbeat failed: %s", exc)
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def _inform(self, _: dict[str, Any]) -> None:
+        """Responds to a ping from the server,
+        sending the instrument data in response.
+        """
+        await self.emit(
+            "instrument_data",
+            {
+                "priority": self._priority,
+                "name": self._name,
+                "sequence": self._sequence_num,
+            },
+        )
+
+    async def _measure(self, body: dict[str, Any]) -> None:
+        """Responds to a measurement request from the server,
+        sending the measurement data in response.
+        """
+        if body["sequence"] != self._sequence_num:
+            return
+        await self._measure_point_async(body, self._ready)
+
+    async def _get_ref(self, body: dict[str, Any]) -> None:
+        """Responds to a reference request from the server,
+        calling onmeasure with the reference type and experiment id."""
+        await _resolve(self.onmeasure(int(body["refType"]), int(body["experimentId"])))
+
+    async def _move(self, body: dict[str, Any]) -> None:
+        pt: STSPoint = STSPoint(body['x'], body['y'], body['z'])
+        with self.position.moving_to(pt):
+            await _resolve(self.onmove(pt))
+
+    async def _get_points(self, _: dict[str, Any]) -> None:
+        # the stage is only queried if it is idle and the cached position is stale
+        pt: STSPoint | None = self.position.point
+        if not self.position.answer_from_cache():
+            pt = await _resolve(self.get_points())
+            if pt:
+                self.position.confirmed(pt)
+        if pt:
+            await self.emit("point_info", {'x': pt.x, "y": pt.y, "z": pt.z})
+
+    async def _set_calibration(self, body: dict[str, Any]) -> None:
+        self._store_calibration(body)
+
+    async def _set_local_calibration(self, body: dict[str, Any]) -> None:
+        self._store_local_calibration(body, await _resolve(self.get_points()))
+
+    async def _ready(self) -> None:
+        """Sends a ready message to the server"""
+        await self.emit("ready", {"sequence": self._sequence_num, "name": self._name})
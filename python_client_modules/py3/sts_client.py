@@ -1,10 +1,56 @@
 """Contains STSClient made for communication with the STS (sequencial thing system)"""
+import inspect
+import json
+import logging
 import threading
 import time
-from typing import Callable, Any, TypeGuard, TypedDict
+from concurrent.futures import Future
+from functools import partial
+from enum import Enum
+from typing import Awaitable, Callable, Any, TypeGuard, TypedDict
 import requests
 import numpy as np
 
+from .sts_dispatch import STSDispatcher
+from .sts_metrics import STSMetrics
+from .sts_position import PositionTracker
+from .sts_session import DEFAULT_CONNECT_TIMEOUT, STSSession
+from .sts_tracing import Tracer, get_tracer
+from .sts_upload import STSUploader
+
+try:
+    import websocket  # type: ignore
+except ImportError:  # websocket-client is only required for STSTransport.WEBSOCKET
+    websocket = None
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+POLL_INTERVAL: float = 0.1
+"""Seconds between `/retrieve` requests while polling"""
+LONG_POLL_WAIT: float = 10.0
+"""Seconds the server may hold a long-polling `/retrieve` request"""
+LONG_POLL_MARGIN: float = 5.0
+"""Seconds a long-polling request may take beyond its wait before it times out"""
+WS_RECEIVE_TIMEOUT: float = 1.0
+"""Seconds a websocket receive may block before heartbeat and shutdown checks run"""
+WS_RETRY_INTERVAL: float = 10.0
+"""Seconds to poll before attempting to reopen a dropped websocket"""
+HEARTBEAT_INTERVAL: float = 30
+"""Seconds between heartbeats sent to the server"""
+
+
+class STSTransport(Enum):
+    """Ways in which STSClient can receive messages from the server"""
+
+    POLL = 1
+    """Requests `/retrieve` every `POLL_INTERVAL` seconds"""
+    WEBSOCKET = 2
+    """Subscribes to `/messageQueue/ws`, polling only while the socket is down"""
+    LONG_POLL = 3
+    """Requests `/retrieve` with a `wait`, the server answers as soon as a message arrives
+    or after `LONG_POLL_WAIT` seconds. Works wherever plain HTTP does"""
+
 
 class STSUpdate:
     """Object containing a single message with topic"""
@@ -33,14 +79,22 @@ class STSUpdate:
 
 class STSPacket:
     """A class containing data of a single STS packet"""
-    class PacketDictionary(TypedDict):
-        """Dictionary meeting the requirements for IoT_Packet"""
-
+    class _RequiredPacketDictionary(TypedDict):
         latestId: int
         messages: list[STSUpdate.UpdateDictionary]
 
+    class PacketDictionary(_RequiredPacketDictionary, total=False):
+        """Dictionary meeting the requirements for IoT_Packet"""
+
+        epoch: int
+        firstId: int
+
     def __init__(self, packet: PacketDictionary) -> None:
         self.latest_id: int = int(packet["latestId"])
+        """Epoch of the server's queue, None if the server does not report one"""
+        self.epoch: int | None = packet.get("epoch")
+        """Id of the oldest message the server still stores, None if not reported"""
+        self.first_id: int | None = packet.get("firstId")
         self.messages: list[STSUpdate] = []
         for msg in packet["messages"]:
             if STSUpdate.is_valid(msg):
@@ -50,19 +104,87 @@ class STSPacket:
     def is_valid(packet: Any) -> TypeGuard[PacketDictionary]:
         """Typeguard for the constructor"""
         if not isinstance(packet, dict):
-            print("Typeguard did not pass")
+            logger.warning("Typeguard did not pass")
             return False
         if not isinstance(packet["latestId"], int):
-            print("Typeguard did not pass")
+            logger.warning("Typeguard did not pass")
             return False
         if not isinstance(packet["messages"], list):
-            print("Typeguard did not pass")
+            logger.warning("Typeguard did not pass")
+            return False
+        if not all(isinstance(packet.get(key, 0), int) for key in ("epoch", "firstId")):
+            logger.warning("Typeguard did not pass")
             return False
         return True
 
 
+class STSCursor:
+    """Position of a client in the server's message queue.
+
+    The server tags its responses with the `epoch` of the queue, which changes
+    whenever the queue is cleared or the server restarts, and with `firstId`,
+    the oldest message it still stores.
+    - A new epoch (or, from servers without epochs, a `latestId` behind the cursor)
+    means the queue was reset. The response was for the old queue, so its messages
+    are dropped and the cursor rewinds to the start of the new queue, which only
+    holds messages sent since the reset.
+    - A `firstId` past the cursor means messages were trimmed before they were read,
+    they are counted in `lost`.
+    """
+
+    def __init__(self, packet: STSPacket | None = None) -> None:
+        self.id: int = 0 if packet is None else packet.latest_id
+        self.epoch: int | None = None if packet is None else packet.epoch
+        self.resets: int = 0
+        self.lost: int = 0
+
+    def update(self, packet: STSPacket) -> tuple[list[STSUpdate], int]:
+        """Moves the cursor past a `/retrieve` response for it,
+        returns the messages to handle and the number of messages skipped"""
+        reset: bool = packet.latest_id < self.id or (
+            packet.epoch is not None and self.epoch is not None and packet.epoch != self.epoch
+        )
+        if packet.epoch is not None:
+            self.epoch = packet.epoch
+        if reset:
+            self.resets += 1
+            self.id = packet.first_id or 0
+            return [], 0
+        skipped: int = 0
+        if packet.first_id is not None and packet.first_id > self.id:
+            skipped = packet.first_id - self.id
+        self.lost += skipped
+        self.id = packet.latest_id
+        return packet.messages, skipped
+
+    def advance(self, message_id: int | None, epoch: int | None = None) -> tuple[bool, int]:
+        """Moves the cursor past a message pushed over the websocket,
+        returns whether to handle it and the number of messages skipped before it.
+        Messages the cursor is already past were read by a poll and are dropped"""
+        if message_id is None:
+            # servers without message ids push every message once and in order
+            self.id += 1
+            return True, 0
+        if epoch is not None and self.epoch is not None and epoch != self.epoch:
+            # the socket continues with the messages of the new queue
+            self.epoch = epoch
+            self.resets += 1
+            self.id = message_id + 1
+            return True, 0
+        if epoch is not None:
+            self.epoch = epoch
+        if message_id < self.id:
+            return False, 0
+        skipped: int = message_id - self.id
+        self.lost += skipped
+        self.id = message_id + 1
+        return True, skipped
+
+
 class STSPoint:
     """Tiny class for access to x,y,z values."""
+    __slots__ = ("x", "y", "z")
+
     def __init__(self, x: int, y: int, z: int) -> None:
         self.x: int = x
         self.y: int = y
@@ -73,27 +195,170 @@ class STSPoint:
 
     def get_local(self, og_A:"STSPoint", og_B:"STSPoint", og_C:"STSPoint",
                   local_A:"STSPoint", local_B:"STSPoint", local_C:"STSPoint"):
-        relself=STSPoint(self.x-og_A.x, self.y-og_A.y, self.z-og_A.z)
-        og_AB=STSPoint(og_B.x-og_A.x, og_B.y-og_A.y, og_B.z-og_A.z)
-        og_AC=STSPoint(og_C.x-og_A.x, og_C.y-og_A.y, og_C.z-og_A.z)
-        components = np.linalg.lstsq(
-            np.transpose(np.array([
-                og_AB.to_list(),
-                og_AC.to_list()
-            ])), 
-            np.array(relself.to_list()), rcond=None)[0]
-        
-        local_AB=STSPoint(local_B.x-local_A.x, local_B.y-local_A.y, local_B.z-local_A.z)
-        local_AC=STSPoint(local_C.x-local_A.x, local_C.y-local_A.y, local_C.z-local_A.z)
-        local_matrix=np.transpose(np.array([
-                local_AB.to_list(),
-                local_AC.to_list()
-            ]))
-        result=STSPoint(*list(local_matrix@components))
-        return STSPoint(local_A.x+result.x, local_A.y+result.y, local_A.z+result.z)
+        """Maps this point from the basis of the `og` triangle to the `local` triangle.
+        Use `STSCalibration` directly to map many points with the same triangles."""
+        return STSCalibration(og_A, og_B, og_C, local_A, local_B, local_C).transform_point(self)
+
+
+class STSCalibration:
+    """Precomputed affine map from dataset coordinates to local (stage) coordinates,
+    defined by the calibration triangles `og` (A, B, C) and `local` (A, B, C).
+
+    Points are decomposed into the AB and AC edges of the `og` triangle
+    (least squares, so points off its plane are projected onto it)
+    and rebuilt from the edges of the `local` triangle.
+    """
+
+    def __init__(self, og_a: STSPoint, og_b: STSPoint, og_c: STSPoint,
+                 local_a: STSPoint, local_b: STSPoint, local_c: STSPoint) -> None:
+        self.key: tuple[float, ...] = STSCalibration.key_of(og_a, og_b, og_c, local_a, local_b, local_c)
+        og_origin: np.ndarray = np.array(og_a.to_list(), dtype=float)
+        og_matrix: np.ndarray = np.transpose(np.array([
+            np.subtract(og_b.to_list(), og_origin),
+            np.subtract(og_c.to_list(), og_origin),
+        ], dtype=float))
+        local_origin: np.ndarray = np.array(local_a.to_list(), dtype=float)
+        local_matrix: np.ndarray = np.transpose(np.array([
+            np.subtract(local_b.to_list(), local_origin),
+            np.subtract(local_c.to_list(), local_origin),
+        ], dtype=float))
+        # the pseudo-inverse solves the edge decomposition of every point at once,
+        # with the same cutoff as a per point lstsq
+        og_inverse: np.ndarray = np.linalg.lstsq(og_matrix, np.eye(3), rcond=None)[0]
+        self.matrix: np.ndarray = local_matrix @ og_inverse
+        self.offset: np.ndarray = local_origin - self.matrix @ og_origin
+
+    @staticmethod
+    def key_of(*points: STSPoint) -> tuple[float, ...]:
+        """Returns the coordinates of `points` as one flat tuple"""
+        return tuple(value for point in points for value in point.to_list())
+
+    @staticmethod
+    def update(previous: "STSCalibration | None",
+               og_a: STSPoint, og_b: STSPoint, og_c: STSPoint,
+               local_a: STSPoint, local_b: STSPoint, local_c: STSPoint) -> "STSCalibration":
+        """Returns `previous` if it was built from the same points, otherwise a new calibration"""
+        if previous is not None and previous.key == STSCalibration.key_of(
+                og_a, og_b, og_c, local_a, local_b, local_c):
+            return previous
+        return STSCalibration(og_a, og_b, og_c, local_a, local_b, local_c)
+
+    def transform(self, points: np.ndarray) -> np.ndarray:
+        """Maps an (N,3) array of points in one vectorized operation"""
+        return np.asarray(points, dtype=float) @ self.matrix.T + self.offset
+
+    def transform_point(self, point: STSPoint) -> STSPoint:
+        """Maps a single point"""
+        result: np.ndarray = self.matrix @ np.array(point.to_list(), dtype=float) + self.offset
+        return STSPoint(*result.tolist())
+
+
+async def _resolve(result: Any) -> Any:
+    """Awaits `result` if a handler returned an awaitable"""
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+class STSMeasuring:
+    """Calibration and `measure` handling shared by STSClient, AsyncSTSClient and
+    the instruments of an STSHub.
+
+    Classes using it set the attributes annotated here in their constructor and
+    call the helpers from their handlers, which keep their own sequence checks
+    and ready messages.
+    """
 
+    is_stage: bool
+    onmeasure: Callable[[int, int], Any]
+    onmove: Callable[[STSPoint], Any]
+    cal_a: STSPoint
+    cal_b: STSPoint
+    cal_c: STSPoint
+    current_cal_a: STSPoint
+    current_cal_b: STSPoint
+    current_cal_c: STSPoint
+    _calibration: STSCalibration | None
+    position: PositionTracker
+
+    def local_calibration(self) -> STSCalibration:
+        """Returns the calibration from dataset to local coordinates,
+        rebuilding it only if a calibration point has changed since the last call"""
+        self._calibration = STSCalibration.update(
+            self._calibration, self.cal_a, self.cal_b, self.cal_c,
+            self.current_cal_a, self.current_cal_b, self.current_cal_c)
+        return self._calibration
+
+    def to_local(self, points: np.ndarray) -> np.ndarray:
+        """Maps an (N,3) array of dataset points to local coordinates,
+        e.g. to transform a whole pointset up front"""
+        return self.local_calibration().transform(points)
+
+    def _store_calibration(self, body: dict[str, Any]) -> None:
+        """Stores the dataset calibration points of a `calibration` message"""
+        self.cal_a = STSPoint(body["A"]['x'], body["A"]['y'], body["A"]['z'])
+        self.cal_b = STSPoint(body["B"]['x'], body["B"]['y'], body["B"]['z'])
+        self.cal_c = STSPoint(body["C"]['x'], body["C"]['y'], body["C"]['z'])
+
+    def _store_local_calibration(self, body: dict[str, Any], pt: STSPoint | None) -> None:
+        """Stores the current point `pt` as the local calibration point named in `body`"""
+        if pt:
+            self.position.confirmed(pt)
+            if body["point"] == "A":
+                self.current_cal_a = pt
+            elif body["point"] == "B":
+                self.current_cal_b = pt
+            elif body["point"] == "C":
+                self.current_cal_c = pt
+
+    def _measure_target(self, body: dict[str, Any]) -> STSPoint:
+        """Returns the point of a `measure` message, in local coordinates for a stage"""
+        point: STSPoint = STSPoint(
+            int(body["point"]["x"]), int(body["point"]["y"]), int(body["point"]["z"])
+        )
+        if self.is_stage:
+            point = self.local_calibration().transform_point(point)
+        return point
+
+    def _measure_point(self, body: dict[str, Any], ready: Callable[[], None], **attributes: Any) -> None:
+        """Moves to and measures the point of a `measure` message, traced as spans.
+        `ready` is called afterwards even if that failed"""
+        tracer: Tracer = get_tracer()
+        with tracer.point(int(body["experimentId"]), int(body["pointNumber"])), \
+                tracer.span("measure", **attributes):
+            try:
+                point: STSPoint = self._measure_target(body)
+                with self.position.busy():
+                    with self.position.moving_to(point), tracer.span("move"):
+                        self.onmove(point)
+                    with tracer.span("capture"):
+                        self.onmeasure(int(body["pointNumber"]), int(body["experimentId"]))
+            finally:
+                # call ready no matter if it failed or not
+                with tracer.span("ready"):
+                    ready()
+
+    async def _measure_point_async(
+        self, body: dict[str, Any], ready: Callable[[], Awaitable[None]], **attributes: Any
+    ) -> None:
+        """`_measure_point` awaiting the callbacks if they return awaitables"""
+        tracer: Tracer = get_tracer()
+        with tracer.point(int(body["experimentId"]), int(body["pointNumber"])), \
+                tracer.span("measure", **attributes):
+            try:
+                point: STSPoint = self._measure_target(body)
+                with self.position.busy():
+                    with self.position.moving_to(point), tracer.span("move"):
+                        await _resolve(self.onmove(point))
+                    with tracer.span("capture"):
+                        await _resolve(self.onmeasure(int(body["pointNumber"]), int(body["experimentId"])))
+            finally:
+                # call ready no matter if it failed or not
+                with tracer.span("ready"):
+                    await ready()
 
-class STSClient:
+
+class STSClient(STSMeasuring):
     """A client made for communicating with the IoT network for sequenced measurement.
 
     Use either with `with` or `start()`, `kill()`.
@@ -109,37 +374,77 @@ class STSClient:
     as they are important for proper operation of sequenced measurements.
 
     To measure at multiple sequence numbers, create multiple `STSClient`
-    instances with different names.
+    instances with different names, or host them all on one `STSHub`.
+
+    With `transport=STSTransport.WEBSOCKET` messages are pushed by the server
+    and dispatched as soon as they arrive. If the socket cannot be opened or drops,
+    the client falls back to polling and retries the socket every `WS_RETRY_INTERVAL`.
+    Requires the `websocket-client` package.
+
+    With `transport=STSTransport.LONG_POLL` every `/retrieve` request is held by the
+    server until a message arrives, with the latency of a websocket and a request
+    every `LONG_POLL_WAIT` seconds on an idle queue. Only messages of the bound topics
+    answer it; binding a new topic with `on()` aborts the held request and reissues it
+    with the new topic, as does `kill()` without reissuing. Against a server without
+    long-polling it polls normally.
+
+    All HTTP requests share one pooled keep-alive `session`. Pass an `STSSession`
+    to configure pool size, retries and timeouts, or to share it between clients.
+
+    Each measured point is traced with the tracer of `sts_tracing.set_tracer()`, as
+    a `measure` span containing `move`, `capture` and `ready` spans. Spans of the
+    callbacks, such as the stage moving or an upload queued with `queue_file()`,
+    join the point's trace.
+
+    By default handlers run one after another on the event thread. Pass an
+    `STSDispatcher` to run them on worker threads instead: `measure` keeps its order
+    on a serial lane, independent topics share a thread pool and heartbeats and
+    pings go out on a priority lane, on time even during long measurements.
+
+    Handler, emit and upload latencies, polls, bytes and queue lag are recorded in
+    `metrics`, see `STSMetrics`. Read them with `metrics.snapshot()` or serve them
+    to Prometheus with `metrics.serve()`. Pass an `STSMetrics` to share it between clients.
     """
 
     def __init__(
-        self, url: str, critical: bool, sequence_number: int, name: str, priority: bool, is_stage:bool=False, is_2d:bool=False
+        self, url: str, critical: bool, sequence_number: int, name: str, priority: bool, is_stage:bool=False, is_2d:bool=False,
+        transport: STSTransport = STSTransport.POLL, session: STSSession | None = None,
+        dispatcher: STSDispatcher | None = None, metrics: STSMetrics | None = None
     ) -> None:
+        if transport == STSTransport.WEBSOCKET and websocket is None:
+            raise ImportError("STSTransport.WEBSOCKET requires the websocket-client package")
         self.url = url
+        self._transport: STSTransport = transport
+        self._ws_retry_time: float = 0
+        self._owns_session: bool = session is None
+        self.session: STSSession = session if session is not None else STSSession()
+        self._dispatcher: STSDispatcher | None = dispatcher
+        self._owns_metrics: bool = metrics is None
+        self.metrics: STSMetrics = metrics if metrics is not None else STSMetrics()
+        self.uploader: STSUploader = STSUploader(self.session, self.url, metrics=self.metrics)
         try: 
-            requests.head(f"{self.url}", timeout=1000)
+            self.session.head(f"{self.url}")
         except requests.ConnectionError as e:
             if critical:
                 # kill the program if the website is not online
-                print("Connection could not be established.\n Closing program.")
+                logger.critical("Connection could not be established. Closing program.")
                 quit()
             else:
                 raise e
         # get end of queue
-        latest_id_response: requests.Response = requests.get(
-            f"{self.url}/retrieve", params={"Id": str(0)}, timeout=1000
+        latest_id_response: requests.Response = self.session.get(
+            f"{self.url}/retrieve", params={"Id": str(0)}
         )
         self.is_stage: bool=is_stage
         self.is_2d: bool=is_2d
         self._topics: list[str] = []
         self._callbacks: dict[str, Callable[[dict[str, Any]], None]] = {}
+        """Set to abort the held long-polling request, see `_hold()`"""
+        self._held_wake: threading.Event = threading.Event()
         latest_id_response.raise_for_status()
         lid: Any = latest_id_response.json()
-        self._latest_id: int
-        if isinstance(lid, dict) and isinstance(lid["latestId"], int):
-            self._latest_id = lid["latestId"]
-        else:
-            self._latest_id = 0
+        """Position in the server's message queue, see `STSCursor`"""
+        self.cursor: STSCursor = STSCursor(STSPacket(lid) if STSPacket.is_valid(lid) else None)
         self._event_crash:Exception|None = None
         self._event_alive: bool = False
         self._event_thread: threading.Thread = threading.Thread(
@@ -182,6 +487,15 @@ class STSClient:
         self.current_cal_a:STSPoint=STSPoint(0,0,0)
         self.current_cal_b:STSPoint=STSPoint(0,0,0)
         self.current_cal_c:STSPoint=STSPoint(0,0,0)
+        self._calibration: STSCalibration | None = None
+
+        """Callback accepting the number of messages skipped because the server's queue
+        was reset or trimmed before they were read, see `STSCursor`.
+        Those messages are not handled, e.g. to re-announce the instrument."""
+        self.ongap: Callable[[int], None] = lambda _: None
+
+        """Last commanded or confirmed position, answers `point_info?` while the stage is busy."""
+        self.position: PositionTracker = PositionTracker()
 
     def __enter__(self):
         self.start()
@@ -194,40 +508,44 @@ class STSClient:
         """Starts the client, acquiring new messages."""
         self._err_chk()
         self._event_alive = True
+        if self._dispatcher is not None:
+            self._dispatcher.on_error = self._handler_crash
+            self._dispatcher.every(1, self._heartbeat)
         self._event_thread.start()
 
     def kill(self):
         """Kills the client event thread."""
-        print("Killing listener")
+        logger.info("Killing listener")
         self._event_alive = False
+        self._held_wake.set()
         self._event_thread.join()
-        print("Joined listener")
+        logger.info("Joined listener")
+        if self._dispatcher is not None:
+            self._dispatcher.shutdown()
+        self.uploader.shutdown()
+        if self._owns_session:
+            self.session.close()
+        if self._owns_metrics:
+            self.metrics.close()
         self._err_chk()
 
     def _set_local_calibration(self, body:dict[str, Any]):
-        pt=self.get_points()
-        if pt:
-            if body["point"]=="A":
-                self.current_cal_a=pt
-            elif body["point"]=="B":
-                self.current_cal_b=pt
-            elif body["point"]=="C":
-                self.current_cal_c=pt
+        self._store_local_calibration(body, self.get_points())
 
     def _move(self, body:dict[str, Any]):
         pt:STSPoint = STSPoint(body['x'], body['y'], body['z'])
-        self.onmove(pt)
+        with self.position.moving_to(pt):
+            self.onmove(pt)
 
 
     def _get_points(self, _:dict[str, Any]):
-        pt:STSPoint|None=self.get_points()
+        # the stage is only queried if it is idle and the cached position is stale
+        pt:STSPoint|None=self.position.get(self.get_points)
         if pt:
             self.emit("point_info", {'x':pt.x, "y":pt.y, "z":pt.z})
 
     def _set_calibration(self, body:dict[str, Any]):
-        self.cal_a=STSPoint(body["A"]['x'], body["A"]['y'], body["A"]['z'])
-        self.cal_b=STSPoint(body["B"]['x'], body["B"]['y'], body["B"]['z'])
-        self.cal_c=STSPoint(body["C"]['x'], body["C"]['y'], body["C"]['z'])
+        self._store_calibration(body)
 
     def _get_ref(self, body: dict[str, Any]):
         """Responds to a reference request from the server,
@@ -241,25 +559,13 @@ class STSClient:
         """Responds to a measurement request from the server,
         sending the measurement data in response.
         """
-        print("Measuring")
-        print(body)
+        logger.debug("Measure request %s", body, extra={"topic": "measure"})
         if body["sequence"] == self._sequence_num:
-            point: STSPoint = STSPoint(
-                int(body["point"]["x"]), int(body["point"]["y"]), int(body["point"]["z"])
-            )
-            print(point.to_list())
-            try:
-                if self.is_stage:
-                    point=point.get_local(self.cal_a, self.cal_b, self.cal_c,
-                                    self.current_cal_a, self.current_cal_b, self.current_cal_c)
-                self.onmove(point)
-                self.onmeasure(
-                    int(body["pointNumber"]), int(body["experimentId"])
-                )
-            finally:
-                # call ready no matter if it failed or not
-                print("Sending ready")
-                self._ready()
+            logger.info("Measuring point %s of experiment %s at %s",
+                        body["pointNumber"], body["experimentId"], body["point"],
+                        extra={"topic": "measure", "experimentId": body["experimentId"],
+                               "pointNumber": body["pointNumber"]})
+            self._measure_point(body, self._ready)
 
 
 
@@ -267,7 +573,7 @@ class STSClient:
         """Responds to a ping from the server, 
         sending the instrument data in response.
         """
-        print("ping")
+        logger.debug("ping", extra={"topic": "instrument_ping"})
         self.emit(
             "instrument_data",
             {
@@ -281,42 +587,195 @@ class STSClient:
         """The event thread function, that is run in a seperate thread."""
         while self._event_alive:
             try:
-                if int(time.time()) - self.last_heartbeat > 30:
-                    requests.post(
-                        f"{self.url}",
-                        json={"topic": 'heartbeat', "body": {"name": self._name}},
-                        timeout=1000,
-                    )
-                    self.last_heartbeat = int(time.time())
-                retrieve_response: requests.Response = requests.get(
-                    f"{self.url}/retrieve",
-                    params={"Id": str(self._latest_id), "topics[]": self._topics},
-                    timeout=1000
-                )
-                if retrieve_response.ok:
-                    retrieve_json: Any = retrieve_response.json()
-                    # print(retrieve_json)
-                    # Type guards
-                    if STSPacket.is_valid(retrieve_json):
-                        retrieve_packet: STSPacket = STSPacket(retrieve_json)
-                        self._latest_id = retrieve_packet.latest_id
-                        for msg in retrieve_packet.messages:
-                            # print(msg.topic)
-                            self._callbacks[msg.topic](msg.message)
-                time.sleep(0.1)
-                #print((1+(int(time.time())%3)) * '.')
+                if self._dispatcher is None:
+                    self._heartbeat()
+                if (self._transport == STSTransport.WEBSOCKET
+                        and time.time() >= self._ws_retry_time):
+                    self._listen_websocket()
+                elif self._transport == STSTransport.LONG_POLL:
+                    started: float = time.monotonic()
+                    # a server ignoring `wait` answers at once, poll it at the normal rate
+                    if not self._poll(LONG_POLL_WAIT) and time.monotonic() - started < LONG_POLL_WAIT / 2:
+                        time.sleep(POLL_INTERVAL)
+                else:
+                    self._poll()
+                    time.sleep(POLL_INTERVAL)
             except Exception as exc: #pylint: disable = broad-exception-caught
                 self._event_crash=exc
-                print("Client has encountered an error.")
-                print(exc)
+                logger.error("Client has encountered an error.", exc_info=exc)
                 # self._event_alive=False
-        
+
+    def _handler_crash(self, exc: Exception) -> None:
+        """Records an exception raised by a handler on a dispatcher worker"""
+        self._event_crash = exc
+        logger.error("Client has encountered an error.", exc_info=exc)
+
+    def _heartbeat(self) -> None:
+        """Sends a heartbeat to the server if the last one is older than `HEARTBEAT_INTERVAL`"""
+        if int(time.time()) - self.last_heartbeat > HEARTBEAT_INTERVAL:
+            self.session.post(
+                f"{self.url}",
+                json={"topic": 'heartbeat', "body": {"name": self._name}},
+            )
+            self.last_heartbeat = int(time.time())
+
+    def _poll(self, wait: float = 0) -> int:
+        """Retrieves and handles all messages since the cursor with a single request,
+        returns the number of messages.
+
+        `wait`: seconds the server may hold the request until a message of the bound
+        topics arrives. A topic bound while the request is held aborts it, and the
+        request is sent again with the new topic
+        """
+        if wait > 0:
+            # replaced before the topics are read, so any topic bound later aborts the request
+            self._held_wake = threading.Event()
+        topics: list[str] = list(self._topics)
+        params: dict[str, Any] = {"Id": str(self.cursor.id), "topics[]": topics}
+        retrieve_response: requests.Response | None
+        if wait > 0:
+            params["wait"] = str(int(wait * 1000))
+            retrieve_response = self._hold(params, (DEFAULT_CONNECT_TIMEOUT, wait + LONG_POLL_MARGIN))
+            if retrieve_response is None:
+                return self._poll(wait) if self._event_alive else 0
+        else:
+            retrieve_response = self.session.get(f"{self.url}/retrieve", params=params)
+        arrived: float = time.monotonic()
+        self.metrics.count("sts_polls_total")
+        if retrieve_response.ok:
+            self.metrics.count("sts_received_bytes_total", len(retrieve_response.content))
+            retrieve_json: Any = retrieve_response.json()
+            if topics != self._topics:
+                # subscribed during the request, which skipped the new topics
+                return 0
+            # Type guards
+            if STSPacket.is_valid(retrieve_json):
+                packet: STSPacket = STSPacket(retrieve_json)
+                self.metrics.set("sts_queue_lag", max(packet.latest_id - self.cursor.id, 0))
+                messages, skipped = self.cursor.update(packet)
+                if skipped:
+                    logger.warning("Message queue reset or trimmed, %i messages skipped", skipped)
+                    self.ongap(skipped)
+                if not messages:
+                    self.metrics.count("sts_empty_polls_total")
+                for msg in messages:
+                    self._dispatch(msg, arrived)
+                return len(messages)
+        return 0
+
+    def _hold(self, params: dict[str, Any], timeout: tuple[float, float]) -> requests.Response | None:
+        """Sends a held `/retrieve` request, returns its response or None if `_held_wake`
+        was set first by `on()` or `kill()`.
+
+        The request is sent from its own thread, as a blocked `requests` call cannot be
+        interrupted. An aborted request expires there and its response is discarded,
+        the cursor only moves with the responses returned here.
+        """
+        wake: threading.Event = self._held_wake
+        held: "Future[requests.Response]" = Future()
+
+        def send() -> None:
+            try:
+                held.set_result(self.session.get(f"{self.url}/retrieve", params=params, timeout=timeout))
+            except Exception as exc: #pylint: disable = broad-exception-caught
+                held.set_exception(exc)
+            wake.set()
+
+        threading.Thread(target=send, daemon=True).start()
+        wake.wait()
+        return held.result() if held.done() else None
+
+    def _dispatch(self, msg: STSUpdate, arrived: float) -> None:
+        """Calls the callback bound to the topic of `msg`, or submits it to the dispatcher.
+
+        `arrived`: `time.monotonic()` when the message was received
+        """
+        callback: Callable[[dict[str, Any]], None] | None = self._callbacks.get(msg.topic)
+        if callback is None:
+            return
+        self.metrics.add("sts_handlers_pending", 1)
+        if self._dispatcher is not None:
+            self._dispatcher.submit(msg.topic, partial(self._handle, msg.topic, callback, arrived), msg.message)
+        else:
+            self._handle(msg.topic, callback, arrived, msg.message)
+
+    def _handle(
+        self, topic: str, callback: Callable[[dict[str, Any]], None], arrived: float, body: dict[str, Any]
+    ) -> None:
+        """Runs a handler, recording how long the message waited for it and took in total"""
+        self.metrics.observe("sts_handler_wait_seconds", time.monotonic() - arrived, topic=topic)
+        try:
+            callback(body)
+        except Exception:
+            self.metrics.count("sts_handler_errors_total", topic=topic)
+            raise
+        finally:
+            self.metrics.observe("sts_handler_latency_seconds", time.monotonic() - arrived, topic=topic)
+            self.metrics.add("sts_handlers_pending", -1)
+
+    def _websocket_url(self) -> str:
+        """Returns the address of the server's message pushing websocket"""
+        if self.url.startswith("https://"):
+            return "wss://" + self.url[len("https://"):] + "/messageQueue/ws"
+        if self.url.startswith("http://"):
+            return "ws://" + self.url[len("http://"):] + "/messageQueue/ws"
+        return self.url + "/messageQueue/ws"
+
+    def _listen_websocket(self) -> None:
+        """Receives pushed messages until the socket drops or the client is killed.
+
+        The server pushes every message in the queue with its id, the cursor is set
+        from it so polling can resume from the cursor after a drop.
+        """
+        try:
+            socket: Any = websocket.create_connection(
+                self._websocket_url(), timeout=WS_RECEIVE_TIMEOUT
+            )
+        except (websocket.WebSocketException, OSError) as exc:
+            logger.warning("Websocket unavailable, polling instead: %s", exc)
+            self._ws_retry_time = time.time() + WS_RETRY_INTERVAL
+            return
+        try:
+            # the socket only pushes messages posted after it connected, catch up on
+            # older ones now; pushed messages the poll already read are dropped
+            self._poll()
+            while self._event_alive:
+                if self._dispatcher is None:
+                    self._heartbeat()
+                try:
+                    raw: Any = socket.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                if not raw:
+                    # empty frame means the server closed the socket
+                    break
+                arrived: float = time.monotonic()
+                self.metrics.count("sts_received_bytes_total", len(raw))
+                msg: Any = json.loads(raw)
+                if self._pushed(msg) and STSUpdate.is_valid(msg):
+                    self._dispatch(STSUpdate(msg), arrived)
+        except (websocket.WebSocketException, OSError) as exc:
+            logger.warning("Websocket dropped, polling instead: %s", exc)
+        finally:
+            socket.close()
+        self._ws_retry_time = time.time() + WS_RETRY_INTERVAL
+
+    def _pushed(self, msg: Any) -> bool:
+        """Moves the cursor past a pushed message, returns whether to handle it"""
+        if not isinstance(msg, dict):
+            return False
+        handle, skipped = self.cursor.advance(msg.get("id"), msg.get("epoch"))
+        if skipped:
+            logger.warning("Message queue trimmed, %i messages skipped", skipped)
+            self.ongap(skipped)
+        return handle
 
     def on(
         self, topic: str | list[str], callback: Callable[[dict[str, Any]], None]
     ) -> None:
         """Binds a callback function to a topic or topics"""
         self._err_chk()
+        bound: set[str] = set(self._topics)
         if isinstance(topic, str):
             self._topics.append(topic)
             self._callbacks[topic] = callback
@@ -324,12 +783,13 @@ class STSClient:
             for top in topic:
                 self._topics.append(top)
                 self._callbacks[top] = callback
+        if not bound.issuperset(self._topics):
+            # the held request skips the new topics, reissue it with them
+            self._held_wake.set()
 
     def _ready(self) -> None:
         """Sends a ready message to the server"""
-        print("_ready: Sending ready")
         self.emit("ready", {"sequence": self._sequence_num, "name": self._name})
-        print("_ready: Sent ready")
 
     def _err_chk(self) -> None:
         """Checks if the event thread has crashed and raises the error if it has"""
@@ -339,28 +799,40 @@ class STSClient:
     def emit(self, topic: str, body: dict[str, Any]) -> None:
         """Sends jsonified `body` with `topic` to server"""
         self._err_chk()
-        print(f"emit: {topic}")
-        requests.post(
-            f"{self.url}", json={"topic": topic, "body": body}, timeout=1000
-        )
-        print(f"emit: {topic} sent")
+        with self.metrics.timer("sts_emit_seconds", topic=topic):
+            response: requests.Response = self.session.post(
+                f"{self.url}", json={"topic": topic, "body": body}
+            )
+        self.metrics.count("sts_sent_bytes_total", len(response.request.body or b""), kind="emit")
+        logger.debug("emit: %s sent", topic, extra={"topic": topic})
         
         
 
     def send_file(self, path: str, pt_num: int, ex_id: int) -> None:
-        """Sends a file from `path` to the STS server"""
+        """Sends a file from `path` to the STS server, blocking until it is stored.
+        Raises `STSUploadError` if it could not be uploaded."""
         self._err_chk()
-        with open(path, "rb") as sendable:
-            requests.post(
-                self.url + "/upload_measurement",
-                files={"file": sendable},
-                data={
-                    "name": self._name,
-                    "point_number": pt_num,
-                    "experimentId": ex_id,
-                },
-                timeout=1000,
-            )
+        self.uploader.upload(path, pt_num, ex_id, self._name)
+
+    def queue_file(self, path: str, pt_num: int, ex_id: int) -> "Future[requests.Response]":
+        """Queues a file from `path` for upload in the background and returns immediately,
+        so the upload overlaps with the next acquisition.
+        The returned future raises `STSUploadError` if the upload failed, the failure is
+        also logged and raised by the next call to the client, like a handler error.
+        Uploads still queued when the client is killed are finished first."""
+        self._err_chk()
+        future: Future[requests.Response] = self.uploader.submit(path, pt_num, ex_id, self._name)
+        future.add_done_callback(self._upload_done)
+        return future
+
+    def _upload_done(self, future: "Future[requests.Response]") -> None:
+        """Records the error of a failed background upload"""
+        if future.cancelled():
+            return
+        exc: BaseException | None = future.exception()
+        if isinstance(exc, Exception):
+            self._event_crash = exc
+            logger.error("Queued upload failed.", exc_info=exc)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,150 @@
+"""Contains STSDispatcher, running STS topic handlers off the client's event thread"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+SEQUENCE_LANE: str = "sequence"
+"""Lane shared by the topics whose relative order matters for measurements"""
+LANES: dict[str, str] = {
+    "measure": SEQUENCE_LANE,
+    "move": SEQUENCE_LANE,
+    "reference": SEQUENCE_LANE,
+    "calibration": SEQUENCE_LANE,
+    "set_local_calibration": SEQUENCE_LANE,
+}
+"""Maps topics to a shared serial lane, every other serial topic gets a lane of its own"""
+POOLED_TOPICS: tuple[str, ...] = ("point_info?",)
+"""Topics whose messages are independent and may be handled concurrently"""
+PRIORITY_TOPICS: tuple[str, ...] = ("instrument_ping",)
+"""Liveness topics, handled on the priority lane"""
+
+_Task = tuple[Callable[..., None], tuple[Any, ...]]
+
+
+class _Lane:
+    """A thread running queued tasks one at a time, in the order they were queued"""
+
+    def __init__(self, name: str, on_error: Callable[[Exception], None]) -> None:
+        self._queue: queue.Queue[_Task | None] = queue.Queue()
+        self._on_error: Callable[[Exception], None] = on_error
+        self._periodic: list[list[Any]] = []
+        self._thread: threading.Thread = threading.Thread(
+            target=self._run, name=f"STSDispatcher-{name}", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, func: Callable[..., None], *args: Any) -> None:
+        """Queues `func(*args)`"""
+        self._queue.put((func, args))
+
+    def every(self, interval: float, func: Callable[[], None]) -> None:
+        """Runs `func` every `interval` seconds, between queued tasks"""
+        self._queue.put((self._periodic.append, ([time.monotonic() + interval, interval, func],)))
+
+    def stop(self, wait: bool) -> None:
+        """Stops the lane after the already queued tasks"""
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
+
+    def _call(self, func: Callable[..., None], args: tuple[Any, ...]) -> None:
+        try:
+            func(*args)
+        except Exception as exc:  # pylint: disable = broad-exception-caught
+            self._on_error(exc)
+
+    def _run(self) -> None:
+        while True:
+            timeout: float | None = None
+            if self._periodic:
+                timeout = max(min(job[0] for job in self._periodic) - time.monotonic(), 0)
+            try:
+                task: _Task | None = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                task = (lambda: None, ())
+            if task is None:
+                return
+            self._call(*task)
+            now: float = time.monotonic()
+            for job in self._periodic:
+                if job[0] <= now:
+                    job[0] = now + job[1]
+                    self._call(job[2], ())
+
+
+class STSDispatcher:
+    """Runs topic handlers on worker threads so a slow handler does not stall the client.
+
+    Every topic is assigned to one of three kinds of workers:
+    - a priority lane for liveness topics (`priority_topics`) and periodic tasks
+    such as heartbeats, which therefore go out on time during long measurements
+    - a thread pool of `max_workers` for independent topics (`pooled_topics`)
+    - serial lanes for everything else. Messages in one lane are handled in order.
+    `lanes` maps topics to a shared lane, other topics get a lane of their own.
+
+    Exceptions raised by handlers are passed to `on_error`.
+    """
+
+    def __init__(
+        self,
+        lanes: dict[str, str] | None = None,
+        pooled_topics: tuple[str, ...] = POOLED_TOPICS,
+        priority_topics: tuple[str, ...] = PRIORITY_TOPICS,
+        max_workers: int = 4,
+    ) -> None:
+        self.lane_names: dict[str, str] = dict(LANES if lanes is None else lanes)
+        self.pooled_topics: tuple[str, ...] = pooled_topics
+        self.priority_topics: tuple[str, ...] = priority_topics
+        self.on_error: Callable[[Exception], None] = lambda exc: logger.error("Handler failed", exc_info=exc)
+        self._lock: threading.Lock = threading.Lock()
+        self._lanes: dict[str, _Lane] = {}
+        self._pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="STSDispatcher-pool"
+        )
+        self._priority: _Lane = _Lane("priority", self._error)
+
+    def _error(self, exc: Exception) -> None:
+        self.on_error(exc)
+
+    def _lane(self, name: str) -> _Lane:
+        with self._lock:
+            lane: _Lane | None = self._lanes.get(name)
+            if lane is None:
+                lane = _Lane(name, self._error)
+                self._lanes[name] = lane
+            return lane
+
+    def _pooled(self, callback: Callable[[dict[str, Any]], None], body: dict[str, Any]) -> None:
+        try:
+            callback(body)
+        except Exception as exc:  # pylint: disable = broad-exception-caught
+            self._error(exc)
+
+    def submit(self, topic: str, callback: Callable[[dict[str, Any]], None], body: dict[str, Any]) -> None:
+        """Schedules `callback(body)` on the worker assigned to `topic`"""
+        if topic in self.priority_topics:
+            self._priority.put(callback, body)
+        elif topic in self.pooled_topics:
+            self._pool.submit(self._pooled, callback, body)
+        else:
+            self._lane(self.lane_names.get(topic, topic)).put(callback, body)
+
+    def every(self, interval: float, func: Callable[[], None]) -> None:
+        """Runs `func` on the priority lane every `interval` seconds"""
+        self._priority.every(interval, func)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops all workers once the already submitted handlers have run"""
+        with self._lock:
+            lanes: list[_Lane] = list(self._lanes.values())
+            self._lanes.clear()
+        for lane in lanes:
+            lane.stop(wait)
+        self._pool.shutdown(wait=wait)
+        self._priority.stop(wait)
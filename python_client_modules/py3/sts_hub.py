@@ -0,0 +1,208 @@
+"""Contains STSHub, hosting several logical instruments over one STS connection"""
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+import requests
+
+from .sts_client import (
+    HEARTBEAT_INTERVAL, STSClient, STSCalibration, STSMeasuring, STSPoint, STSTransport
+)
+from .sts_dispatch import STSDispatcher
+from .sts_metrics import STSMetrics
+from .sts_position import PositionTracker
+from .sts_session import STSSession
+
+
+class STSInstrument(STSMeasuring):
+    """A logical instrument hosted by an `STSHub`.
+
+    Offers the callbacks and calibration points of `STSClient`, but receives
+    its messages from the hub instead of a connection of its own.
+    """
+
+    def __init__(
+        self, hub: "STSHub", name: str, sequence_number: int, priority: bool,
+        is_stage: bool = False, is_2d: bool = False
+    ) -> None:
+        self._hub: STSHub = hub
+        self.name: str = name
+        self.sequence_number: int = sequence_number
+        self.priority: bool = priority
+        self.is_stage: bool = is_stage
+        self.is_2d: bool = is_2d
+
+        """A callback accepting a point number and experiment id (or a reference type
+        and experiment id), that is called when measurement/preparation is ordered.
+        Only return when measurement is finished to ensure proper sequencing.
+        """
+        self.onmeasure: Callable[[int, int], None] = lambda _, __: None
+
+        """A callback accepting a single point, that is called when a move is ordered."""
+        self.onmove: Callable[[STSPoint], None] = lambda _: None
+
+        """Callback requesting that the current point is supplied.
+        Return None if device does not supply point data.
+        """
+        self.get_points: Callable[[], STSPoint | None] = lambda: None
+
+        self.cal_a: STSPoint = STSPoint(0, 0, 0)
+        self.cal_b: STSPoint = STSPoint(0, 0, 0)
+        self.cal_c: STSPoint = STSPoint(0, 0, 0)
+
+        self.current_cal_a: STSPoint = STSPoint(0, 0, 0)
+        self.current_cal_b: STSPoint = STSPoint(0, 0, 0)
+        self.current_cal_c: STSPoint = STSPoint(0, 0, 0)
+        self._calibration: STSCalibration | None = None
+        self.position: PositionTracker = PositionTracker()
+
+    def instrument_data(self) -> dict[str, Any]:
+        """Returns the body of this instrument's `instrument_data` reply"""
+        return {
+            "priority": self.priority,
+            "name": self.name,
+            "sequence": self.sequence_number,
+        }
+
+    def emit(self, topic: str, body: dict[str, Any]) -> None:
+        """Sends jsonified `body` with `topic` to server through the hub"""
+        self._hub.emit(topic, body)
+
+    def send_file(self, path: str, pt_num: int, ex_id: int) -> None:
+        """Sends a file from `path` to the STS server under this instrument's name"""
+        self._hub.send_file_as(self.name, path, pt_num, ex_id)
+
+    def queue_file(self, path: str, pt_num: int, ex_id: int) -> "Future[requests.Response]":
+        """Queues a file from `path` for background upload under this instrument's name"""
+        return self._hub.queue_file_as(self.name, path, pt_num, ex_id)
+
+    def measure(self, body: dict[str, Any]) -> None:
+        """Moves and measures if the request is for this instrument's sequence number,
+        sending ready afterwards."""
+        if body["sequence"] != self.sequence_number:
+            return
+        self._measure_point(
+            body, lambda: self.emit("ready", {"sequence": self.sequence_number, "name": self.name}),
+            instrument=self.name
+        )
+
+    def reference(self, body: dict[str, Any]) -> None:
+        """Calls onmeasure with the reference type and experiment id"""
+        self.onmeasure(int(body["refType"]), int(body["experimentId"]))
+
+    def move(self, point: STSPoint) -> None:
+        """Calls onmove with a copy of `point`"""
+        point = STSPoint(point.x, point.y, point.z)
+        with self.position.moving_to(point):
+            self.onmove(point)
+
+    def current_point(self) -> STSPoint | None:
+        """Returns the position for a `point_info?` request, from the cache if possible"""
+        return self.position.get(self.get_points)
+
+    def set_calibration(self, body: dict[str, Any]) -> None:
+        """Stores the dataset calibration points"""
+        self._store_calibration(body)
+
+    def set_local_calibration(self, body: dict[str, Any]) -> None:
+        """Stores the current point as a local calibration point"""
+        self._store_local_calibration(body, self.get_points())
+
+
+class STSHub(STSClient):
+    """Hosts any number of `STSInstrument`s over a single STS connection.
+
+    The hub holds one subscription to the queue and fans every message out to
+    its instruments. Heartbeats and `instrument_data`/`point_info` replies of all
+    instruments are posted together as one batch.
+
+    Register instruments with `add_instrument()`, then use the hub like an
+    `STSClient` with `with` or `start()`, `kill()`.
+    """
+
+    def __init__(
+        self, url: str, critical: bool, name: str = "STSHub",
+        transport: STSTransport = STSTransport.POLL, session: STSSession | None = None,
+        dispatcher: STSDispatcher | None = None, metrics: STSMetrics | None = None
+    ) -> None:
+        self.instruments: list[STSInstrument] = []
+        # the hub itself is never reported as an instrument
+        super().__init__(url, critical, -1, name, False, transport=transport,
+                         session=session, dispatcher=dispatcher, metrics=metrics)
+
+    def add_instrument(
+        self, name: str, sequence_number: int, priority: bool,
+        is_stage: bool = False, is_2d: bool = False
+    ) -> STSInstrument:
+        """Creates and registers a logical instrument, returning it for callback setup"""
+        self._err_chk()
+        instrument: STSInstrument = STSInstrument(
+            self, name, sequence_number, priority, is_stage, is_2d
+        )
+        self.instruments.append(instrument)
+        return instrument
+
+    def emit_batch(self, messages: list[dict[str, Any]]) -> None:
+        """Sends several `{"topic": ..., "body": ...}` messages in a single request"""
+        self._err_chk()
+        if messages:
+            with self.metrics.timer("sts_emit_seconds", topic="batch"):
+                response: requests.Response = self.session.post(f"{self.url}", json=messages)
+            self.metrics.count("sts_sent_bytes_total", len(response.request.body or b""), kind="emit")
+
+    def send_file_as(self, name: str, path: str, pt_num: int, ex_id: int) -> None:
+        """Sends a file from `path` to the STS server on behalf of instrument `name`"""
+        self._err_chk()
+        self.uploader.upload(path, pt_num, ex_id, name)
+
+    def queue_file_as(self, name: str, path: str, pt_num: int, ex_id: int) -> "Future[requests.Response]":
+        """Queues a file from `path` for background upload on behalf of instrument `name`,
+        a failed upload is recorded like in `queue_file()`"""
+        self._err_chk()
+        future: Future[requests.Response] = self.uploader.submit(path, pt_num, ex_id, name)
+        future.add_done_callback(self._upload_done)
+        return future
+
+    def _heartbeat(self) -> None:
+        """Sends the heartbeats of all instruments as one batch every `HEARTBEAT_INTERVAL`"""
+        if int(time.time()) - self.last_heartbeat > HEARTBEAT_INTERVAL:
+            self.emit_batch([
+                {"topic": "heartbeat", "body": {"name": instrument.name}}
+                for instrument in self.instruments
+            ])
+            self.last_heartbeat = int(time.time())
+
+    def _inform(self, _: dict[str, Any]):
+        """Responds to a ping from the server with the data of every instrument"""
+        self.emit_batch([
+            {"topic": "instrument_data", "body": instrument.instrument_data()}
+            for instrument in self.instruments
+        ])
+
+    def _measure(self, body: dict[str, Any]):
+        for instrument in self.instruments:
+            instrument.measure(body)
+
+    def _get_ref(self, body: dict[str, Any]):
+        for instrument in self.instruments:
+            instrument.reference(body)
+
+    def _move(self, body: dict[str, Any]):
+        pt: STSPoint = STSPoint(body['x'], body['y'], body['z'])
+        for instrument in self.instruments:
+            instrument.move(pt)
+
+    def _get_points(self, _: dict[str, Any]):
+        replies: list[dict[str, Any]] = []
+        for instrument in self.instruments:
+            pt: STSPoint | None = instrument.current_point()
+            if pt:
+                replies.append({"topic": "point_info", "body": {'x': pt.x, "y": pt.y, "z": pt.z}})
+        self.emit_batch(replies)
+
+    def _set_calibration(self, body: dict[str, Any]):
+        for instrument in self.instruments:
+            instrument.set_calibration(body)
+
+    def _set_local_calibration(self, body: dict[str, Any]):
+        for instrument in self.instruments:
+            instrument.set_local_calibration(body)
@@ -0,0 +1,239 @@
+"""Contains configure(), setting up non-blocking logging for the STS client modules"""
+import atexit
+import collections
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from types import TracebackType
+from typing import Any, Callable, TextIO
+
+from .sts_tracing import current_context
+
+
+PACKAGE: str = __name__.rpartition(".")[0]
+"""Logger of the package, parent of every module logger"""
+RATE_LIMIT: int = 20
+"""Records of one message (and topic) let through per `RATE_WINDOW`"""
+RATE_WINDOW: float = 10.0
+"""Seconds over which `RATE_LIMIT` applies"""
+HISTORY_SIZE: int = 2000
+"""Recent records kept for a crash dump"""
+CONSOLE_FORMAT: str = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+FIELDS: tuple[str, ...] = ("topic", "experimentId", "pointNumber")
+"""Extra record attributes written by `JsonFormatter`"""
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `limit` records of a message per `window` seconds.
+
+    Records are told apart by logger, message template and `topic` (passed in
+    `extra`), so one chatty topic does not silence the others. The first record
+    let through after some were dropped reports how many.
+    """
+
+    def __init__(self, limit: int = RATE_LIMIT, window: float = RATE_WINDOW) -> None:
+        super().__init__()
+        self.limit: int = limit
+        self.window: float = window
+        self._lock: threading.Lock = threading.Lock()
+        # key: [window start, records in the window, records dropped]
+        self._counts: dict[tuple[Any, ...], list[Any]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key: tuple[Any, ...] = (record.name, record.msg, getattr(record, "topic", None))
+        now: float = time.monotonic()
+        with self._lock:
+            count: list[Any] | None = self._counts.get(key)
+            if count is None or now - count[0] >= self.window:
+                dropped: int = 0 if count is None else count[2]
+                self._counts[key] = [now, 1, 0]
+                if dropped:
+                    record.msg = f"{record.msg} ({dropped} similar messages suppressed)"
+                return True
+            if count[1] >= self.limit:
+                count[2] += 1
+                return False
+            count[1] += 1
+            return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single line JSON objects, with the `FIELDS` they carry"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, formatting is left to the listener thread.
+    The last `history` records are also kept for a crash dump"""
+
+    def __init__(self, records: "queue.SimpleQueue[logging.LogRecord]", history: int) -> None:
+        super().__init__(records)
+        self.history: collections.deque[logging.LogRecord] = collections.deque(maxlen=history)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.history.append(record)
+        super().enqueue(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        context: Any = current_context()
+        if context is not None and not hasattr(record, "experimentId"):
+            record.experimentId = context.experiment_id
+            record.pointNumber = context.point_number
+        return record
+
+
+class STSLogging:
+    """Logging of the package loggers, as set up by `configure()`.
+
+    Records are put on a queue and written by a background thread, so logging only
+    costs the caller a level check, the rate limit and a queue put. The records
+    let through recently are also kept, and dumped when an exception is not caught.
+    """
+
+    def __init__(
+        self, handlers: list[logging.Handler], rate_limit: int, rate_window: float,
+        history: int, crash_path: str | None
+    ) -> None:
+        self.crash_path: str | None = crash_path
+        self._queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+        self._queue_handler: _QueueHandler = _QueueHandler(self._queue, history)
+        self._queue_handler.addFilter(RateLimitFilter(rate_limit, rate_window))
+        self.listener: logging.handlers.QueueListener = logging.handlers.QueueListener(
+            self._queue, *handlers, respect_handler_level=True
+        )
+        self._excepthook: Callable[..., None] = sys.excepthook
+        self._threading_excepthook: Callable[..., None] = threading.excepthook
+        self._running: bool = False
+
+    def install(self) -> None:
+        """Attaches the handlers to the package logger and starts the listener"""
+        package: logging.Logger = logging.getLogger(PACKAGE)
+        package.addHandler(self._queue_handler)
+        package.propagate = False
+        self.listener.start()
+        self._running = True
+        # the listener thread is a daemon, write what is queued before exiting
+        atexit.register(self.shutdown)
+        sys.excepthook = self._on_exception
+        threading.excepthook = self._on_thread_exception
+
+    def shutdown(self) -> None:
+        """Writes the queued records and detaches the handlers"""
+        package: logging.Logger = logging.getLogger(PACKAGE)
+        package.removeHandler(self._queue_handler)
+        package.propagate = True
+        if sys.excepthook == self._on_exception:
+            sys.excepthook = self._excepthook
+        if threading.excepthook == self._on_thread_exception:
+            threading.excepthook = self._threading_excepthook
+        if self._running:
+            self._running = False
+            atexit.unregister(self.shutdown)
+            self.listener.stop()
+
+    def dump_history(self, reason: str = "") -> None:
+        """Writes the recent records to `crash_path`, or stderr without one"""
+        records: list[logging.LogRecord] = list(self._queue_handler.history)
+        formatter: logging.Formatter = logging.Formatter(CONSOLE_FORMAT)
+        stream: TextIO = sys.stderr if self.crash_path is None else open(
+            self.crash_path, "a", encoding="utf-8"
+        )
+        try:
+            stream.write(f"--- last {len(records)} log records {reason}---\n")
+            for record in records:
+                try:
+                    stream.write(formatter.format(record) + "\n")
+                except Exception:  # pylint: disable = broad-exception-caught
+                    stream.write(f"{record.levelname} {record.name}: {record.msg!r} {record.args!r}\n")
+            stream.flush()
+        finally:
+            if stream is not sys.stderr:
+                stream.close()
+
+    def _crashed(
+        self, exc_type: type[BaseException], exc: BaseException | None,
+        traceback: TracebackType | None, where: str
+    ) -> None:
+        logging.getLogger(PACKAGE).critical(
+            "Uncaught exception in %s", where, exc_info=(exc_type, exc, traceback)
+        )
+        self.dump_history(f"before the crash in {where} ")
+
+    def _on_exception(
+        self, exc_type: type[BaseException], exc: BaseException, traceback: TracebackType | None
+    ) -> None:
+        if not issubclass(exc_type, KeyboardInterrupt):
+            self._crashed(exc_type, exc, traceback, threading.current_thread().name)
+        self._excepthook(exc_type, exc, traceback)
+
+    def _on_thread_exception(self, args: Any) -> None:
+        self._crashed(
+            args.exc_type, args.exc_value, args.exc_traceback,
+            args.thread.name if args.thread is not None else "a thread"
+        )
+        self._threading_excepthook(args)
+
+
+_installed: STSLogging | None = None
+
+
+def configure(
+    level: int = logging.INFO, levels: dict[str, int] | None = None,
+    path: str | None = None, handlers: list[logging.Handler] | None = None,
+    rate_limit: int = RATE_LIMIT, rate_window: float = RATE_WINDOW,
+    history: int = HISTORY_SIZE, crash_path: str | None = None
+) -> STSLogging:
+    """Sets up logging of the package modules, replacing an earlier configuration.
+
+    `level`: level of the package logger
+    `levels`: levels of single modules, e.g. `{"py3.prior_solis.serial_link": logging.DEBUG}`
+    `path`: also write JSON lines to this file
+    `handlers`: write to these instead of stderr and `path`
+    `rate_limit`, `rate_window`: see `RateLimitFilter`
+    `history`: records kept for a crash dump, written to `crash_path` or stderr
+    """
+    global _installed  # pylint: disable = global-statement
+    if _installed is not None:
+        _installed.shutdown()
+    if handlers is None:
+        console: logging.Handler = logging.StreamHandler(sys.stderr)
+        console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers = [console]
+        if path is not None:
+            file: logging.Handler = logging.FileHandler(path, encoding="utf-8")
+            file.setFormatter(JsonFormatter())
+            handlers.append(file)
+    logging.getLogger(PACKAGE).setLevel(level)
+    for name, module_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+    _installed = STSLogging(handlers, rate_limit, rate_window, history, crash_path)
+    _installed.install()
+    return _installed
+
+
+def shutdown() -> None:
+    """Writes the queued records and restores the default logging of the package"""
+    global _installed  # pylint: disable = global-statement
+    if _installed is not None:
+        _installed.shutdown()
+        _installed = None
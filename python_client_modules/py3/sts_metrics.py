@@ -0,0 +1,224 @@
+"""Contains STSMetrics, the counters, gauges and latency histograms of an STS client"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator
+
+
+LATENCY_BUCKETS: tuple[float, ...] = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+"""Upper bounds of the histogram buckets in seconds, from a local request to a long measurement"""
+DESCRIPTIONS: dict[str, str] = {
+    "sts_handler_wait_seconds": "Seconds from a message arriving at the client to its handler starting",
+    "sts_handler_latency_seconds": "Seconds from a message arriving at the client to its handler returning",
+    "sts_handler_errors_total": "Handlers that raised an exception",
+    "sts_handlers_pending": "Messages received but not yet handled",
+    "sts_emit_seconds": "Seconds to post a message to the server",
+    "sts_upload_seconds": "Seconds to upload a file, including retries",
+    "sts_upload_failures_total": "Uploads that failed after all retries",
+    "sts_polls_total": "Requests to /retrieve",
+    "sts_empty_polls_total": "Requests to /retrieve that returned no messages",
+    "sts_received_bytes_total": "Bytes of messages received from the server",
+    "sts_sent_bytes_total": "Bytes of messages and files sent to the server",
+    "sts_queue_lag": "Messages in the server's queue past the client's cursor when it last read it",
+}
+"""Help texts of the metrics recorded by STSClient, included in the Prometheus text"""
+
+_Labels = tuple[tuple[str, str], ...]
+
+
+class STSHistogram:
+    """Counts observations in buckets, like a Prometheus histogram.
+    Quantiles are estimated by interpolating within a bucket."""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets: tuple[float, ...] = buckets
+        """Observations per bucket, the last one counts those above all bounds"""
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        """Records a single observation"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimates the value below which a fraction `q` of the observations lies"""
+        rank: float = q * self.count
+        seen: int = 0
+        lower: float = 0.0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            if count and seen + count >= rank:
+                upper: float = min(bound, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.max
+
+    def to_dict(self) -> dict[str, float]:
+        """Returns the count, sum and estimated quantiles"""
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+def _series(name: str, labels: _Labels, extra: str = "") -> str:
+    """Formats a series name with its labels, as in the Prometheus text format"""
+    pairs: list[str] = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        pairs.append(extra)
+    return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class STSMetrics:
+    """Thread safe counters, gauges and histograms.
+
+    Every metric is identified by a name and optional labels, e.g.
+    `observe("sts_emit_seconds", 0.002, topic="ready")`. Read them with `snapshot()`,
+    or scrape them as Prometheus text from the endpoint started by `serve()`.
+    The metrics STSClient records are listed in `DESCRIPTIONS`.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets: tuple[float, ...] = buckets
+        self._lock: threading.Lock = threading.Lock()
+        self._counters: dict[tuple[str, _Labels], float] = {}
+        self._gauges: dict[tuple[str, _Labels], float] = {}
+        self._histograms: dict[tuple[str, _Labels], STSHistogram] = {}
+        self._server: ThreadingHTTPServer | None = None
+
+    def count(self, name: str, amount: float = 1, **labels: str) -> None:
+        """Increases a counter"""
+        key: tuple[str, _Labels] = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """Sets a gauge"""
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add(self, name: str, amount: float, **labels: str) -> None:
+        """Changes a gauge by `amount`"""
+        key: tuple[str, _Labels] = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Records an observation in a histogram, in seconds for latencies"""
+        key: tuple[str, _Labels] = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram: STSHistogram | None = self._histograms.get(key)
+            if histogram is None:
+                histogram = STSHistogram(self.buckets)
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """Observes the seconds spent in the `with` block, even if it raises"""
+        started: float = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns every metric by series name, e.g. `sts_emit_seconds{topic="ready"}`.
+        Histograms are summarized by `STSHistogram.to_dict`"""
+        with self._lock:
+            values: dict[str, Any] = {}
+            for (name, labels), value in self._counters.items():
+                values[_series(name, labels)] = value
+            for (name, labels), value in self._gauges.items():
+                values[_series(name, labels)] = value
+            for (name, labels), histogram in self._histograms.items():
+                values[_series(name, labels)] = histogram.to_dict()
+            return dict(sorted(values.items()))
+
+    def to_prometheus(self) -> str:
+        """Returns every metric in the Prometheus text exposition format"""
+        lines: list[str] = []
+        with self._lock:
+            for kind, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    self._header(lines, name, kind)
+                    for (series, labels), value in sorted(metrics.items()):
+                        if series == name:
+                            lines.append(f"{_series(name, labels)} {_number(value)}")
+            for name in sorted({name for name, _ in self._histograms}):
+                self._header(lines, name, "histogram")
+                for (series, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if series != name:
+                        continue
+                    cumulative: int = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        bucket: str = _series(name + "_bucket", labels, f'le="{bound}"')
+                        lines.append(f"{bucket} {cumulative}")
+                    bucket = _series(name + "_bucket", labels, 'le="+Inf"')
+                    lines.append(f"{bucket} {histogram.count}")
+                    lines.append(f"{_series(name + '_sum', labels)} {_number(histogram.sum)}")
+                    lines.append(f"{_series(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _header(lines: list[str], name: str, kind: str) -> None:
+        if name in DESCRIPTIONS:
+            lines.append(f"# HELP {name} {DESCRIPTIONS[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def serve(self, port: int = 9464, host: str = "127.0.0.1") -> int:
+        """Serves the metrics as Prometheus text at `http://host:port/metrics` on a
+        background thread, returns the port. Only local by default, as the endpoint
+        has no authentication"""
+        metrics: STSMetrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answers scrapes of /metrics"""
+
+            def log_message(self, *_: Any) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data: bytes = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.close()
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, name="STSMetrics", daemon=True
+        ).start()
+        return self._server.server_address[1]
+
+    def close(self) -> None:
+        """Stops the endpoint started by `serve()`, if any"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
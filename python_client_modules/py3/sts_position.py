@@ -0,0 +1,116 @@
+"""Contains PositionTracker, answering position requests without querying a busy stage"""
+from __future__ import annotations
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterator
+
+if TYPE_CHECKING:
+    from .sts_client import STSPoint
+
+
+MAX_POSITION_AGE: float = 1.0
+"""Seconds a confirmed position is answered from the cache"""
+
+
+class PositionTracker:
+    """Keeps the last commanded or confirmed position of a stage.
+
+    A position request (`point_info?`) is answered from the cache while the stage
+    is moving or busy with a measurement, or while the last confirmed position is
+    younger than `max_age` seconds. Only otherwise is the hardware queried, and
+    concurrent requests share a single query.
+    """
+
+    def __init__(self, max_age: float = MAX_POSITION_AGE) -> None:
+        self.max_age: float = max_age
+        self._lock: threading.Lock = threading.Lock()
+        self._query_lock: threading.Lock = threading.Lock()
+        self._point: STSPoint | None = None
+        self._updated: float = 0.0
+        self._moving: bool = False
+        self._busy: int = 0
+
+    @property
+    def point(self) -> STSPoint | None:
+        """The last known position, or the destination while the stage is moving"""
+        return self._point
+
+    @property
+    def moving(self) -> bool:
+        """Whether a commanded move has not finished yet"""
+        return self._moving
+
+    @property
+    def age(self) -> float:
+        """Seconds since the position was last commanded or confirmed"""
+        return time.monotonic() - self._updated
+
+    def answer_from_cache(self) -> bool:
+        """Whether a position request should be answered without querying the stage"""
+        with self._lock:
+            if self._moving or self._busy:
+                return True
+            return self._point is not None and time.monotonic() - self._updated < self.max_age
+
+    def commanded(self, point: STSPoint) -> None:
+        """Records that the stage was ordered to move to `point`"""
+        with self._lock:
+            self._point = point
+            self._moving = True
+            self._updated = time.monotonic()
+
+    def arrived(self) -> None:
+        """Records that the stage reached the commanded position"""
+        with self._lock:
+            self._moving = False
+            self._updated = time.monotonic()
+
+    def confirmed(self, point: STSPoint) -> None:
+        """Records a position read from the stage"""
+        with self._lock:
+            self._point = point
+            self._moving = False
+            self._updated = time.monotonic()
+
+    def invalidate(self) -> None:
+        """Forgets the position, e.g. after a failed move"""
+        with self._lock:
+            self._point = None
+            self._moving = False
+
+    @contextmanager
+    def busy(self) -> Iterator[None]:
+        """Answers position requests from the cache while the stage is in use,
+        e.g. during an acquisition"""
+        with self._lock:
+            self._busy += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._busy -= 1
+
+    @contextmanager
+    def moving_to(self, point: STSPoint) -> Iterator[None]:
+        """Tracks a move to `point` that completes when the block exits"""
+        self.commanded(point)
+        try:
+            yield
+        except BaseException:
+            self.invalidate()
+            raise
+        self.arrived()
+
+    def get(self, query: Callable[[], STSPoint | None]) -> STSPoint | None:
+        """Returns the cached position if it may be used, otherwise `query()`s the stage"""
+        if self.answer_from_cache():
+            return self._point
+        with self._query_lock:
+            # another request may have queried while this one waited
+            if self.answer_from_cache():
+                return self._point
+            point: STSPoint | None = query()
+            if point is not None:
+                self.confirmed(point)
+            return point
@@ -0,0 +1,144 @@
+"""Contains STSSession, a pooled keep-alive HTTP session used by STSClient for all server I/O"""
+import threading
+from typing import Any
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+DEFAULT_CONNECT_TIMEOUT: float = 3.05
+"""Seconds to wait for a TCP connection to the server"""
+DEFAULT_READ_TIMEOUT: float = 30
+"""Seconds to wait for the server to respond once connected"""
+
+
+class STSConnectionStats:
+    """Thread safe counters of requests sent and connections opened by an STSSession"""
+
+    def __init__(self) -> None:
+        self._lock: threading.Lock = threading.Lock()
+        self.requests: int = 0
+        self.connections_opened: int = 0
+
+    def count_request(self) -> None:
+        """Counts a request sent through the session"""
+        with self._lock:
+            self.requests += 1
+
+    def count_connection(self) -> None:
+        """Counts a new TCP connection opened by the pool"""
+        with self._lock:
+            self.connections_opened += 1
+
+    @property
+    def connections_reused(self) -> int:
+        """Requests that were sent over an already open connection"""
+        with self._lock:
+            return max(self.requests - self.connections_opened, 0)
+
+    def to_dict(self) -> dict[str, int]:
+        """Returns a snapshot of the counters"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "connections_reused": max(self.requests - self.connections_opened, 0),
+            }
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report every connection they open"""
+
+    def __init__(self, stats: STSConnectionStats, **kwargs: Any) -> None:
+        # set before super().__init__, which creates the pool manager
+        self._stats: STSConnectionStats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        stats: STSConnectionStats = self._stats
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            """HTTPConnectionPool counting opened connections"""
+            def _new_conn(self) -> Any:
+                stats.count_connection()
+                return super()._new_conn()
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            """HTTPSConnectionPool counting opened connections"""
+            def _new_conn(self) -> Any:
+                stats.count_connection()
+                return super()._new_conn()
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request: requests.PreparedRequest, *args: Any, **kwargs: Any) -> requests.Response:
+        self._stats.count_request()
+        return super().send(request, *args, **kwargs)
+
+
+class STSSession:
+    """A keep-alive HTTP session with a bounded connection pool, retries and sane timeouts.
+
+    Connection failures are retried for every method, as the request never reached
+    the server. Failed responses (`retry_statuses`) are only retried for idempotent
+    methods, so a POSTed message is never duplicated in the queue.
+
+    Any object implementing `get`, `post`, `head` and `close` with the signatures of
+    `requests.Session` can be passed to STSClient in place of this class.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 4,
+        retries: int = 3,
+        backoff: float = 0.2,
+        retry_statuses: tuple[int, ...] = (502, 503, 504),
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+    ) -> None:
+        self.stats: STSConnectionStats = STSConnectionStats()
+        self.timeout: tuple[float, float] = (connect_timeout, read_timeout)
+        retry: Retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=retry_statuses,
+            raise_on_status=False,
+        )
+        adapter: _CountingAdapter = _CountingAdapter(
+            self.stats, pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self._session: requests.Session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        """Sends a request, using the session timeouts unless `timeout` is given"""
+        kwargs.setdefault("timeout", self.timeout)
+        return self._session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        """Sends a GET request through the pool"""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        """Sends a POST request through the pool"""
+        return self.request("POST", url, **kwargs)
+
+    def head(self, url: str, **kwargs: Any) -> requests.Response:
+        """Sends a HEAD request through the pool"""
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self) -> None:
+        """Closes all pooled connections"""
+        self._session.close()
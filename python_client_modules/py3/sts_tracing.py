@@ -0,0 +1,170 @@
+"""Contains Tracer, recording timed spans of each measured point to a trace file"""
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from enum import Enum
+from typing import Any, Iterator, TextIO
+
+
+class TraceFormat(Enum):
+    """File formats a Tracer can write"""
+
+    JSONL = 1
+    """One JSON object per span and line"""
+    CHROME = 2
+    """Chrome trace event format, opens in Perfetto or chrome://tracing"""
+
+
+class TraceContext:
+    """Identifies the point a span belongs to"""
+    __slots__ = ("experiment_id", "point_number")
+
+    def __init__(self, experiment_id: int, point_number: int) -> None:
+        self.experiment_id: int = experiment_id
+        self.point_number: int = point_number
+
+    @property
+    def trace_id(self) -> str:
+        """Id shared by all spans of the point"""
+        return f"{self.experiment_id}:{self.point_number}"
+
+
+_context: contextvars.ContextVar[TraceContext | None] = contextvars.ContextVar("sts_trace", default=None)
+_parent: contextvars.ContextVar[int | None] = contextvars.ContextVar("sts_span", default=None)
+
+
+class Tracer:
+    """Records spans, timed phases of a point such as a move or an upload.
+
+    `point()` sets the trace context for the spans inside it, on the same thread
+    or asyncio task. Work handed to another thread keeps the context if it is run
+    in a copy of it, see `contextvars.copy_context()`.
+    Spans are appended to `path` as soon as they end, so a trace survives a crash.
+    Without a `path` nothing is recorded and spans cost next to nothing.
+    """
+
+    def __init__(self, path: str | None = None, trace_format: TraceFormat = TraceFormat.JSONL) -> None:
+        self.path: str | None = path
+        self.format: TraceFormat = trace_format
+        self._lock: threading.Lock = threading.Lock()
+        self._ids: Iterator[int] = itertools.count(1)
+        self._file: TextIO | None = None
+        self._named_threads: set[int | None] = set()
+        if path is not None:
+            new: bool = not os.path.exists(path) or os.path.getsize(path) == 0
+            # line buffered, every span reaches the file when it ends
+            self._file = open(path, "a", buffering=1, encoding="utf-8")
+            if new and trace_format == TraceFormat.CHROME:
+                # the closing bracket may be omitted, which keeps the file appendable
+                self._file.write("[\n")
+
+    @property
+    def enabled(self) -> bool:
+        """Whether spans are recorded"""
+        return self._file is not None
+
+    @contextmanager
+    def point(self, experiment_id: int, point_number: int) -> Iterator[TraceContext]:
+        """Sets the trace context of the spans in the `with` block"""
+        context: TraceContext = TraceContext(experiment_id, point_number)
+        token: contextvars.Token[TraceContext | None] = _context.set(context)
+        try:
+            yield context
+        finally:
+            _context.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[None]:
+        """Records the `with` block as a span of the current point.
+        A span raising an exception records it as `error`"""
+        if self._file is None:
+            yield
+            return
+        span_id: int = next(self._ids)
+        token: contextvars.Token[int | None] = _parent.set(span_id)
+        error: BaseException | None = None
+        started: float = time.time()
+        start_counter: float = time.perf_counter()
+        try:
+            yield
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            duration: float = time.perf_counter() - start_counter
+            _parent.reset(token)
+            if error is not None:
+                attributes["error"] = repr(error)
+            self._write(name, span_id, _parent.get(), started, duration, attributes)
+
+    def _write(
+        self, name: str, span_id: int, parent: int | None, started: float, duration: float,
+        attributes: dict[str, Any]
+    ) -> None:
+        context: TraceContext | None = _context.get()
+        thread: threading.Thread = threading.current_thread()
+        if self.format == TraceFormat.CHROME:
+            args: dict[str, Any] = dict(attributes)
+            if context is not None:
+                args["experimentId"] = context.experiment_id
+                args["pointNumber"] = context.point_number
+            record: dict[str, Any] = {
+                "name": name, "cat": "sts", "ph": "X",
+                "ts": started * 1e6, "dur": duration * 1e6,
+                "pid": os.getpid(), "tid": thread.ident, "args": args,
+            }
+            line: str = json.dumps(record, default=str) + ",\n"
+        else:
+            record = {
+                "name": name, "id": span_id, "parent": parent,
+                "trace": None if context is None else context.trace_id,
+                "experimentId": None if context is None else context.experiment_id,
+                "pointNumber": None if context is None else context.point_number,
+                "start": started, "duration": duration, "thread": thread.name,
+                "attributes": attributes,
+            }
+            line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                return
+            if self.format == TraceFormat.CHROME and thread.ident not in self._named_threads:
+                # names the thread's track in the viewer
+                self._named_threads.add(thread.ident)
+                self._file.write(json.dumps({
+                    "name": "thread_name", "ph": "M", "pid": os.getpid(),
+                    "tid": thread.ident, "args": {"name": thread.name},
+                }) + ",\n")
+            self._file.write(line)
+
+    def close(self) -> None:
+        """Stops recording and closes the file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def current_context() -> TraceContext | None:
+    """Returns the trace context set by `Tracer.point()`, if any"""
+    return _context.get()
+
+
+_tracer: Tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """Returns the tracer spans are recorded with, one recording nothing by default"""
+    return _tracer
+
+
+def set_tracer(tracer: Tracer | None) -> Tracer:
+    """Records all following spans with `tracer`, or nothing if None.
+    Returns the previous tracer, which is not closed"""
+    global _tracer  # pylint: disable = global-statement
+    previous: Tracer = _tracer
+    _tracer = tracer if tracer is not None else Tracer()
+    return previous
@@ -0,0 +1,179 @@
+"""Contains STSUploader, streaming measurement files to the STS server in the background"""
+import contextvars
+import os
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator
+import requests
+
+from .sts_metrics import STSMetrics
+from .sts_session import STSSession
+from .sts_tracing import get_tracer
+
+
+UPLOAD_PATH: str = "/measurements/upload"
+"""Route of the server's measurement upload handler"""
+CHUNK_SIZE: int = 64 * 1024
+"""Bytes read from disk per chunk of a streamed upload"""
+
+
+class STSUploadError(Exception):
+    """Raised when the server rejects an upload or all retries have failed"""
+
+
+class _MultipartStream:
+    """A file-like multipart/form-data body that reads the file from disk in chunks.
+
+    Its length is known up front, so it is sent with a Content-Length header
+    and never held in memory as a whole.
+    """
+
+    def __init__(self, path: str, fields: dict[str, str]) -> None:
+        self.boundary: str = uuid.uuid4().hex
+        head: list[bytes] = []
+        for key, value in fields.items():
+            head.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'
+                f"{value}\r\n".encode("utf-8")
+            )
+        filename: str = os.path.basename(path)
+        head.append(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="file"; '
+            f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+            .encode("utf-8")
+        )
+        self._parts: list[bytes | str] = [b"".join(head), path, f"\r\n--{self.boundary}--\r\n".encode()]
+        self._length: int = len(self._parts[0]) + os.path.getsize(path) + len(self._parts[2])
+        self._chunks: Iterator[bytes] = self._iter_chunks()
+        self._buffer: bytes = b""
+
+    @property
+    def content_type(self) -> str:
+        """The Content-Type header value of the body"""
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return self._length
+
+    def _iter_chunks(self) -> Iterator[bytes]:
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, "rb") as file:
+                while chunk := file.read(CHUNK_SIZE):
+                    yield chunk
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads up to `size` bytes of the body, or the rest of it if `size` is negative"""
+        while size < 0 or len(self._buffer) < size:
+            chunk: bytes | None = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data: bytes = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+
+class STSUploader:
+    """Uploads measurement files to the STS server on a pool of background threads.
+
+    Files are streamed from disk. Each upload carries an idempotency key
+    (`uploadId`), so retrying after a lost response never records a measurement twice.
+    Failed uploads are retried `retries` times with exponential backoff, except
+    when the server rejects the request (4xx).
+
+    Upload times, bytes and failures are recorded in `metrics`, and every upload
+    is traced as an `upload` span of the point it was submitted for.
+    """
+
+    def __init__(
+        self, session: STSSession, url: str,
+        max_concurrent: int = 2, retries: int = 3, backoff: float = 0.5,
+        metrics: STSMetrics | None = None
+    ) -> None:
+        self.session: STSSession = session
+        self.url: str = url
+        self.metrics: STSMetrics = metrics if metrics is not None else STSMetrics()
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self._pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=max_concurrent, thread_name_prefix="STSUploader"
+        )
+        self._pending: set[Future[requests.Response]] = set()
+
+    def upload(self, path: str, pt_num: int, ex_id: int, name: str) -> requests.Response:
+        """Uploads the file at `path`, blocking until it is accepted by the server"""
+        try:
+            with get_tracer().span("upload", file=os.path.basename(path)), \
+                    self.metrics.timer("sts_upload_seconds"):
+                return self._upload(path, pt_num, ex_id, name)
+        except Exception:
+            self.metrics.count("sts_upload_failures_total")
+            raise
+
+    def _upload(self, path: str, pt_num: int, ex_id: int, name: str) -> requests.Response:
+        upload_id: str = uuid.uuid4().hex
+        attempt: int = 0
+        while True:
+            body: _MultipartStream = _MultipartStream(path, {
+                "name": name,
+                "pointNumber": str(pt_num),
+                "experimentId": str(ex_id),
+                "uploadId": upload_id,
+            })
+            try:
+                response: requests.Response = self.session.post(
+                    self.url + UPLOAD_PATH,
+                    data=body,
+                    headers={"Content-Type": body.content_type, "Idempotency-Key": upload_id},
+                )
+                if response.ok:
+                    self.metrics.count("sts_sent_bytes_total", len(body), kind="upload")
+                    return response
+                if response.status_code < 500:
+                    raise STSUploadError(
+                        f"Upload of {path} rejected ({response.status_code}): {response.text}"
+                    )
+                error: Exception = STSUploadError(
+                    f"Upload of {path} failed ({response.status_code})"
+                )
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = exc
+            attempt += 1
+            if attempt > self.retries:
+                raise STSUploadError(f"Upload of {path} failed after {attempt} attempts") from error
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def submit(self, path: str, pt_num: int, ex_id: int, name: str) -> "Future[requests.Response]":
+        """Queues the file at `path` for upload, returning a future of the server response"""
+        # run in a copy of the caller's context, so the upload joins its trace
+        future: Future[requests.Response] = self._pool.submit(
+            contextvars.copy_context().run, self.upload, path, pt_num, ex_id, name
+        )
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    def flush(self, timeout: float | None = None) -> None:
+        """Blocks until all queued uploads have finished"""
+        deadline: float | None = None if timeout is None else time.monotonic() + timeout
+        for future in list(self._pending):
+            remaining: float | None = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                future.result(remaining)
+            except STSUploadError:
+                # reported through the future
+                pass
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops accepting uploads, finishing the queued ones if `wait`"""
+        self._pool.shutdown(wait=wait)
+
+    def pending(self) -> int:
+        """Returns the number of queued or running uploads"""
+        return len(self._pending)
@@ -0,0 +1,171 @@
+"""Tests of how the clients follow the message queue, against the stand-in QueueServer"""
+from typing import Any, Callable, Iterator
+
+import threading
+import time
+
+import pytest
+
+from py3.debugging.queue_server import QueueServer
+from py3 import sts_client
+from py3.sts_client import STSClient, STSTransport
+
+TOPIC: str = "test"
+TIMEOUT: float = 5.0
+"""Seconds a test waits for the client"""
+LONG_POLL_WAIT: float = 2.0
+"""Seconds a long poll is held in the tests, so stopping a client does not take long"""
+
+
+class _Received:
+    """Handler collecting the `index` of every message it is called with"""
+
+    def __init__(self) -> None:
+        self.indices: list[int] = []
+        self._lock: threading.Lock = threading.Lock()
+
+    def __call__(self, body: dict[str, Any]) -> None:
+        with self._lock:
+            self.indices.append(int(body["index"]))
+
+    def wait_for(self, count: int, timeout: float = TIMEOUT) -> list[int]:
+        """Waits until `count` messages were received, returns their indices"""
+        deadline: float = time.monotonic() + timeout
+        while len(self.indices) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with self._lock:
+            return list(self.indices)
+
+
+def _wait(predicate: Callable[[], bool], timeout: float = TIMEOUT) -> bool:
+    deadline: float = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture(autouse=True)
+def _short_long_polls(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(sts_client, "LONG_POLL_WAIT", LONG_POLL_WAIT)
+
+
+@pytest.fixture(name="server")
+def _server() -> Iterator[QueueServer]:
+    with QueueServer() as server:
+        yield server
+
+
+@pytest.mark.parametrize("transport", list(STSTransport))
+def test_clear_starts_over(server: QueueServer, transport: STSTransport) -> None:
+    """Messages of the new epoch are received after the queue is cleared, none are lost"""
+    received: _Received = _Received()
+    with STSClient(server.url, False, 1, "TEST", False, transport=transport) as client:
+        client.on(TOPIC, received)
+        for index in range(3):
+            server.post(TOPIC, {"index": index})
+        assert received.wait_for(3) == [0, 1, 2]
+        server.clear()
+        # fewer messages than before, so the new ids lie behind the cursor
+        server.post(TOPIC, {"index": 3})
+        assert received.wait_for(4) == [0, 1, 2, 3]
+        assert client.cursor.resets == 1
+        assert client.cursor.epoch == server.epoch
+
+
+def test_epoch_change_before_the_next_poll(server: QueueServer) -> None:
+    """A clear between two polls is noticed by the epoch alone, with the ids past the cursor"""
+    received: _Received = _Received()
+    gaps: list[int] = []
+    client: STSClient = STSClient(server.url, False, 1, "TEST", False)
+    client.on(TOPIC, received)
+    client.ongap = gaps.append
+    server.post(TOPIC, {"index": 0})
+    assert client._poll() == 1  # pylint: disable = protected-access
+    server.clear()
+    for index in range(1, 4):
+        server.post(TOPIC, {"index": index})
+    # the response is for the old cursor, the client rewinds and reads the new queue
+    assert client._poll() == 0  # pylint: disable = protected-access
+    assert client._poll() == 3  # pylint: disable = protected-access
+    assert received.indices == [0, 1, 2, 3]
+    assert client.cursor.resets == 1
+    assert not gaps
+
+
+def test_trim_reports_the_gap(server: QueueServer) -> None:
+    """Messages trimmed before they were read are reported to `ongap` and counted as lost"""
+    received: _Received = _Received()
+    gaps: list[int] = []
+    client: STSClient = STSClient(server.url, False, 1, "TEST", False)
+    client.on(TOPIC, received)
+    client.ongap = gaps.append
+    for index in range(10):
+        server.post(TOPIC, {"index": index})
+    server.trim(4)
+    with client:
+        assert received.wait_for(4) == [6, 7, 8, 9]
+    assert gaps == [6]
+    assert client.cursor.lost == 6
+    assert client.cursor.resets == 0
+
+
+def test_subscribe_during_long_poll(server: QueueServer) -> None:
+    """A topic bound while a long poll is held receives its messages without waiting it out"""
+    received: _Received = _Received()
+    with STSClient(server.url, False, 1, "TEST", False, transport=STSTransport.LONG_POLL) as client:
+        requests: int = server.requests
+        # the client holds a long poll once the server stops seeing new requests
+        assert _wait(lambda: server.requests > requests)
+        time.sleep(0.2)
+        client.on(TOPIC, received)
+        started: float = time.monotonic()
+        server.post(TOPIC, {"index": 0})
+        assert received.wait_for(1) == [0]
+        # not held up until the poll in flight expires
+        assert time.monotonic() - started < LONG_POLL_WAIT / 2
+
+
+def test_long_poll_ignores_unbound_topics(server: QueueServer) -> None:
+    """Messages of topics the client did not bind, such as its own emits, leave the long poll held"""
+    received: _Received = _Received()
+    with STSClient(server.url, False, 1, "TEST", False, transport=STSTransport.LONG_POLL) as client:
+        client.on(TOPIC, received)
+        requests: int = server.requests
+        assert _wait(lambda: server.requests > requests)
+        time.sleep(0.2)
+        requests = server.requests
+        for index in range(5):
+            client.emit("other", {"index": index})
+        time.sleep(0.2)
+        # only the emits reached the server, no poll was answered and resent
+        assert server.requests == requests + 5
+        server.post(TOPIC, {"index": 0})
+        assert received.wait_for(1) == [0]
+
+
+def test_websocket_delivers_once(server: QueueServer) -> None:
+    """Messages posted while the socket connects are received exactly once"""
+    received: _Received = _Received()
+    client: STSClient = STSClient(server.url, False, 1, "TEST", False, transport=STSTransport.WEBSOCKET)
+    client.on(TOPIC, received)
+    stop: threading.Event = threading.Event()
+
+    def post() -> None:
+        index: int = 0
+        while not stop.is_set() and index < 200:
+            server.post(TOPIC, {"index": index})
+            index += 1
+            time.sleep(0.001)
+
+    poster: threading.Thread = threading.Thread(target=post)
+    poster.start()
+    with client:
+        poster.join()
+        indices: list[int] = received.wait_for(200)
+        # late duplicates would arrive after the last message
+        time.sleep(0.2)
+    stop.set()
+    assert received.indices == list(range(200))
+    assert indices == list(range(200))
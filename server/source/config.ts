@@ -46,6 +46,8 @@ export const messageQueue = {
 	maxQueueSize: Number(process.env.STS_MQ_MAX_QUEUE_SIZE ?? config.messageQueue.maxQueueSize ?? 15000),
 	/// A factor of the maxQueueSize to trim the queue to when it overflows
 	queueOverflowTrim: Number(process.env.STS_MQ_QUEUE_OVERFLOW_TRIM ?? config.messageQueue.queueOverflowTrim ?? 0.33),
+	/// The longest time in milliseconds a /retrieve request may wait for new messages
+	maxRetrieveWait: Number(process.env.STS_MQ_MAX_RETRIEVE_WAIT ?? config.messageQueue.maxRetrieveWait ?? 30_000),
 };
 
 export const heartbeatTimeout = Number(process.env.STS_HEARTBEAT_TIMEOUT ?? 60*1000);
@@ -1,6 +1,7 @@
 import assert from "node:assert";
 import { test } from "node:test";
 import type { JSONValue } from "../config.js";
+import { messageQueue as config } from "../config.js";
 import { MessageQueue, TopicMessage } from "./messageQueue.js";
 import { HaltExperimentMessage, ReadyMessage, UncalibratedMessage, isHaltExperimentMessage, isInstrumentData, isReadyMessage, isUncalibratedMessage } from "./messageQueueMessages.js";
 
@@ -93,6 +94,103 @@ test('MessageQueue', async (tctx) => {
 		queue.clear();
 		assert.deepStrictEqual([...queue.messagesSinceId(0, 'all')], []);
 	});
+
+	await tctx.test('Queue wait', {timeout: 1000}, async (tctx) => {
+		await tctx.test('returns existing messages at once', async () => {
+			const queue = new MessageQueue();
+			queue.addMessage('testA', {x:3});
+			const start = Date.now();
+			assert.deepStrictEqual(
+				await queue.waitForMessages(0, 'testA', 500),
+				[{topic:'testA', body: {x:3}}]);
+			assert(Date.now() - start < 100);
+		});
+
+		await tctx.test('resolves on a matching message', async () => {
+			const queue = new MessageQueue();
+			queue.addMessage('testA', {x:3});
+			const promise = queue.waitForMessages(1, ['testA'], 500);
+			setTimeout(() => queue.addMessage('testB', {u:'asd'}), 10);
+			setTimeout(() => queue.addMessage('testA', {x:4}), 20);
+			assert.deepStrictEqual(await promise, [{topic:'testA', body: {x:4}}]);
+		});
+
+		await tctx.test('resolves empty on timeout', async () => {
+			const queue = new MessageQueue();
+			const start = Date.now();
+			setTimeout(() => queue.addMessage('testB', {u:'asd'}), 10);
+			assert.deepStrictEqual(await queue.waitForMessages(0, 'testA', 50), []);
+			assert(Date.now() - start >= 50);
+		});
+
+		await tctx.test('removes its callback on timeout', async () => {
+			const queue = new MessageQueue();
+			await queue.waitForMessages(0, 'testA', 10);
+			await queue.waitForMessages(0, 'testA', 10);
+			assert.strictEqual(queue['onMessageCallbacks'].length, 0);
+		});
+
+		await tctx.test('resolves at once past the end of the queue', async () => {
+			const queue = new MessageQueue();
+			const start = Date.now();
+			assert.deepStrictEqual(await queue.waitForMessages(5, 'all', 500), []);
+			assert(Date.now() - start < 100);
+		});
+	});
+
+	await tctx.test('Queue overflow keeps the newest messages', () => {
+		const queue = new MessageQueue();
+		for(let i = 0; i <= config.maxQueueSize; i++){
+			queue.addMessage('x', {i});
+		}
+		const kept = Math.floor(config.maxQueueSize * config.queueOverflowTrim);
+		assert.strictEqual(queue.getId(), config.maxQueueSize + 1);
+		assert.strictEqual(queue.firstId, config.maxQueueSize + 1 - kept);
+		const messages = [...queue.messagesSinceId(0, 'all')];
+		assert.strictEqual(messages.length, kept);
+		assert.deepStrictEqual(messages[kept - 1], {topic:'x', body: {i: config.maxQueueSize}});
+		// ids of the kept messages do not change
+		assert.deepStrictEqual(
+			[...queue.messagesSinceId(config.maxQueueSize, 'all')],
+			[{topic:'x', body: {i: config.maxQueueSize}}]);
+	});
+
+	await tctx.test('Queue epoch changes on clear', () => {
+		const queue = new MessageQueue();
+		const epoch = queue.epoch;
+		queue.addMessage('testA', {x:3});
+		assert.strictEqual(queue.epoch, epoch);
+		queue.clear();
+		queue.clear();
+		assert(queue.epoch > epoch + 1);
+		assert.strictEqual(queue.getId(), 0);
+		assert.strictEqual(queue.firstId, 0);
+	});
+
+	await tctx.test('Async generator continues after a clear', async () => {
+		const queue = new MessageQueue();
+		queue.addMessage('x', 'x');
+		queue.addMessage('y', 'y');
+		const generator = queue.messagesSinceIdAsync(2, 'all');
+		queue.clear();
+		const promise = generator.next();
+		queue.addMessage('z', 'z');
+		assert.deepStrictEqual((await promise).value, {topic:'z', body: 'z'});
+	});
+
+	await tctx.test('Async entries carry the message id and epoch', async () => {
+		const queue = new MessageQueue();
+		queue.addMessage('x', 'x');
+		queue.addMessage('y', 'y');
+		const generator = queue.entriesSinceIdAsync(1, 'all');
+		assert.deepStrictEqual((await generator.next()).value,
+			{id: 1, epoch: queue.epoch, message: {topic:'y', body: 'y'}});
+		queue.clear();
+		const promise = generator.next();
+		queue.addMessage('z', 'z');
+		assert.deepStrictEqual((await promise).value,
+			{id: 0, epoch: queue.epoch, message: {topic:'z', body: 'z'}});
+	});
 });
 
 test('IsInstrumentData test', async (tctx) => {
@@ -9,13 +9,28 @@ import { messageQueue as config } from '../config.js';
 
 
 /**
- * Response to a queue request
+ * Response to a queue request.
+ * Ids count messages since the queue was last cleared, `epoch` changes
+ * whenever it is cleared. `firstId` is the oldest message still stored,
+ * older ones were trimmed. Clients compare both with their cursor to
+ * detect a reset or lost messages.
  */
 export type QueueResponse = {
 	"latestId":number;
+	"epoch"?:number;
+	"firstId"?:number;
 	"messages":Message[];
 };
 
+/**
+ * A message with its id and the epoch of the queue it was stored in
+ */
+export type QueueEntry = {
+	"id":number;
+	"epoch":number;
+	"message":Message;
+};
+
 /**
  * A message to be sent to the queue
  * Contains a topic and a JSON object
@@ -139,6 +154,15 @@ export class MessageQueue{
 	 * The queue of messages
 	 */
 	private queue:TopicMessage[];
+	/**
+	 * The id of the first message in the queue,
+	 * counts the messages trimmed since the last clear
+	 */
+	private baseId: number;
+	/**
+	 * Identifies the current contents of the queue, changes on every clear
+	 */
+	private _epoch: number;
 	/**
 	 * The last time the queue was accessed
 	 */
@@ -162,9 +186,32 @@ export class MessageQueue{
 	constructor(resetTime: number = defaultTimeout){
 		this.timeout = resetTime;
 		this.queue=[];
+		this.baseId=0;
+		this._epoch=Date.now();
 		this._lastAccess=Date.now();
 		this.lastPoint={x:0,y:0,z:0};
 	}
+
+	/**
+	 * A getter for the epoch of the queue, which changes when the queue is cleared
+	 */
+	public get epoch() : number {
+		return this._epoch;
+	}
+
+	/**
+	 * The id of the oldest message still stored in the queue
+	 */
+	public get firstId() : number {
+		return this.baseId;
+	}
+
+	/**
+	 * The id the next message will get, without updating the access time
+	 */
+	private get endId() : number {
+		return this.baseId + this.queue.length;
+	}
 	
 	/**
 	 * A getter for the lastAccess property
@@ -234,10 +281,13 @@ export class MessageQueue{
 	}
 
 	/**
-	 * Clears the queue
+	 * Clears the queue, starting a new epoch
 	 */
 	clear(){
 		this.queue=[];
+		this.baseId=0;
+		// strictly increasing, even for clears within the same millisecond
+		this._epoch=Math.max(Date.now(), this._epoch+1);
 	}
 
 	/**
@@ -246,7 +296,7 @@ export class MessageQueue{
 	 */
 	getId(): number{
 		this.timeUpdate();
-		return this.queue.length;
+		return this.endId;
 	}
 
 	getStream(filter: string[] | string = 'all'): MessageQueueStream {
@@ -266,10 +316,12 @@ export class MessageQueue{
 		if(typeof topics=='string'){
 			topics=[topics];
 		}
-		for(let it=id;it<this.queue.length;it++){
-			if(topics.includes("all") || topics.includes(this.queue[it].topic)){
+		// trimmed messages are skipped
+		for(let it=Math.max(id, this.baseId);it<this.endId;it++){
+			const message = this.queue[it-this.baseId];
+			if(topics.includes("all") || topics.includes(message.topic)){
 				this.timeUpdate();
-				yield this.queue[it].data;
+				yield message.data;
 			}
 		}
 		return this.getId();
@@ -286,26 +338,88 @@ export class MessageQueue{
 	 * 
 	 */
 	async *messagesSinceIdAsync(id:number, topics:string[] | string): AsyncGenerator<Message, never> {
+		const entries = this.entriesSinceIdAsync(id, topics);
+		while(true) {
+			yield (await entries.next()).value.message;
+		}
+	}
+
+	/**
+	 * Like messagesSinceIdAsync, but also yields the id and epoch of each
+	 * message, so a client streaming them can keep its cursor in step
+	 * with the queue
+	 * @param id
+	 * the id of the last received message
+	 * @param topics
+	 * a list of topics
+	 */
+	async *entriesSinceIdAsync(id:number, topics:string[] | string): AsyncGenerator<QueueEntry, never> {
 		if(typeof topics=='string'){
 			topics=[topics];
 		} else if (typeof topics == 'undefined') {
 			topics = ['all'];
 		}
 		let index = id;
+		let epoch = this._epoch;
 		while(true) {
-			if(index >= this.queue.length) {
+			if(epoch !== this._epoch || index > this.endId) {
+				// the queue was cleared, possibly before the generator started,
+				// continue with its new messages
+				epoch = this._epoch;
+				index = this.baseId;
+			}
+			// trimmed messages are skipped
+			index = Math.max(index, this.baseId);
+			if(index >= this.endId) {
 				// push a callback to the onMessageCallbacks array and wait for it to be called upon receiving a message
 				await new Promise((resolve) => { this.onMessageCallbacks.push(()=>{ resolve(undefined); }); });
 				continue;
 			}
-			if(topics.includes("all") || topics.includes(this.queue[index].topic)){
+			const message = this.queue[index-this.baseId];
+			if(topics.includes("all") || topics.includes(message.topic)){
 				this.timeUpdate();
-				yield this.queue[index].data;
+				yield {id: index, epoch: epoch, message: message.data};
 			}
 			index++;
 		}
 	}
 
+	/**
+	 * Retrieves messages since the given id, waiting up to `timeout`
+	 * milliseconds for a matching message if there is none yet.
+	 * Resolves as soon as a matching message is added, or with an empty
+	 * array once the timeout expires.
+	 * Also resolves at once if the id is past the end of the queue,
+	 * so a client whose queue was cleared can catch up.
+	 * @param id
+	 * the id of the last received message
+	 * @param topics
+	 * a list of topics
+	 * @param timeout
+	 * the longest time to wait in milliseconds
+	 */
+	async waitForMessages(id:number, topics:string[] | string, timeout:number): Promise<Message[]> {
+		const deadline = Date.now() + timeout;
+		while(true) {
+			const messages: Message[] = [...this.messagesSinceId(id, topics)];
+			const remaining = deadline - Date.now();
+			if(messages.length > 0 || id > this.endId || remaining <= 0) {
+				return messages;
+			}
+			// only messages added after the check can match
+			id = this.endId;
+			await new Promise((resolve) => {
+				const wake = ()=>{ clearTimeout(timer); resolve(undefined); };
+				const timer = setTimeout(() => {
+					// a waiter left behind would pile up while the queue is idle
+					this.onMessageCallbacks = this.onMessageCallbacks.filter((callback) => callback !== wake);
+					resolve(undefined);
+				}, remaining);
+				this.onMessageCallbacks.push(wake);
+			});
+		}
+	}
+
 	/**
 	 * Pushes a message to the queue with topic+body
 	 * @param topic The topic of the message
@@ -321,10 +435,12 @@ export class MessageQueue{
 				this.lastPoint=body;
 			}
 		}
-		// TODO: Add tests for this
 		this.queue.push(message);
 		if(this.queue.length>maxQueueSize){
-			this.queue = this.queue.splice(0,queueOverflowTrimSize);
+			// drop the oldest messages, the ids of the kept ones do not change
+			const trimmed = this.queue.length-queueOverflowTrimSize;
+			this.queue.splice(0,trimmed);
+			this.baseId+=trimmed;
 		}
 	}
 
@@ -4,9 +4,15 @@ import multer from "multer";
 import { Experiment, Measurement, Point, Pointset } from "../models/index.js";
 
 import path from "path";
+import fs from "fs";
 
 const FILE_STORAGE_PATH = "uploads/";
 
+/**
+ * The number of upload ids remembered to recognise retried uploads
+ */
+const RECENT_UPLOAD_IDS_SIZE = 1000;
+
 export default function (wsInstance: expressWs.Instance): expressWs.Router {
 	const measurementController = express.Router();
 	wsInstance.applyTo(measurementController);
@@ -33,6 +39,12 @@ export default function (wsInstance: expressWs.Instance): expressWs.Router {
 		
 	}
 	
+	/**
+	 * Upload ids (idempotency keys) of recently stored measurements, oldest first.
+	 * A client retrying an upload whose response was lost sends the same id again.
+	 */
+	const recentUploadIds: string[] = [];
+
 	function isMeasurementData(x: unknown): x is MeasurementData {
 		if(typeof x !== 'object') return false;
 		if(x === null) return false;
@@ -61,6 +73,14 @@ export default function (wsInstance: expressWs.Instance): expressWs.Router {
 			return;
 		}
 
+		// acknowledge a retried upload without storing it twice
+		const uploadId = typeof req.body.uploadId === 'string' ? req.body.uploadId : undefined;
+		if(uploadId !== undefined && recentUploadIds.includes(uploadId)){
+			await fs.promises.unlink(req.file.path);
+			res.sendStatus(200);
+			return;
+		}
+
 		// check if the experiment exists
 		const experiment = await Experiment.findByPk(req.body.experimentId);
 		if(experiment === null){
@@ -83,6 +103,12 @@ export default function (wsInstance: expressWs.Instance): expressWs.Router {
 			pointNumber: point.pointNumber,
 			filename: path.resolve(req.file.path)
 		});
+		if(uploadId !== undefined){
+			recentUploadIds.push(uploadId);
+			if(recentUploadIds.length > RECENT_UPLOAD_IDS_SIZE){
+				recentUploadIds.shift();
+			}
+		}
 
 		res.sendStatus(200);
 
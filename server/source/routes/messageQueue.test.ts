@@ -69,7 +69,9 @@ describe('get messages endpoint', {timeout: 1000}, async () => {
 		const response = await request(app).get('/get/dat/0').expect(200);
 		assert.deepStrictEqual(msgMock.mock.calls.length, 1);
 		msgMock.mock.restore();
-		assert.deepStrictEqual(response.body, {latestId:0, messages:[{topic:'das', body:['x']}]})
+		assert.deepStrictEqual(response.body, {
+			latestId:0, epoch:mainQueue.epoch, firstId:0, messages:[{topic:'das', body:['x']}]
+		})
 	});
 });
 
@@ -26,7 +26,9 @@ export default function (wsInstance: expressWs.Instance): expressWs.Router {
 		const lastId = Number(req.params.lastId);
 		const messages : Message[] = [...mainQueue.messagesSinceId(lastId, [req.params.topic])];
 		const queueLastMessage = mainQueue.getId();
-		const response: QueueResponse = {latestId:queueLastMessage, messages:messages};
+		const response: QueueResponse = {
+			latestId:queueLastMessage, epoch:mainQueue.epoch, firstId:mainQueue.firstId, messages:messages
+		};
 		res.status(200);
 		res.send(response);
 	});
@@ -62,16 +64,18 @@ export default function (wsInstance: expressWs.Instance): expressWs.Router {
 		}
 	});
 
+	// frames carry the id and epoch of each message, so a client can
+	// catch up on older ones with /get and skip those it already has
 	router.ws('/ws', async (ws, req) => {
 		const currentId = mainQueue.getId();
-		const generator = mainQueue.messagesSinceIdAsync(currentId, 'all');
+		const generator = mainQueue.entriesSinceIdAsync(currentId, 'all');
 		ws.onmessage = (msg) => {
 			if(isMessagePayload(msg.data)) {
 				mainQueue.addMessage(msg.data);
 			}
 		};
-		for await (const msg of generator){
-			ws.send(JSON.stringify(msg));
+		for await (const entry of generator){
+			ws.send(JSON.stringify({...entry.message, id: entry.id, epoch: entry.epoch}));
 		}
 	});
 
@@ -2,7 +2,8 @@ import express from 'express';
 import bodyParser from 'body-parser';
 import type { QueueResponse} from './lib/messageQueue.js';
 import { mainQueue } from './lib/messageQueue.js';
-import { server as config } from './config.js';
+import { server as config, messageQueue as queueConfig } from './config.js';
+import type { JSONValue } from './config.js';
 import http from 'http';
 //import { Server } from 'socket.io';
 //import { websocketSetup } from './routes/websocket.messageQueue.js';
@@ -49,14 +50,16 @@ app.use('/measurements', measurementController(wsInstance));
 app.get('/', (req, res) => {res.redirect('/samples');});
 
 // posts new messages to the queue
+// accepts a single message or an array of messages posted as one batch
 app.post('/', (req, res) => {
 	if(!req.is('json')){
 		res.status(415);
 		res.send("Invalid type");
 		return;
 	}
-	if(typeof req.body.topic === 'string' && req.body.body instanceof Object){
-		mainQueue.addMessage(req.body.topic, req.body.body);
+	const messages: Message[] = Array.isArray(req.body) ? req.body : [req.body];
+	if(messages.every((msg)=>msg instanceof Object && typeof msg.topic === 'string' && msg.body instanceof Object)){
+		messages.forEach((msg)=>mainQueue.addMessage(msg.topic, msg.body as JSONValue));
 		res.status(200);
 		res.end();
 	}else{
@@ -66,20 +69,26 @@ app.post('/', (req, res) => {
 });
 
 // retrieves messages from the queue
-app.get('/retrieve', (req, res) => {
+// with wait (milliseconds) the request is held until a matching message
+// arrives or the wait expires (long-polling), capped at maxRetrieveWait
+app.get('/retrieve', async (req, res) => {
 	const id=Number(req.query.Id);
+	const wait=Math.min(Math.max(Number(req.query.wait ?? 0) || 0, 0), queueConfig.maxRetrieveWait);
 	const topics:string[]=[];
 	if( req.query.topics instanceof Array){
 		req.query.topics.forEach((val)=>{if(typeof val ==='string')topics.push(val.toString());});
 	}
 	if(!isNaN(id)){
-		const response: QueueResponse={latestId:mainQueue.getId(), messages:[]};
-		const messages: Message[]=[...mainQueue.messagesSinceId(id,topics)];
-		messages.forEach(value=>response.messages.push(value));
+		const messages: Message[]=wait > 0
+			? await mainQueue.waitForMessages(id, topics, wait)
+			: [...mainQueue.messagesSinceId(id,topics)];
+		const latestId=mainQueue.getId();
+		const response: QueueResponse={latestId, epoch:mainQueue.epoch, firstId:mainQueue.firstId, messages:messages};
 		res.send(response);
 	}else{
 		res.status(400);
-		const queueResponse:QueueResponse={latestId:mainQueue.getId(),messages:[]};
+		const latestId=mainQueue.getId();
+		const queueResponse:QueueResponse={latestId, epoch:mainQueue.epoch, firstId:mainQueue.firstId, messages:[]};
 		res.send(queueResponse);
 	}
 });